@@ -0,0 +1,99 @@
+import math
+import time
+
+from mqtt_logging import get_logger
+
+log = get_logger('autoscaler')
+
+
+class Actuator:
+    """Something whose capacity, in workers, the autoscaler can change."""
+
+    def capacity(self):
+        raise NotImplementedError
+
+    def resize(self, count):
+        raise NotImplementedError
+
+
+class DryRunActuator(Actuator):
+    """Only logs the resizes and remembers the capacity they would have left; nothing is started or stopped."""
+
+    def __init__(self, capacity):
+        self.count = capacity
+
+    def capacity(self):
+        return self.count
+
+    def resize(self, count):
+        log.info("[DRY RUN] Would resize from %s to %s workers", self.count, count)
+        self.count = count
+
+
+class Autoscaler:
+    """Turns load forecasts into resizes of an actuator, without flapping.
+
+    Thresholds are in forecast units per worker (PUBLISH packets per metrics interval).
+    Above up_threshold the capacity grows at once to what brings every worker back under
+    it. A worker is only removed when the forecast would leave the rest below
+    down_threshold, for down_after forecasts in a row; the gap between the two
+    thresholds is the hysteresis. Each direction has its own cooldown since the last
+    resize, and the capacity stays within [minimum, maximum].
+
+    A new worker takes time to start and to be given clients, so capacity has to be in
+    place before the load arrives. When a forecast rises above the last one by more than
+    the pool's hysteresis band, it is extrapolated `lead` forecasts further along that
+    rise. Smaller rises are taken as noise and used as they are.
+    """
+
+    def __init__(self, actuator, minimum, maximum, up_threshold, down_threshold, up_cooldown, down_cooldown,
+                 down_after=1, lead=0):
+        if not 0 < down_threshold < up_threshold:
+            raise ValueError("down_threshold must be positive and below up_threshold")
+        self.actuator = actuator
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.up_threshold = up_threshold
+        self.down_threshold = down_threshold
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.down_after = down_after
+        self.lead = lead
+        self.last_forecast = None
+        self.last_resize = float('-inf')
+        self.low_forecasts = 0  # Consecutive forecasts that would allow shrinking
+        self.resizes = 0
+
+    def target(self, predicted, capacity):
+        """The capacity the forecast calls for, before cooldowns; capacity if nothing should change."""
+        if predicted > self.up_threshold * capacity:
+            return min(self.maximum, max(capacity + 1, math.ceil(predicted / self.up_threshold)))
+        if capacity > self.minimum and predicted < self.down_threshold * (capacity - 1):
+            return capacity - 1  # One at a time: a forecast that keeps falling shrinks further after the cooldown
+        return max(self.minimum, min(self.maximum, capacity))
+
+    def observe(self, predicted, now=None):
+        """Resizes the actuator if the forecast calls for it; returns the new capacity, or None."""
+        now = time.monotonic() if now is None else now
+        capacity = self.actuator.capacity()
+        rise = 0 if self.last_forecast is None else predicted - self.last_forecast
+        self.last_forecast = predicted
+        if self.lead and rise > (self.up_threshold - self.down_threshold) * capacity:
+            predicted += self.lead * rise
+        target = self.target(predicted, capacity)
+        self.low_forecasts = self.low_forecasts + 1 if target < capacity else 0
+        if target > capacity:
+            if now - self.last_resize < self.up_cooldown:
+                return None
+            log.info("[SCALING UP] Predicted load %.0f: %s -> %s workers", predicted, capacity, target)
+        elif target < capacity:
+            if now - self.last_resize < self.down_cooldown or self.low_forecasts < self.down_after:
+                return None
+            log.info("[SCALING DOWN] Predicted load %.0f: %s -> %s workers", predicted, capacity, target)
+        else:
+            return None
+        self.actuator.resize(target)
+        self.last_resize = now
+        self.low_forecasts = 0
+        self.resizes += 1
+        return target
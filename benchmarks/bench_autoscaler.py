@@ -0,0 +1,118 @@
+"""Replays a load trace through the Autoscaler in dry-run mode, on a simulated clock.
+
+The trace is --intervals samples of PUBLISH counts per metrics interval: a noisy
+baseline with a spike (a ramp up to --spike times the baseline, a plateau, a ramp
+down). Each forecaster is asked for the next interval at every step:
+
+    oracle    the value that actually comes next (a perfect forecast)
+    reactive  the last value seen, i.e. scaling on current load
+    model     NumpyLSTM on the last window of the trace (--model mqtt_lstm_model.npz)
+
+Reported per forecaster: resizes, flaps (a resize undone by the next one within
+--flap-window seconds), intervals where the load was above what the workers could take
+(--worker-capacity), and how many intervals before the spike first reaches its level
+the pool was big enough for its peak load (negative: after). With a perfect forecast
+the pool should be ready at least one interval early, with no flap and no overload.
+
+Run from the repository root:
+    python -m benchmarks.bench_autoscaler [--intervals 720] [--baseline 800] [--spike 6]
+        [--ramp 3] [--noise 0.15] [--model mqtt_lstm_model.npz]
+"""
+import argparse
+import math
+import random
+
+import config
+from autoscaling import Autoscaler, DryRunActuator
+
+
+def make_trace(intervals, baseline, spike, ramp, noise, seed):
+    rng = random.Random(seed)
+    start, plateau = intervals // 2, max(1, intervals // 12)
+    trace = []
+    for index in range(intervals):
+        if index < start or index >= start + 2 * ramp + plateau:
+            level = 1.0
+        elif index < start + ramp:
+            level = 1.0 + (spike - 1.0) * (index - start + 1) / ramp
+        elif index < start + ramp + plateau:
+            level = spike
+        else:
+            level = spike - (spike - 1.0) * (index - start - ramp - plateau + 1) / ramp
+        trace.append(max(0.0, baseline * level * (1.0 + rng.gauss(0.0, noise))))
+    return trace, start + ramp - 1  # The last step of the ramp already reaches the spike level
+
+
+def simulate(trace, peak_at, forecast, args):
+    actuator = DryRunActuator(args.min_workers)
+    autoscaler = Autoscaler(actuator, args.min_workers, args.max_workers, args.up_threshold, args.down_threshold,
+                            args.up_cooldown, args.down_cooldown, args.down_after, args.lead)
+    peak_workers = math.ceil(max(trace) / args.worker_capacity)
+    ready_at = None  # First interval at which the pool could take the peak load
+    overloaded = 0
+    resizes = []  # (time, +1 or -1)
+    for index, load in enumerate(trace):
+        if load > actuator.capacity() * args.worker_capacity:
+            overloaded += 1
+        if ready_at is None and actuator.capacity() >= min(peak_workers, args.max_workers):
+            ready_at = index
+        predicted = forecast(index)
+        if predicted is None:
+            continue
+        before = actuator.capacity()
+        resized = autoscaler.observe(predicted, now=index * args.interval)
+        if resized is not None:
+            resizes.append((index * args.interval, 1 if resized > before else -1))
+    flaps = sum(1 for (t1, d1), (t2, d2) in zip(resizes, resizes[1:]) if d1 != d2 and t2 - t1 < args.flap_window)
+    lead = None if ready_at is None else peak_at - ready_at
+    return len(resizes), flaps, overloaded, lead
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--intervals", type=int, default=720)
+    parser.add_argument("--interval", type=float, default=config.METRICS_INTERVAL or 10, help="Seconds per sample")
+    parser.add_argument("--baseline", type=float, default=800, help="PUBLISH per interval outside the spike")
+    parser.add_argument("--spike", type=float, default=6.0, help="Peak load as a multiple of the baseline")
+    parser.add_argument("--ramp", type=int, default=3, help="Intervals the spike takes to build up")
+    parser.add_argument("--noise", type=float, default=0.15, help="Relative standard deviation of the load")
+    parser.add_argument("--fanout", type=float, default=3.0, help="sub_count per pub_count, for the model's input")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--worker-capacity", type=float, default=1500, help="PUBLISH per interval one worker can take")
+    parser.add_argument("--min-workers", type=int, default=config.AUTOSCALE_MIN_WORKERS)
+    parser.add_argument("--max-workers", type=int, default=config.AUTOSCALE_MAX_WORKERS or 8)
+    parser.add_argument("--up-threshold", type=float, default=config.AUTOSCALE_UP_THRESHOLD)
+    parser.add_argument("--down-threshold", type=float, default=config.AUTOSCALE_DOWN_THRESHOLD)
+    parser.add_argument("--up-cooldown", type=float, default=config.AUTOSCALE_UP_COOLDOWN)
+    parser.add_argument("--down-cooldown", type=float, default=config.AUTOSCALE_DOWN_COOLDOWN)
+    parser.add_argument("--down-after", type=int, default=config.AUTOSCALE_DOWN_AFTER)
+    parser.add_argument("--lead", type=int, default=config.AUTOSCALE_LEAD, help="Forecasts a steep rise is extrapolated")
+    parser.add_argument("--flap-window", type=float, default=600,
+                        help="Seconds within which a resize undone by the next one counts as a flap")
+    parser.add_argument("--model", default=None, help="Exported model (.npz) to add as a forecaster")
+    args = parser.parse_args()
+
+    trace, peak_at = make_trace(args.intervals, args.baseline, args.spike, max(1, args.ramp), args.noise, args.seed)
+    forecasters = {
+        'oracle': lambda index: trace[index + 1] if index + 1 < len(trace) else None,
+        'reactive': lambda index: trace[index],
+    }
+    if args.model:
+        from lstm_inference import NumpyLSTM  # Needs NumPy; the rest of the simulation does not
+
+        model = NumpyLSTM(args.model)
+        series = {'pub_count': trace, 'sub_count': [value * args.fanout for value in trace]}
+        rows = [[series[feature][index] for feature in model.features] for index in range(len(trace))]
+        forecasters['model'] = (lambda index: model.forecast(rows[index + 1 - model.window:index + 1])
+                                if index + 1 >= model.window else None)
+
+    print(f"{args.intervals} intervals of {args.interval:g}s, spike x{args.spike:g} arriving at interval {peak_at}")
+    print(f"{'forecaster':<10} {'resizes':>8} {'flaps':>6} {'overloaded':>11} {'ready before peak':>18}")
+    for name, forecast in forecasters.items():
+        resizes, flaps, overloaded, lead = simulate(trace, peak_at, forecast, args)
+        ready = "never" if lead is None else f"{lead} intervals"
+        print(f"{name:<10} {resizes:>8} {flaps:>6} {overloaded:>11} {ready:>18}")
+
+
+if __name__ == "__main__":
+    main()
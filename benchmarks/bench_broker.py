@@ -0,0 +1,445 @@
+"""End-to-end load generator for the broker variants over loopback TCP.
+
+Starts a broker in-process (a thread) or as a subprocess, connects --publishers
+and --subscribers real MQTT clients, and publishes --messages per publisher,
+round-robin over --topics topics (subscriber i listens on topic i % topics, so the
+fan-out per topic is subscribers / topics). Every payload carries its send time,
+so end-to-end latency is measured per delivered message.
+
+Reports publish and delivery rates, delivered bytes/s, p50/p99/p999 latency and
+the broker's RSS growth per connection (subprocess mode measures the broker alone;
+in-process mode also counts the client sockets). --json writes the results to a
+file so runs can be compared between commits.
+
+--workers 1,2,4 runs the same load against a worker pool of each size instead:
+worker processes of --server share the port through SO_REUSEPORT and are linked by
+the worker bus, as worker_pool.py runs them. The kernel spreads the client
+connections over the workers, so a publisher usually reaches most subscribers
+through another worker; use enough publishers to keep every worker busy. Delivery
+throughput is reported per pool size, with the speed-up over the first size. The
+clients all run in this process, which needs a core of its own: on a box with N
+cores, pool sizes up to N - 1 show how the broker scales.
+
+Run from the repository root:
+    python -m benchmarks.bench_broker [--server mqtt_server:MQTTServer] [--subprocess | --workers 1,2,4]
+        [--publishers 4] [--subscribers 40] [--topics 4] [--messages 5000]
+        [--payload 64] [--rate 0] [--json results.json]
+"""
+import argparse
+import importlib
+import json
+import os
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config
+from mqtt_framer import PacketFramer, encode_remaining_length
+
+TIMESTAMP_DIGITS = 20  # perf_counter_ns() at send time as ASCII digits, so any payload decoder copes
+PROBE_TOPIC = "bench/probe"  # Tells when the subscriptions have reached every worker of a pool
+
+
+def packet(header, body):
+    return bytes([header]) + encode_remaining_length(len(body)) + body
+
+
+def mqtt_string(text):
+    data = text.encode('utf-8')
+    return struct.pack("!H", len(data)) + data
+
+
+def read_packet(sock, framer):
+    while True:
+        for header, body in framer.packets():
+            return header, bytes(body)
+        if framer.recv_into(sock) == 0:
+            raise ConnectionError("broker closed the connection")
+
+
+def open_client(host, port, client_id):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    framer = PacketFramer()
+    sock.sendall(packet(0x10, mqtt_string("MQTT") + bytes([4, 0x02]) + struct.pack("!H", 60)
+                        + mqtt_string(client_id)))
+    header, _ = read_packet(sock, framer)
+    if header != 0x20:
+        raise ConnectionError(f"expected CONNACK, got {header:#x}")
+    return sock, framer
+
+
+def subscribe(sock, framer, topic, qos=0):
+    sock.sendall(packet(0x82, struct.pack("!H", 1) + mqtt_string(topic) + bytes([qos])))
+    header, _ = read_packet(sock, framer)
+    if header != 0x90:
+        raise ConnectionError(f"expected SUBACK, got {header:#x}")
+
+
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"broker did not start listening on {host}:{port}")
+
+
+def store_overrides(directory):
+    """Config overrides that move the retained and session stores, where enabled, into directory.
+
+    A benchmark measures the broker as configured, but never reads or writes the real stores.
+    """
+    return {"RETAINED_STORE_PATH": config.RETAINED_STORE_PATH and os.path.join(directory, "retained.log"),
+            "SESSION_STORE_DIR": config.SESSION_STORE_DIR and os.path.join(directory, "sessions")}
+
+
+def start_broker(server, port, use_subprocess, queue_size):
+    """Returns (pid, stop) for a broker listening on 127.0.0.1:port."""
+    module_name, class_name = server.split(":")
+    directory = tempfile.mkdtemp(prefix="bench-broker-")
+    overrides = {"MQTT_HOST": "127.0.0.1", "MQTT_PORT": port, "OUTBOUND_QUEUE_SIZE": queue_size,
+                 "INFLUX_SPILL_PATH": None, **store_overrides(directory)}
+    if use_subprocess:
+        code = (f"import config; config.__dict__.update({overrides!r})\n"
+                f"import {module_name}\n"
+                f"broker = {module_name}.{class_name}(sinks=[])\n"
+                f"broker.start()\n")
+        process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL)
+        wait_for_port("127.0.0.1", port)
+
+        def stop():
+            process.terminate()
+            process.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        return process.pid, stop
+
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    broker = getattr(importlib.import_module(module_name), class_name)(sinks=[])  # The broker, not the persistence path
+    threading.Thread(target=broker.start, daemon=True).start()
+    wait_for_port("127.0.0.1", port)
+    return os.getpid(), lambda: shutil.rmtree(directory, ignore_errors=True)
+
+
+def listeners(port):
+    """Counts the sockets listening on a TCP port; each worker of a pool has its own."""
+    count = 0
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == "0A" and int(fields[1].rpartition(":")[2], 16) == port:  # LISTEN
+                        count += 1
+        except OSError:
+            pass
+    return count
+
+
+def start_workers(server, port, workers, queue_size):
+    """Returns (pids, stop) for a pool of worker processes sharing 127.0.0.1:port.
+
+    Each worker runs `server` with no sinks and the worker bus, as run_worker() does.
+    """
+    module_name, class_name = server.split(":")
+    directory = tempfile.mkdtemp(prefix="bench-workers-")
+    processes = []
+    for index in range(workers):
+        overrides = {"MQTT_HOST": "127.0.0.1", "MQTT_PORT": port, "OUTBOUND_QUEUE_SIZE": queue_size,
+                     "INFLUX_SPILL_PATH": None, "METRICS_PORT": None, "BUS_SOCKET_DIR": directory,
+                     **store_overrides(os.path.join(directory, f"worker{index}"))}
+        code = (f"import config; config.__dict__.update({overrides!r})\n"
+                f"import {module_name}, worker_pool\n"
+                f"broker = {module_name}.{class_name}(sinks=[])\n"
+                f"broker.reuse_port = True\n"
+                f"broker.bus = worker_pool.WorkerBus(broker, {index}, {workers})\n"
+                f"broker.bus.start()\n"
+                f"broker.start()\n")
+        processes.append(subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL))
+
+    def stop():
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    deadline = time.monotonic() + 10
+    while listeners(port) < workers:
+        if time.monotonic() > deadline or any(process.poll() is not None for process in processes):
+            stop()
+            raise RuntimeError(f"the {workers} workers did not all start listening on port {port}")
+        time.sleep(0.05)
+    return [process.pid for process in processes], stop
+
+
+def wait_for_interest(subscribers, publishers, timeout=30):
+    """Publishes probes until every subscriber gets one from every publisher, then drains them.
+
+    Each subscriber subscribed to PROBE_TOPIC after its topic, and the worker bus sends a
+    link's filters in order, so a probe arriving means the worker the publisher is on
+    already forwards the subscriber's topic too.
+    """
+    missing = [set(range(len(publishers))) for _ in subscribers]
+    for sock, _ in subscribers:
+        sock.settimeout(0.01)
+    deadline = time.monotonic() + timeout
+    while any(missing):
+        if time.monotonic() > deadline:
+            raise RuntimeError("the subscriptions did not reach every worker")
+        for index, sock in enumerate(publishers):
+            sock.sendall(packet(0x30, mqtt_string(PROBE_TOPIC) + b"%d" % index))
+        for (sock, framer), waiting in zip(subscribers, missing):
+            try:
+                while framer.recv_into(sock):
+                    for header, body in framer.packets():
+                        if header >> 4 == 3:
+                            waiting.discard(int(bytes(body[2 + len(PROBE_TOPIC):])))
+            except socket.timeout:
+                pass
+    for sock, framer in subscribers:  # Probes still on their way would be taken for messages
+        sock.settimeout(0.2)
+        try:
+            while framer.recv_into(sock):
+                list(framer.packets())
+        except socket.timeout:
+            pass
+        sock.settimeout(None)
+
+
+class SubscriberPool(threading.Thread):
+    """Reads every subscriber socket from one selector and records per-message latency.
+
+    With track_duplicates, also counts deliveries of a message (told apart by its send
+    time) beyond the first, across all the subscribers.
+    """
+
+    def __init__(self, clients, track_duplicates=False):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for sock, framer in clients:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, framer)
+        self.latencies_ns = []
+        self.received = 0
+        self.bytes = 0
+        self.seen = set() if track_duplicates else None
+        self.duplicates = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                framer = key.data
+                try:
+                    if framer.recv_into(key.fileobj) == 0:
+                        self.selector.unregister(key.fileobj)
+                        continue
+                except BlockingIOError:
+                    continue
+                now = time.perf_counter_ns()
+                for header, body in framer.packets():
+                    if header >> 4 != 3:
+                        continue
+                    topic_length = struct.unpack_from("!H", body)[0]
+                    sent_at = int(body[2 + topic_length:2 + topic_length + TIMESTAMP_DIGITS])
+                    self.latencies_ns.append(now - sent_at)
+                    if self.seen is not None:
+                        if sent_at in self.seen:
+                            self.duplicates += 1
+                        self.seen.add(sent_at)
+                    self.received += 1
+                    self.bytes += len(body) + 2  # Body plus a typical 2-byte fixed header
+
+
+def publisher(sock, topics, messages, payload_size, rate, start_event):
+    padding = b"x" * max(0, payload_size - TIMESTAMP_DIGITS)
+    prefixes = [bytes([0x30]) + encode_remaining_length(len(mqtt_string(topic)) + TIMESTAMP_DIGITS + len(padding))
+                + mqtt_string(topic) for topic in topics]
+    interval = 1 / rate if rate else 0
+    start_event.wait()
+    next_send = time.perf_counter()
+    for i in range(messages):
+        if interval:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+        try:
+            sock.sendall(prefixes[i % len(prefixes)] + b"%020d" % time.perf_counter_ns() + padding)
+        except OSError as e:
+            print(f"publisher stopped after {i} messages: {e}", file=sys.stderr)
+            return
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_load(args, pids, probe=False):
+    """Connects the clients, runs the load against the broker processes in pids and returns the results."""
+    topics = [f"bench/topic{i}" for i in range(args.topics)]
+    rss_before = [rss_kb(pid) for pid in pids]
+    subscribers = []
+    for i in range(args.subscribers):
+        sock, framer = open_client("127.0.0.1", args.port, f"bench-sub-{i}")
+        subscribe(sock, framer, topics[i % args.topics])
+        if probe:
+            subscribe(sock, framer, PROBE_TOPIC)
+        subscribers.append((sock, framer))
+    publishers = [open_client("127.0.0.1", args.port, f"bench-pub-{i}")[0] for i in range(args.publishers)]
+    connections = args.subscribers + args.publishers
+    rss_after = [rss_kb(pid) for pid in pids]
+    if probe:
+        wait_for_interest(subscribers, publishers)
+
+    # Publisher i sends message k to topic k % topics; subscriber j listens on topic j % topics
+    per_topic = [0] * args.topics
+    for k in range(args.messages):
+        per_topic[k % args.topics] += args.publishers
+    expected = sum(per_topic[j % args.topics] for j in range(args.subscribers))
+
+    pool = SubscriberPool(subscribers)
+    pool.start()
+    start_event = threading.Event()
+    threads = [threading.Thread(target=publisher, args=(sock, topics, args.messages, args.payload,
+                                                        args.rate, start_event)) for sock in publishers]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    published_in = time.perf_counter() - start
+    last_count, last_progress = -1, time.monotonic()
+    while pool.received < expected and time.monotonic() - last_progress < args.timeout:
+        if pool.received != last_count:
+            last_count, last_progress = pool.received, time.monotonic()
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    pool.running = False
+    for sock in publishers + [sock for sock, _ in subscribers]:
+        sock.close()
+
+    latencies = sorted(pool.latencies_ns)
+    published = args.messages * args.publishers
+    rss_known = None not in rss_before + rss_after
+    return {
+        "published": published,
+        "expected_deliveries": expected,
+        "delivered": pool.received,
+        "elapsed_s": round(elapsed, 4),
+        "publish_msgs_per_s": round(published / published_in, 1),
+        "delivery_msgs_per_s": round(pool.received / elapsed, 1),
+        "delivery_bytes_per_s": round(pool.bytes / elapsed, 1),
+        "latency_us": {
+            name: (round(value / 1000, 1) if value is not None else None)
+            for name, value in (("p50", percentile(latencies, 0.50)), ("p99", percentile(latencies, 0.99)),
+                                ("p999", percentile(latencies, 0.999)),
+                                ("max", latencies[-1] if latencies else None))
+        },
+        "rss_kb_per_connection": (round((sum(rss_after) - sum(rss_before)) / connections, 2)
+                                  if rss_known else None),
+    }
+
+
+def print_results(results):
+    print(f"published   {results['published']:>10,}  {results['publish_msgs_per_s']:>12,.0f} msgs/s")
+    print(f"delivered   {results['delivered']:>10,}  {results['delivery_msgs_per_s']:>12,.0f} msgs/s  "
+          f"{results['delivery_bytes_per_s'] / 1e6:>8.2f} MB/s  (expected {results['expected_deliveries']:,})")
+    print("latency     " + "  ".join(f"{name} {value} us" for name, value in results["latency_us"].items()))
+    print(f"rss         {results['rss_kb_per_connection']} KB per connection")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default="mqtt_server:MQTTServer",
+                        help="module:Class, e.g. PureMQTT:MQTTServer or mqtt_server:AsyncMQTTServer")
+    placement = parser.add_mutually_exclusive_group()
+    placement.add_argument("--subprocess", action="store_true", help="Run the broker in its own process")
+    placement.add_argument("--workers", help="Comma-separated worker pool sizes to run the load against, e.g. 1,2,4")
+    parser.add_argument("--port", type=int, default=18830)
+    parser.add_argument("--publishers", type=int, default=4)
+    parser.add_argument("--subscribers", type=int, default=40)
+    parser.add_argument("--topics", type=int, default=4, help="Distinct topics (fan-out = subscribers / topics)")
+    parser.add_argument("--messages", type=int, default=5000, help="Messages per publisher")
+    parser.add_argument("--payload", type=int, default=64, help="Payload size in bytes (minimum 20)")
+    parser.add_argument("--rate", type=float, default=0, help="Messages/s per publisher (0 = unthrottled)")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="Give up once no message has arrived for this many seconds")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    header = (f"{args.publishers} publishers -> {args.subscribers} subscribers "
+              f"on {args.topics} topics, {args.payload}-byte payloads")
+    results = {
+        "server": args.server,
+        "mode": "workers" if args.workers else "subprocess" if args.subprocess else "in-process",
+        "commit": git_commit(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("json", "port", "server")},
+    }
+    if args.workers:
+        counts = [int(count) for count in args.workers.split(",")]
+        print(f"{args.server} (worker pool): {header}")
+        results["workers"] = {}
+        for count in counts:
+            pids, stop = start_workers(args.server, args.port, count, args.messages * args.publishers)
+            try:
+                run = results["workers"][count] = run_load(args, pids, probe=True)
+            finally:
+                stop()
+            print(f"-- {count} worker{'s' if count > 1 else ''}")
+            print_results(run)
+        base = results["workers"][counts[0]]["delivery_msgs_per_s"]
+        print("workers  delivered msgs/s  speed-up")
+        for count in counts:
+            rate = results["workers"][count]["delivery_msgs_per_s"]
+            print(f"{count:>7}  {rate:>16,.0f}  {rate / base if base else 0:>7.2f}x")
+    else:
+        pid, stop = start_broker(args.server, args.port, args.subprocess, args.messages * args.publishers)
+        try:
+            results.update(run_load(args, [pid]))
+        finally:
+            stop()
+        print(f"{args.server} ({results['mode']}): {header}")
+        print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
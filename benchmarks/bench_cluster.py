@@ -0,0 +1,195 @@
+"""Three cluster nodes on loopback: throughput when publisher and subscriber are on different nodes.
+
+Starts --nodes broker processes linked as a cluster (cluster.py), then runs the
+same load three times with the publishers on node 0:
+
+    local   every subscriber on node 0 (no cluster link involved)
+    remote  every subscriber on the last node, one link away
+    spread  subscribers spread over all nodes
+    shared  subscribers spread over all nodes, all in one $share/bench/<topic> group
+            per topic: each message must reach exactly one of them
+
+Reports delivery rate and latency per run, checks that every message arrived
+exactly once (counting deliveries per message in the shared run), and reads the nodes' mqtt_bus_forwarded_total /
+mqtt_bus_received_total counters to show which nodes the publishes were sent to:
+a node without a matching subscriber should receive none. The CPU time every node
+used during the run shows what the links cost; compare --batch-delay 0 with the
+default at a steady --rate, where unbatched links write every message separately.
+
+Run from the repository root:
+    python -m benchmarks.bench_cluster [--mode threaded|async] [--nodes 3] [--publishers 2]
+        [--subscribers 4] [--messages 20000] [--payload 64] [--rate 0] [--batch-delay 0.001]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from benchmarks.bench_broker import (SubscriberPool, open_client, percentile, publisher, store_overrides, subscribe,
+                                     wait_for_port)
+
+SERVER_CLASSES = {"threaded": "MQTTServer", "async": "AsyncMQTTServer"}
+
+
+def start_node(index, args):
+    peers = [f"127.0.0.1:{args.cluster_port + other}" for other in range(args.nodes) if other != index]
+    overrides = {"MQTT_HOST": "127.0.0.1", "MQTT_PORT": args.port + index, "CLUSTER_HOST": "127.0.0.1",
+                 "CLUSTER_PORT": args.cluster_port + index, "CLUSTER_NODE_ID": f"node{index}",
+                 "CLUSTER_PEERS": peers, "CLUSTER_BATCH_DELAY": args.batch_delay,
+                 "METRICS_PORT": args.metrics_port + index, "METRICS_HOST": "127.0.0.1", "METRICS_INTERVAL": None,
+                 "OUTBOUND_QUEUE_SIZE": args.messages * args.publishers, "INFLUX_SPILL_PATH": None,
+                 "LOG_LEVEL": "WARNING", **store_overrides(os.path.join(args.directory, f"node{index}"))}
+    code = (f"import config; config.__dict__.update({overrides!r})\n"
+            f"import mqtt_logging; mqtt_logging.setup_logging()\n"
+            f"import cluster, mqtt_server\n"
+            f"server = mqtt_server.{SERVER_CLASSES[args.mode]}(sinks=[])\n"
+            f"server.bus = cluster.ClusterBus(server)\n"
+            f"server.bus.start()\n"
+            f"server.start()\n")
+    process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL)
+    wait_for_port("127.0.0.1", args.port + index)
+    return process
+
+
+def bus_counters(args, index):
+    with urllib.request.urlopen(f"http://127.0.0.1:{args.metrics_port + index}/metrics", timeout=5) as response:
+        text = response.read().decode()
+    values = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(" ")
+        if name in ("mqtt_bus_forwarded_total", "mqtt_bus_received_total"):
+            values[name] = int(float(value))
+    return values.get("mqtt_bus_forwarded_total", 0), values.get("mqtt_bus_received_total", 0)
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+
+
+def wait_for_interest(args, publish_node, subscriber_nodes, run):
+    """Publishes probes until a subscriber on every node gets one, so the cluster links and filters are in place."""
+    probe_topic = f"bench/{run}/probe"
+    probes = []
+    for node in set(subscriber_nodes):
+        sock, framer = open_client("127.0.0.1", args.port + node, f"probe-{run}-{node}")
+        subscribe(sock, framer, probe_topic)
+        sock.settimeout(0.05)
+        probes.append((sock, framer))
+    sender, _ = open_client("127.0.0.1", args.port + publish_node, f"probe-{run}-pub")
+    topic = probe_topic.encode()
+    frame = bytes([0x30, 2 + len(topic)]) + len(topic).to_bytes(2, "big") + topic
+    deadline = time.monotonic() + 30
+    waiting = list(probes)
+    while waiting:
+        if time.monotonic() > deadline:
+            raise RuntimeError("the cluster nodes did not link up")
+        sender.sendall(frame)
+        for sock, framer in list(waiting):
+            try:
+                if framer.recv_into(sock) and any(header >> 4 == 3 for header, _ in framer.packets()):
+                    waiting.remove((sock, framer))
+            except OSError:
+                pass
+    for sock, _ in probes + [(sender, None)]:
+        sock.close()
+
+
+def run(args, nodes, name, subscriber_nodes, shared=False):
+    topics = [f"bench/{name}/topic{i}" for i in range(args.topics)]
+    subscribers = []
+    for i, node in enumerate(subscriber_nodes):
+        sock, framer = open_client("127.0.0.1", args.port + node, f"bench-{name}-sub-{i}")
+        subscribe(sock, framer, f"$share/bench/{topics[i % args.topics]}" if shared else topics[i % args.topics])
+        subscribers.append((sock, framer))
+    wait_for_interest(args, 0, subscriber_nodes, name)
+    publishers = [open_client("127.0.0.1", args.port, f"bench-{name}-pub-{i}")[0] for i in range(args.publishers)]
+    per_topic = [0] * args.topics
+    for k in range(args.messages):
+        per_topic[k % args.topics] += args.publishers
+    if shared:
+        expected = sum(per_topic[j] for j in range(min(args.topics, len(subscribers))))  # Once per message
+    else:
+        expected = sum(per_topic[j % args.topics] for j in range(len(subscribers)))
+    before = [bus_counters(args, node) for node in range(args.nodes)]
+    cpu_before = [cpu_seconds(process.pid) for process in nodes]
+
+    pool = SubscriberPool(subscribers, track_duplicates=shared)
+    pool.start()
+    start_event = threading.Event()
+    threads = [threading.Thread(target=publisher,
+                                args=(sock, topics, args.messages, args.payload, args.rate, start_event))
+               for sock in publishers]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    last_count, last_progress = -1, time.monotonic()
+    while pool.received < expected and time.monotonic() - last_progress < args.timeout:
+        if pool.received != last_count:
+            last_count, last_progress = pool.received, time.monotonic()
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.2)  # Anything beyond the expected count would be a duplicate
+    pool.running = False
+    pool.join()
+    cpu = [cpu_seconds(process.pid) - used for process, used in zip(nodes, cpu_before)]
+    after = [bus_counters(args, node) for node in range(args.nodes)]
+    for sock in publishers + [sock for sock, _ in subscribers]:
+        sock.close()
+
+    latencies = sorted(pool.latencies_ns)
+    print(f"{name:<7} {pool.received:>9,} of {expected:,}  {pool.received / elapsed:>10,.0f} msgs/s  "
+          + "  ".join(f"{label} {percentile(latencies, fraction) / 1000:,.0f} us"
+                      for label, fraction in (("p50", 0.5), ("p99", 0.99)) if latencies)
+          + (f"  {pool.duplicates:,} delivered more than once, {len(pool.seen):,} distinct" if shared else ""))
+    print("        bus forwarded/received per node: "
+          + "  ".join(f"node{node} {a[0] - b[0]:,}/{a[1] - b[1]:,}" for node, (b, a) in enumerate(zip(before, after))))
+    print("        CPU seconds per node: " + "  ".join(f"node{node} {used:.2f}" for node, used in enumerate(cpu)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=SERVER_CLASSES, default="threaded", help="SERVER_MODE of every node")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--port", type=int, default=18840, help="MQTT port of node 0; node i uses port + i")
+    parser.add_argument("--cluster-port", type=int, default=18850, help="CLUSTER_PORT of node 0")
+    parser.add_argument("--metrics-port", type=int, default=18860, help="METRICS_PORT of node 0")
+    parser.add_argument("--publishers", type=int, default=2)
+    parser.add_argument("--subscribers", type=int, default=4)
+    parser.add_argument("--topics", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per publisher")
+    parser.add_argument("--payload", type=int, default=64, help="Payload size in bytes (minimum 20)")
+    parser.add_argument("--rate", type=float, default=0, help="Messages/s per publisher (0 = unthrottled)")
+    parser.add_argument("--batch-delay", type=float, default=0.001, help="CLUSTER_BATCH_DELAY")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="Give up once no message has arrived for this many seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as args.directory:
+        nodes = [start_node(index, args) for index in range(args.nodes)]
+        try:
+            print(f"{args.nodes} {args.mode} nodes, {args.publishers} publishers on node0 -> {args.subscribers} "
+                  f"subscribers, {args.messages * args.publishers:,} messages of {args.payload} bytes, "
+                  f"batch delay {args.batch_delay * 1000:g} ms")
+            last = args.nodes - 1
+            run(args, nodes, "local", [0] * args.subscribers)
+            run(args, nodes, "remote", [last] * args.subscribers)
+            run(args, nodes, "spread", [i % args.nodes for i in range(args.subscribers)])
+            run(args, nodes, "shared", [i % args.nodes for i in range(args.subscribers)], shared=True)
+        finally:
+            for process in nodes:
+                process.terminate()
+            for process in nodes:
+                process.wait()
+
+
+if __name__ == "__main__":
+    main()
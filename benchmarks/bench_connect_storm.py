@@ -0,0 +1,207 @@
+"""Reconnect storm: --clients clients connect at once, as a fleet does after a broker restart.
+
+The broker runs in its own process, with the connection-storm settings given here.
+One selector loop opens every client socket as fast as it can, sends CONNECT
+once connected and waits for CONNACK. A refused, reset or closed connection is
+retried after a randomized exponential backoff, as MQTT client libraries do. Every
+client stays connected until the end.
+
+Reports the time until every client had its CONNACK, the per-client time to
+CONNACK (from its first attempt), how many attempts failed, and how many clients
+the broker closed after their CONNACK, which should be none: a takeover only
+closes a connection whose client ID connected again. --anonymous sends empty
+client IDs, which the broker replaces with unique ones. Run with
+--backlog 5 --connect-rate 0 to compare against the old listen(5) behaviour.
+Both processes raise their open-file limit to the hard limit; each needs about one
+descriptor per client.
+
+Run from the repository root:
+    python -m benchmarks.bench_connect_storm [--server mqtt_server:AsyncMQTTServer]
+        [--clients 20000] [--backlog 4096] [--connect-rate 2000] [--connect-burst 500] [--anonymous]
+"""
+import argparse
+import errno
+import heapq
+import random
+import resource
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_broker import mqtt_string, packet, percentile, store_overrides, wait_for_port
+
+RAISE_FILE_LIMIT = ("import resource; soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE); "
+                    "resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))")
+
+
+def start_broker(server, port, overrides, directory):
+    module_name, class_name = server.split(":")
+    overrides = dict(overrides, MQTT_HOST="127.0.0.1", MQTT_PORT=port, INFLUX_SPILL_PATH=None,
+                     METRICS_PORT=None, LOG_LEVEL='WARNING', **store_overrides(directory))
+    code = (f"{RAISE_FILE_LIMIT}\n"
+            f"import config; config.__dict__.update({overrides!r})\n"
+            f"import mqtt_logging; mqtt_logging.setup_logging()\n"
+            f"import {module_name}\n"
+            f"{module_name}.{class_name}(sinks=[]).start()\n")
+    process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL)
+    wait_for_port("127.0.0.1", port)
+    return process
+
+
+class Storm:
+    """Drives every client's connect / CONNECT / CONNACK from one selector."""
+
+    def __init__(self, port, clients, backoff, backoff_max, anonymous=False):
+        self.address = ("127.0.0.1", port)
+        self.selector = selectors.DefaultSelector()
+        self.connects = [packet(0x10, mqtt_string("MQTT") + bytes([4, 0x02]) + struct.pack("!H", 300)
+                                + mqtt_string("" if anonymous else f"storm-{index}")) for index in range(clients)]
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.attempts = [0] * clients
+        self.first_attempt = [None] * clients
+        self.connected_after = []  # Seconds from each client's first attempt to its CONNACK
+        self.failures = 0
+        self.retries = []  # Heap of (time, client index)
+        self.sockets = []
+
+    def attempt(self, index):
+        now = time.perf_counter()
+        if self.first_attempt[index] is None:
+            self.first_attempt[index] = now
+        self.attempts[index] += 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        result = sock.connect_ex(self.address)
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.fail(index)
+            return
+        self.selector.register(sock, selectors.EVENT_WRITE, index)
+
+    def fail(self, index):
+        self.failures += 1
+        delay = min(self.backoff_max, self.backoff * 2 ** (self.attempts[index] - 1)) * random.random()
+        heapq.heappush(self.retries, (time.perf_counter() + delay, index))
+
+    def drop(self, sock, index):
+        self.selector.unregister(sock)
+        sock.close()
+        self.fail(index)
+
+    def run(self, timeout):
+        start = time.perf_counter()
+        for index in range(len(self.connects)):
+            self.attempt(index)
+        total = len(self.connects)
+        while len(self.connected_after) < total and time.perf_counter() - start < timeout:
+            wait = 0.1
+            if self.retries:
+                wait = max(0.0, min(wait, self.retries[0][0] - time.perf_counter()))
+            for key, events in self.selector.select(wait):
+                sock, index = key.fileobj, key.data
+                if events & selectors.EVENT_WRITE:
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        self.drop(sock, index)
+                        continue
+                    try:
+                        sock.send(self.connects[index])  # Small enough to go out in one send
+                    except OSError:
+                        self.drop(sock, index)
+                        continue
+                    self.selector.modify(sock, selectors.EVENT_READ, index)
+                    continue
+                try:
+                    data = sock.recv(4)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                if data[:1] != b"\x20" or (len(data) == 4 and data[3] != 0):
+                    self.drop(sock, index)  # Closed, reset or refused by the broker
+                    continue
+                self.selector.unregister(sock)
+                self.sockets.append(sock)
+                self.connected_after.append(time.perf_counter() - self.first_attempt[index])
+            now = time.perf_counter()
+            while self.retries and self.retries[0][0] <= now:
+                self.attempt(heapq.heappop(self.retries)[1])
+        return time.perf_counter() - start
+
+    def closed_by_broker(self):
+        """Returns how many clients that got their CONNACK have since been disconnected."""
+        closed = 0
+        for sock in self.sockets:
+            try:
+                closed += sock.recv(1) == b""
+            except BlockingIOError:
+                pass  # Still connected, nothing to read
+            except OSError:
+                closed += 1
+        return closed
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default="mqtt_server:AsyncMQTTServer",
+                        help="module:Class; the threaded server needs one thread per client")
+    parser.add_argument("--port", type=int, default=18831)
+    parser.add_argument("--clients", type=int, default=20000)
+    parser.add_argument("--backlog", type=int, default=4096, help="LISTEN_BACKLOG")
+    parser.add_argument("--connect-rate", type=float, default=2000, help="CONNECT_RATE (0 = unthrottled)")
+    parser.add_argument("--connect-burst", type=int, default=500, help="CONNECT_BURST")
+    parser.add_argument("--max-connections", type=int, default=0, help="MAX_CONNECTIONS (0 = no cap)")
+    parser.add_argument("--backoff", type=float, default=0.5, help="Seconds before a client's first retry")
+    parser.add_argument("--backoff-max", type=float, default=8, help="Longest retry delay in seconds")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--anonymous", action="store_true", help="Connect with empty client IDs")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.clients + 64 > hard:
+        print(f"warning: {args.clients} clients need about as many descriptors; the hard limit is {hard}",
+              file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as directory:
+        broker = start_broker(args.server, args.port, {
+            "LISTEN_BACKLOG": args.backlog,
+            "CONNECT_RATE": args.connect_rate or None,
+            "CONNECT_BURST": args.connect_burst,
+            "MAX_CONNECTIONS": args.max_connections or None,
+            "CONNECT_TIMEOUT": max(10, args.timeout),
+        }, directory)
+        storm = Storm(args.port, args.clients, args.backoff, args.backoff_max, args.anonymous)
+        try:
+            elapsed = storm.run(args.timeout)
+            time.sleep(1)  # Lets any takeover close its connection
+            closed = storm.closed_by_broker()
+        finally:
+            storm.close()
+            broker.terminate()
+            broker.wait()
+
+    times = sorted(storm.connected_after)
+    print(f"{args.server}: {args.clients} clients, backlog {args.backlog}, "
+          f"CONNECT rate {args.connect_rate or 'unlimited'} (burst {args.connect_burst})")
+    print(f"connected      {len(times):>8} of {args.clients} in {elapsed:.2f}s"
+          + ("" if len(times) == args.clients else " (timed out)"))
+    if times:
+        print("to CONNACK     " + "  ".join(f"{name} {percentile(times, fraction):.3f}s" for name, fraction in
+                                             (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))))
+    print(f"failed tries   {storm.failures:>8}  (refused, reset or closed, then retried)")
+    print(f"closed later   {closed:>8}  (disconnected by the broker after CONNACK)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Fan-out benchmark: 1 publisher -> N subscribers through publish_to_subscribers().
+
+Compares the previous strategy (re-encode the PUBLISH frame per subscriber and
+sendall() while holding topic_lock) with the current encode-once fan-out into
+per-client outbound queues. Every
+subscriber is a real socketpair drained by a reader thread, so delivered bytes are
+counted end to end. stdout is sent to /dev/null for both runs.
+
+Run from the repository root:
+    python -m benchmarks.bench_fanout [--subscribers 1000] [--messages 2000] [--payload 64]
+"""
+import argparse
+import contextlib
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+import config
+from PureMQTT import MQTTServer
+from mqtt_framer import encode_remaining_length
+
+
+def legacy_create_publish_packet(topic, payload):
+    packet = bytearray()
+    packet.append(0x30)
+    packet.extend(encode_remaining_length(len(topic) + len(payload) + 2))
+    packet.extend(struct.pack("!H", len(topic)))
+    packet.extend(topic.encode('utf-8'))
+    packet.extend(payload.encode('utf-8'))
+    print(f"[DEBUG] Created publish packet: {packet}")
+    return packet
+
+
+def legacy_publish_to_subscribers(server, topic, payload):
+    print(f"[PUBLISH TO SUBSCRIBERS] Topic: {topic}, Payload: {payload}")
+    with server.topic_lock:
+        for client in list(server.topics.match(topic)):
+            client.sendall(legacy_create_publish_packet(topic, payload))
+
+
+class Drain(threading.Thread):
+    """Reads every subscriber socket and counts the bytes that arrive."""
+
+    def __init__(self, sockets):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for sock in sockets:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.received = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    self.received += len(key.fileobj.recv(1 << 16))
+                except BlockingIOError:
+                    pass
+
+
+def run(publish, server, drain, topic, payload, messages, frame_size, subscribers):
+    expected = drain.received + frame_size * messages * subscribers
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(messages):
+            publish(topic, payload)
+    while drain.received < expected:
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--payload", type=int, default=64, help="Payload size in bytes")
+    args = parser.parse_args()
+
+    config.OUTBOUND_QUEUE_SIZE = args.messages  # Measure throughput, not the overflow policy
+    server = MQTTServer()
+    topic = "bench/fanout"
+    payload = "x" * args.payload
+    readers = []
+    for i in range(args.subscribers):
+        sender, reader = socket.socketpair()
+        server.clients[sender] = {"id": f"sub{i}", "address": None,
+                                  "queue": server.create_outbound_queue(sender, f"sub{i}")}
+        server.topics.subscribe(sender, topic)
+        readers.append(reader)
+
+    drain = Drain(readers)
+    drain.start()
+    frame_size = len(server.create_publish_packet(topic, payload))
+
+    results = {}
+    for label, publish in (
+        ("before (encode per subscriber, send under lock)", lambda t, p: legacy_publish_to_subscribers(server, t, p)),
+        ("after (encode once, per-client writer queues)", server.publish_to_subscribers),
+    ):
+        elapsed = run(publish, server, drain, topic, payload, args.messages, frame_size, args.subscribers)
+        results[label] = args.messages / elapsed
+        print(f"{label:<50} {args.messages / elapsed:>10,.0f} msgs/s  "
+              f"{args.messages * args.subscribers / elapsed:>12,.0f} deliveries/s")
+
+    before, after = results.values()
+    print(f"speed-up: {after / before:.2f}x")
+    drain.running = False
+
+
+if __name__ == "__main__":
+    main()
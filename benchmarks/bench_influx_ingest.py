@@ -0,0 +1,89 @@
+"""Ingest throughput with InfluxDB persistence disabled, per-message, and batched.
+
+InfluxDB is simulated by a client whose write_points() sleeps for a fixed round trip
+plus a small per-point cost, so no server is needed. Each variant runs the PUBLISH
+handler of PureMQTT (no subscribers, stdout to /dev/null) and adds its persistence
+step on the calling thread, the way handle_publish does in mqtt_server.py.
+
+Run from the repository root:
+    python -m benchmarks.bench_influx_ingest [--messages 20000] [--rtt-ms 2]
+"""
+import argparse
+import contextlib
+import os
+import struct
+import time
+
+import config
+from PureMQTT import MQTTServer
+from influx_writer import InfluxBatchWriter
+
+
+class SimulatedInfluxClient:
+    def __init__(self, rtt, per_point):
+        self.rtt = rtt
+        self.per_point = per_point
+        self.points = 0
+
+    def create_database(self, name):
+        time.sleep(self.rtt)
+
+    def write_points(self, points, **kwargs):
+        time.sleep(self.rtt + self.per_point * len(points))
+        self.points += len(points)
+        return True
+
+
+def publish_body(topic, payload):
+    topic_bytes = topic.encode('utf-8')
+    return memoryview(struct.pack("!H", len(topic_bytes)) + topic_bytes + payload.encode('utf-8'))
+
+
+def run(label, messages, persist, drain=None):
+    server = MQTTServer()
+    body = publish_body("sensor/data", '{"temperature": 25, "humidity": 50}')
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(messages):
+            server.handle_publish(None, body)
+            if persist is not None:
+                persist("sensor/data", '{"temperature": 25, "humidity": 50}')
+    ingest = time.perf_counter() - start
+    if drain is not None:
+        drain()
+    total = time.perf_counter() - start
+    print(f"{label:<32} {messages / ingest:>12,.0f} msgs/s ingest   {messages / total:>12,.0f} msgs/s persisted")
+    return messages / ingest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="Simulated HTTP round trip per write")
+    parser.add_argument("--per-point-us", type=float, default=1.0, help="Simulated server cost per point")
+    args = parser.parse_args()
+    rtt, per_point = args.rtt_ms / 1000, args.per_point_us / 1e6
+
+    disabled = run("persistence disabled", args.messages, None)
+
+    sync_client = SimulatedInfluxClient(rtt, per_point)
+    sync_messages = max(1, args.messages // 20)  # Per-message writes are too slow to run in full
+    run("per-message write_points()", sync_messages,
+        lambda topic, value: sync_client.write_points([{"measurement": topic, "fields": {"value": value}}]))
+
+    config.INFLUX_SPILL_PATH = None
+    batched_client = SimulatedInfluxClient(rtt, per_point)
+    writer = InfluxBatchWriter(batched_client, config.INFLUXDB_DATABASE)
+    writer.start()
+
+    def drain():
+        while batched_client.points < args.messages:
+            time.sleep(0.001)
+
+    batched = run("InfluxBatchWriter", args.messages, writer.write, drain)
+    writer.stop()
+    print(f"batched ingest reaches {batched / disabled:.0%} of the no-persistence rate")
+
+
+if __name__ == "__main__":
+    main()
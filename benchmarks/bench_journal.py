@@ -0,0 +1,85 @@
+"""Durable ingest rate of the write-ahead journal against one fsync per message.
+
+--threads producers append --messages each to a MessageJournal in a temporary
+directory; a message counts once its on_durable callback has fired, i.e. once the
+group commit that covers it has been fsynced. The baseline writes and fsyncs every
+message on its own, which is what a naive journal does.
+
+Run from the repository root:
+    python -m benchmarks.bench_journal [--threads 4] [--messages 20000] [--payload 64]
+        [--intervals-ms 1,5,20] [--dir /tmp]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from message_journal import MessageJournal
+
+
+def fsync_each(directory, messages, payload):
+    path = os.path.join(directory, "naive.log")
+    start = time.perf_counter()
+    with open(path, "ab") as f:
+        for _ in range(messages):
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+    return messages / (time.perf_counter() - start)
+
+
+def group_commit(directory, threads, messages, payload, interval):
+    journal = MessageJournal(directory, 64 * 1024 * 1024, 1024 * 1024 * 1024, interval, 2000)
+    journal.recover(lambda *message: None)
+    journal.start()
+    total = threads * messages
+    durable = []  # list.append is atomic; one entry per durable message
+    done = threading.Event()
+
+    def on_durable():
+        durable.append(1)
+        if len(durable) == total:
+            done.set()
+
+    def produce(index):
+        topic = f"bench/{index}".encode('utf-8')
+        for _ in range(messages):
+            journal.append(topic, payload, 1, False, on_durable)
+
+    start = time.perf_counter()
+    producers = [threading.Thread(target=produce, args=(i,)) for i in range(threads)]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    done.wait(60)
+    elapsed = time.perf_counter() - start
+    commits = journal.stats()["commits"]
+    journal.close()
+    return len(durable) / elapsed, commits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per producer thread")
+    parser.add_argument("--payload", type=int, default=64)
+    parser.add_argument("--intervals-ms", default="1,5,20", help="Group commit intervals to compare")
+    parser.add_argument("--baseline-messages", type=int, default=500, help="Messages for the fsync-per-message run")
+    parser.add_argument("--dir", default=None, help="Directory on the disk to measure (default: system temp)")
+    args = parser.parse_args()
+
+    payload = b"x" * args.payload
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        rate = fsync_each(directory, args.baseline_messages, payload)
+        print(f"{'mode':<24} {'durable msgs/s':>15} {'fsyncs':>8}")
+        print(f"{'fsync per message':<24} {rate:>15,.0f} {args.baseline_messages:>8}")
+        for interval_ms in (float(value) for value in args.intervals_ms.split(",")):
+            with tempfile.TemporaryDirectory(dir=directory) as journal_dir:
+                rate, commits = group_commit(journal_dir, args.threads, args.messages, payload, interval_ms / 1000)
+            print(f"{f'group commit {interval_ms:g} ms':<24} {rate:>15,.0f} {commits:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Acknowledged QoS 1 throughput against the in-flight window size.
+
+One publisher sends --messages QoS 1 messages to a broker running in-process; one
+QoS 1 subscriber acknowledges every PUBLISH with PUBACK after --rtt-ms, which stands
+in for the network round trip to a real device. With a window of 1 every message
+costs a full round trip; larger windows keep the pipe full. Throughput counts
+messages the subscriber has received and acknowledged.
+
+Run from the repository root:
+    python -m benchmarks.bench_qos_window [--server PureMQTT:MQTTServer]
+        [--windows 1,2,4,8,16,32,64] [--messages 2000] [--rtt-ms 2]
+"""
+import argparse
+import heapq
+import importlib
+import struct
+import tempfile
+import threading
+import time
+
+import config
+from benchmarks.bench_broker import open_client, store_overrides, subscribe, wait_for_port
+
+
+class AckingSubscriber(threading.Thread):
+    """Reads QoS 1 PUBLISH packets and sends each PUBACK once the simulated RTT has passed."""
+
+    def __init__(self, sock, framer, expected, rtt):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.framer = framer
+        self.expected = expected
+        self.rtt = rtt
+        self.acked = 0
+        self.duplicates = 0
+
+    def run(self):
+        due = []  # Heap of (ack_time, packet_id)
+        self.sock.settimeout(0.0002)
+        while self.acked < self.expected:
+            now = time.perf_counter()
+            while due and due[0][0] <= now:
+                _, packet_id = heapq.heappop(due)
+                self.sock.sendall(struct.pack("!BBH", 0x40, 2, packet_id))
+                self.acked += 1
+            try:
+                if self.framer.recv_into(self.sock) == 0:
+                    return
+            except TimeoutError:
+                continue
+            for header, body in self.framer.packets():
+                if header >> 4 != 3:
+                    continue
+                if header & 0x08:
+                    self.duplicates += 1  # Retransmission; the original is already being acknowledged
+                    continue
+                topic_length = struct.unpack_from("!H", body)[0]
+                packet_id = struct.unpack_from("!H", body, 2 + topic_length)[0]
+                heapq.heappush(due, (time.perf_counter() + self.rtt, packet_id))
+
+
+def publish_all(sock, framer, topic, messages):
+    topic_bytes = topic.encode('utf-8')
+    frames = []
+    for i in range(messages):
+        packet_id = i % 65535 + 1
+        body = struct.pack("!H", len(topic_bytes)) + topic_bytes + struct.pack("!H", packet_id) + b"%08d" % i
+        frames.append(bytes([0x32, len(body)]) + body)
+    sock.sendall(b"".join(frames))
+    pubacks = 0
+    while pubacks < messages:  # The broker acknowledges each QoS 1 publish
+        if framer.recv_into(sock) == 0:
+            return
+        pubacks += sum(1 for header, _ in framer.packets() if header >> 4 == 4)
+
+
+def run(port, window, messages, rtt):
+    config.QOS1_MAX_INFLIGHT = window  # Read when the subscriber's session is created
+    config.QOS1_MAX_PENDING = messages  # Measure the window, not the overflow policy
+    sub, sub_framer = open_client("127.0.0.1", port, f"bench-sub-{window}")
+    subscribe(sub, sub_framer, "bench/qos1", qos=1)
+    pub, pub_framer = open_client("127.0.0.1", port, f"bench-pub-{window}")
+
+    subscriber = AckingSubscriber(sub, sub_framer, messages, rtt)
+    subscriber.start()
+    start = time.perf_counter()
+    publisher = threading.Thread(target=publish_all, args=(pub, pub_framer, "bench/qos1", messages), daemon=True)
+    publisher.start()
+    subscriber.join()
+    elapsed = time.perf_counter() - start
+    publisher.join()
+    sub.close()
+    pub.close()
+    return subscriber.acked / elapsed, subscriber.duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default="PureMQTT:MQTTServer", help="module:Class of the broker")
+    parser.add_argument("--port", type=int, default=18831)
+    parser.add_argument("--windows", default="1,2,4,8,16,32,64")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="Delay before the subscriber sends PUBACK")
+    args = parser.parse_args()
+
+    config.MQTT_HOST, config.MQTT_PORT = "127.0.0.1", args.port
+    module_name, class_name = args.server.split(":")
+    with tempfile.TemporaryDirectory() as directory:
+        config.__dict__.update(store_overrides(directory))
+        broker = getattr(importlib.import_module(module_name), class_name)(sinks=[])
+        threading.Thread(target=broker.start, daemon=True).start()
+        wait_for_port("127.0.0.1", args.port)
+
+        print(f"{args.server}: {args.messages} QoS 1 messages, PUBACK after {args.rtt_ms} ms")
+        print(f"{'window':>8} {'acked msgs/s':>14} {'retransmits':>12}")
+        for window in (int(w) for w in args.windows.split(",")):
+            rate, duplicates = run(args.port, window, args.messages, args.rtt_ms / 1000)
+            print(f"{window:>8} {rate:>14,.0f} {duplicates:>12}")
+
+
+if __name__ == "__main__":
+    main()
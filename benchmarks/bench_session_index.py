@@ -0,0 +1,61 @@
+"""Cost of opening a persistent session as the number of stored sessions grows.
+
+Opens --sessions clean-session=0 sessions one after another on a SessionStore in a
+temporary directory, each followed by --subscriptions SUBSCRIBEs, as a reconnecting
+fleet of persistent clients does. Every --step sessions it prints the mean time per
+open() and subscribe() call over that step: with the index kept as an append-only
+log, the cost per call should stay flat as the store grows (the occasional rewrite
+of the index is included in the means). It then disconnects and reloads the store
+to check that every session and subscription came back.
+
+Run from the repository root:
+    python -m benchmarks.bench_session_index [--sessions 10000] [--subscriptions 1] [--step 1000] [--dir /tmp]
+"""
+import argparse
+import tempfile
+import time
+
+from session_store import SessionStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--subscriptions", type=int, default=1, help="SUBSCRIBEs per session")
+    parser.add_argument("--step", type=int, default=1000, help="Sessions per printed row")
+    parser.add_argument("--dir", default=None, help="Directory on the disk to measure (default: system temp)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        store = SessionStore(directory, 1024 * 1024, 64 * 1024 * 1024)
+        print(f"{'sessions':>9} {'us per open':>12} {'us per subscribe':>17}")
+        sessions = []
+        for first in range(0, args.sessions, args.step):
+            opened = subscribed = 0.0
+            for index in range(first, min(first + args.step, args.sessions)):
+                owner = object()
+                start = time.perf_counter()
+                session, _ = store.open(f"client-{index}", owner)
+                opened += time.perf_counter() - start
+                start = time.perf_counter()
+                for k in range(args.subscriptions):
+                    store.subscribe(session, f"devices/{index}/commands/{k}", 1)
+                subscribed += time.perf_counter() - start
+                sessions.append((session, owner))
+            count = min(first + args.step, args.sessions) - first
+            print(f"{first + count:>9,} {opened / count * 1e6:>12,.1f} "
+                  f"{subscribed / max(count * args.subscriptions, 1) * 1e6:>17,.1f}")
+        for session, owner in sessions:
+            store.go_offline(session, owner)
+        store.close()
+
+        start = time.perf_counter()
+        reloaded = SessionStore(directory, 1024 * 1024, 64 * 1024 * 1024)
+        elapsed = time.perf_counter() - start
+        subscriptions = sum(len(session.subscriptions) for session in reloaded.sessions.values())
+        print(f"reloaded {len(reloaded.sessions):,} sessions with {subscriptions:,} subscriptions in {elapsed:.2f}s")
+        reloaded.close()
+
+
+if __name__ == "__main__":
+    main()
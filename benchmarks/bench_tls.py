@@ -0,0 +1,163 @@
+"""TLS handshakes per second on TLS_PORT, full and resumed, and what a handshake storm does to delivery.
+
+Creates a self-signed certificate with the openssl command line tool (--key ec for
+P-256, rsa for RSA 2048) and starts the broker in its own process with TLS_PORT
+set. --clients threads then connect over TLS, send CONNECT, wait for CONNACK and
+disconnect, over and over for --seconds:
+
+    full      no session offered: certificate exchange and key agreement every time
+    resumed   each client offers the session ticket from its previous connection
+
+Then a plain-TCP publisher sends --rate messages/s to a plain subscriber three
+times: idle, during a storm of plain connections, and during a storm of full TLS
+handshakes. The handshakes run off the serving path, so the TLS storm should cost
+deliveries about what the plain one does. The clients share the machine with the
+broker, so handshakes/s is a lower bound of what the broker can do; the broker's
+CPU time per handshake is the figure to compare between runs. With an EC key and
+TLS 1.3 a resumed handshake still does a key exchange, so try --key rsa or --tls12
+to see what resumption saves.
+
+Run from the repository root:
+    python -m benchmarks.bench_tls [--server mqtt_server:MQTTServer] [--key ec|rsa]
+        [--clients 8] [--seconds 5] [--rate 1000] [--tls12]
+"""
+import argparse
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from benchmarks.bench_broker import (TIMESTAMP_DIGITS, SubscriberPool, mqtt_string, open_client, packet, percentile,
+                                     publisher, subscribe)
+from benchmarks.bench_cluster import cpu_seconds
+from benchmarks.bench_connect_storm import start_broker
+
+KEY_OPTIONS = {"ec": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256"], "rsa": ["-newkey", "rsa:2048"]}
+
+
+def make_certificate(directory, key):
+    certfile, keyfile = os.path.join(directory, "server.crt"), os.path.join(directory, "server.key")
+    subprocess.run(["openssl", "req", "-x509", *KEY_OPTIONS[key], "-nodes", "-keyout", keyfile, "-out", certfile,
+                    "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1"],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def handshake_loop(context, port, name, resume, deadline, results):
+    """Connects until the deadline, over TLS unless context is None; appends (connections, resumed) to results."""
+    connect = packet(0x10, mqtt_string("MQTT") + bytes([4, 0x02]) + struct.pack("!H", 60) + mqtt_string(name))
+    session = None
+    handshakes = resumed = 0
+    while time.perf_counter() < deadline:
+        raw = socket.create_connection(("127.0.0.1", port))
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock = context.wrap_socket(raw, server_hostname="127.0.0.1", session=session) if context else raw
+            sock.sendall(connect)
+            if sock.recv(4)[:1] != b"\x20":
+                raise ConnectionError("no CONNACK")
+        except OSError as e:
+            print(f"{name}: {e}")
+            raw.close()
+            continue
+        handshakes += 1
+        if context:
+            resumed += sock.session_reused
+            if resume:
+                session = sock.session  # The TLS 1.3 ticket arrives with the first records after the handshake
+        sock.close()
+    results.append((handshakes, resumed))
+
+
+def storm(args, port, resume, seconds, tls=True):
+    context = None
+    if tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.load_verify_locations(args.certfile)
+        if args.tls12:
+            context.maximum_version = ssl.TLSVersion.TLSv1_2
+    results = []
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=handshake_loop, args=(context, port, f"tls-{i}", resume, deadline, results))
+               for i in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return sum(h for h, _ in results), sum(r for _, r in results), elapsed
+
+
+def delivery_latency(args, port, during=None):
+    """Publishes at --rate for --seconds over plain TCP, optionally while `during` runs; returns latencies in us."""
+    sub, framer = open_client("127.0.0.1", port, f"latency-sub-{time.perf_counter_ns()}")
+    subscribe(sub, framer, "bench/latency")
+    pub, _ = open_client("127.0.0.1", port, f"latency-pub-{time.perf_counter_ns()}")
+    pool = SubscriberPool([(sub, framer)])
+    pool.start()
+    start_event = threading.Event()
+    count = int(args.rate * args.seconds)
+    sender = threading.Thread(target=publisher, args=(pub, ["bench/latency"], count, TIMESTAMP_DIGITS,
+                                                      args.rate, start_event))
+    sender.start()
+    start_event.set()
+    result = during() if during is not None else None
+    sender.join()
+    time.sleep(0.5)
+    pool.running = False
+    pub.close()
+    sub.close()
+    latencies = sorted(ns / 1000 for ns in pool.latencies_ns)
+    return latencies, count, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default="mqtt_server:MQTTServer", help="module:Class")
+    parser.add_argument("--port", type=int, default=18870, help="MQTT_PORT; TLS_PORT is the next one")
+    parser.add_argument("--key", choices=KEY_OPTIONS, default="ec", help="Certificate key type")
+    parser.add_argument("--clients", type=int, default=8, help="Client threads doing handshakes")
+    parser.add_argument("--seconds", type=float, default=5, help="Duration of each run")
+    parser.add_argument("--rate", type=float, default=1000, help="Plain messages/s for the latency probe")
+    parser.add_argument("--handshake-threads", type=int, default=4, help="TLS_HANDSHAKE_THREADS")
+    parser.add_argument("--tls12", action="store_true", help="Clients stop at TLS 1.2")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        args.certfile, keyfile = make_certificate(directory, args.key)
+        tls_port = args.port + 1
+        broker = start_broker(args.server, args.port, {
+            "TLS_PORT": tls_port, "TLS_CERTFILE": args.certfile, "TLS_KEYFILE": keyfile,
+            "TLS_HANDSHAKE_THREADS": args.handshake_threads, "CONNECT_RATE": None, "MAX_CONNECTIONS": None,
+        }, directory)
+        try:
+            print(f"{args.server}: {args.key} certificate, {args.clients} client threads, "
+                  f"{args.handshake_threads} handshake threads, {'TLS 1.2' if args.tls12 else 'TLS 1.3'}")
+            for name, resume in (("full", False), ("resumed", True)):
+                cpu_before = cpu_seconds(broker.pid)
+                handshakes, resumed, elapsed = storm(args, tls_port, resume, args.seconds)
+                cpu = cpu_seconds(broker.pid) - cpu_before
+                print(f"{name:<8} {handshakes / elapsed:>8,.0f} handshakes/s  {cpu / max(handshakes, 1) * 1e6:>6,.0f} us "
+                      f"broker CPU each  ({handshakes:,} in {elapsed:.1f}s, {resumed:,} resumed)")
+
+            idle, expected, _ = delivery_latency(args, args.port)
+            rows = [("idle", idle, "")]
+            for name, port, tls in (("plain", args.port, False), ("tls", tls_port, True)):
+                latencies, _, (connections, _, elapsed) = delivery_latency(
+                    args, args.port, lambda: storm(args, port, False, args.seconds, tls))
+                rows.append((name, latencies, f"  (during {connections / elapsed:,.0f} {name} connections/s)"))
+            for name, latencies, note in rows:
+                print(f"latency {name:<6} p50 {percentile(latencies, 0.5):,.0f} us  p99 {percentile(latencies, 0.99):,.0f} us"
+                      f"  max {latencies[-1]:,.0f} us  {len(latencies):,} of {expected:,} delivered{note}")
+        finally:
+            broker.terminate()
+            broker.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Micro-benchmark for topic_trie.SubscriptionIndex at 100k filters.
+
+Run from the repository root:
+    python -m benchmarks.bench_topic_trie [--filters 100000] [--clients 10000]
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+
+from topic_trie import SubscriptionIndex, topic_matches
+
+
+def make_filters(count, sites):
+    filters = []
+    for i in range(count):
+        site = f"site{i % sites}"
+        kind = i % 10
+        if kind == 0:
+            filters.append(f"{site}/+/temperature")
+        elif kind == 1:
+            filters.append(f"{site}/dev{i}/#")
+        else:
+            filters.append(f"{site}/dev{i}/temperature")
+    return filters
+
+
+def timed(label, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<45} {repeat / elapsed:>14,.0f} ops/s  ({elapsed / repeat * 1e6:,.2f} us/op)")
+    return elapsed / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filters", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--sites", type=int, default=997)  # Coprime with --clients keeps filters distinct
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    filters = make_filters(args.filters, args.sites)
+    owners = [f"client{i % args.clients}" for i in range(args.filters)]
+
+    index = SubscriptionIndex()
+    start = time.perf_counter()
+    for client, topic_filter in zip(owners, filters):
+        index.subscribe(client, topic_filter)
+    print(f"Built index with {len(index):,} filters for {args.clients:,} clients in {time.perf_counter() - start:.2f}s")
+
+    topics = [f"site{rng.randrange(args.sites)}/dev{rng.randrange(args.filters)}/temperature"
+              for _ in range(1024)]
+    topic_iter = iter(topics * (args.lookups // len(topics) + 1))
+    timed("trie match()", lambda: index.match(next(topic_iter)), args.lookups)
+
+    # Baseline: wildcard matching by scanning every filter, as a flat dict would require
+    scan_topics = iter(topics)
+
+    def linear_scan():
+        topic = next(scan_topics)
+        return [f for f in filters if topic_matches(f, topic)]
+
+    timed("linear scan over all filters", linear_scan, 20)
+
+    # Disconnect cost: reverse index vs walking every topic of the old defaultdict(set)
+    old_topics = defaultdict(set)
+    for client, topic_filter in zip(owners, filters):
+        old_topics[topic_filter].add(client)
+
+    victims = iter(f"client{i}" for i in range(args.clients))
+
+    def old_remove():
+        client = next(victims)
+        for topic in old_topics:
+            if client in old_topics[topic]:
+                old_topics[topic].remove(client)
+
+    timed("disconnect: walk every topic (old)", old_remove, 50)
+    victims = iter(f"client{i}" for i in range(args.clients))
+    timed("disconnect: reverse index remove_client()", lambda: index.remove_client(next(victims)), 5000)
+
+
+if __name__ == "__main__":
+    main()
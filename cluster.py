@@ -0,0 +1,129 @@
+"""Runs the broker as one node of a cluster, so clients on any node reach subscribers on all of them.
+
+    python cluster.py
+
+Every node lists the others in CLUSTER_PEERS and links with each of them over TCP
+(CLUSTER_PORT). The links work like the worker bus (see worker_pool.py): nodes tell
+each other which topic filters their clients subscribe to, and a PUBLISH is only
+sent to the nodes that have a matching subscriber. Each node is a single broker
+process; SERVER_MODE picks threaded or async.
+"""
+import socket
+import threading
+import time
+import config
+from mqtt_logging import get_logger, setup_logging
+from mqtt_server import AsyncMQTTServer, MQTTServer
+from worker_pool import BUS_SYNC, BusPeer, LinkRefused, PeerBus, bus_frame
+
+log = get_logger('bus')
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host.strip('[]'), int(port)
+
+
+class ClusterBus(PeerBus):
+    """Links this node with the other cluster nodes over TCP.
+
+    Since every node is linked with every other one, a message received from a node is
+    delivered to local subscribers only and never forwarded again: it crosses one
+    link at most and cannot loop. For the same reason there is one link per pair of
+    nodes. When both dial each other, both keep the link opened by the node with the
+    smaller ID, and the other dialer waits until that link drops. A node that
+    redials over a link still up (it restarted before the old link timed out)
+    replaces it, and a node listed in its own CLUSTER_PEERS refuses the link to itself.
+
+    On every link-up the two nodes ask each other for their retained messages and each
+    keeps the topics it lacks, so a node that joins or rejoins gets what was retained
+    while it was away. A topic both nodes hold keeps the local value (retained messages
+    carry no timestamp to pick the newer one), and a retained message cleared on one
+    node while the other was away comes back from the other.
+
+    Peer links batch their writes: the writer waits CLUSTER_BATCH_DELAY for more
+    messages before each send, and TCP_NODELAY then sends every batch at once.
+    """
+
+    def __init__(self, server, node_id=None, peers=None):
+        node_id = node_id or config.CLUSTER_NODE_ID or f"{socket.gethostname()}:{config.CLUSTER_PORT}"
+        super().__init__(server, node_id)
+        self.addresses = [parse_address(address) for address in (config.CLUSTER_PEERS if peers is None else peers)]
+
+    def start(self):
+        self.server.topics.listener = self
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((config.CLUSTER_HOST, config.CLUSTER_PORT))
+        listener.listen(max(16, len(self.addresses)))
+        threading.Thread(target=self.accept_loop, args=(listener,), daemon=True).start()
+        for address in self.addresses:
+            threading.Thread(target=self.connect_loop, args=(address,), daemon=True).start()
+        log.info("[BUS] Cluster node %s on port %s, peers: %s", self.name, config.CLUSTER_PORT,
+                 ", ".join(config.CLUSTER_PEERS) or "none")
+
+    def connect_loop(self, address):
+        delay = 0.1
+        name = None  # The node at this address, once it has said hello
+        while not self.closing:
+            if name is not None and name in self.peers:
+                time.sleep(1)  # Linked through the connection that node opened
+                continue
+            try:
+                sock = socket.create_connection(address, timeout=5)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+            sock.settimeout(None)
+            delay = 0.1
+            name = self.serve_peer(sock, dialed=True) or name  # Returns once the link drops or is refused
+            if name == self.name:
+                return  # This node's own address
+
+    def hello(self):
+        return self.name.encode('utf-8')
+
+    def create_peer(self, hello, sock, dialed):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Writes are already batched
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # Notices a node that vanished
+        return BusPeer(str(hello, 'utf-8'), sock, dialed, config.CLUSTER_QUEUE_SIZE, config.CLUSTER_BATCH_DELAY)
+
+    def add_peer(self, peer):
+        peer = super().add_peer(peer)
+        peer.send(bus_frame(BUS_SYNC, b""), force=True)  # Its answer fills in the retained topics missing here
+        return peer
+
+    def apply_retained(self, topic, payload, qos):
+        self.server.retained.set_missing(topic, payload, qos)  # A retained PUBLISH made here meanwhile wins
+
+    def finish_sync(self, peer):
+        log.info("[BUS] %s merged the retained messages of %s, holds %s", self.name, peer.name,
+                 len(self.server.retained))
+
+    def admit(self, peer):
+        if peer.name == self.name:
+            raise LinkRefused(f"{peer.name} is this node; remove it from CLUSTER_PEERS")
+        current = self.peers.get(peer.name)
+        if current is None:
+            return
+        if current.dialed != peer.dialed and not self.preferred(peer):
+            raise LinkRefused(f"already linked with {peer.name}")
+        self.drop(current)  # The preferred link of the two, or a newer one from the same dialer
+
+    def preferred(self, peer):
+        # The link opened by the node with the smaller ID; both ends of a pair agree on it
+        dialer = self.name if peer.dialed else peer.name
+        return dialer == min(self.name, peer.name)
+
+
+def main():
+    setup_logging()
+    server = AsyncMQTTServer() if config.SERVER_MODE == 'async' else MQTTServer()
+    server.bus = ClusterBus(server)
+    server.bus.start()
+    server.start()
+
+
+if __name__ == "__main__":
+    main()
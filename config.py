@@ -3,8 +3,119 @@
 # MQTT Server Configuration
 MQTT_HOST = '0.0.0.0'  # Bind to all IP addresses
 MQTT_PORT = 1883       # MQTT port
+SERVER_MODE = 'threaded'  # 'threaded' (one thread per client) or 'async' (single asyncio event loop)
+FRAMER_BUFFER_SIZE = 1024  # Initial per-connection receive buffer; grows only for larger packets
+MAX_PACKET_SIZE = 268435455  # Largest packet accepted (MQTT protocol maximum)
+
+# TLS listener: MQTT over TLS served by the broker itself, so client addresses are kept
+TLS_PORT = None  # Port for MQTT over TLS, normally 8883; None serves plain MQTT_PORT only
+TLS_CERTFILE = 'certs/server.crt'  # PEM certificate chain
+TLS_KEYFILE = 'certs/server.key'  # PEM private key
+TLS_CAFILE = None  # CA bundle; when set, clients must present a certificate it signed
+TLS_SESSION_TICKETS = 2  # TLS 1.3 session tickets sent after each handshake, for resumption
+TLS_HANDSHAKE_THREADS = 4  # Handshakes in progress at once, on a pool of threads off the serving path
+TLS_HANDSHAKE_NICE = 10  # Nice increment of the handshake threads (Linux), so serving threads preempt them; None disables
+
+# Connection storms: a restarted broker gets the whole fleet reconnecting at once
+LISTEN_BACKLOG = 4096  # Pending connections the kernel queues (capped by net.core.somaxconn)
+ACCEPT_BATCH = 1024  # Most connections accepted per wakeup of the threaded server's listener
+MAX_CONNECTIONS = 100000  # Connections beyond this are closed as soon as they are accepted; None disables
+CONNECT_RATE = 2000  # New connections per second whose CONNECT is processed; the rest wait their turn. None disables
+CONNECT_BURST = 500  # Connections admitted at once before CONNECT_RATE applies
+
+# Logging: messages are formatted lazily on a background thread; kill -USR1 toggles DEBUG
+LOG_LEVEL = 'INFO'  # DEBUG also logs every PUBLISH
+LOG_FORMAT = '%(asctime)s %(message)s'
+LOG_CATEGORY_LEVELS = {}  # Category -> level, e.g. {'publish': 'DEBUG', 'connection': 'WARNING'}
+LOG_SAMPLE_EVERY = {'publish': 100}  # Category -> keep 1 in N records below WARNING
+LOG_RATE_LIMITS = {'connection': 100, 'subscribe': 100, 'publish': 100, 'outbound': 10}  # Category -> records/s
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread; more are dropped
+
+# Outbound delivery: every client gets a bounded queue drained by its own writer
+OUTBOUND_QUEUE_SIZE = 1000  # Packets queued per client before the overflow policy applies
+OUTBOUND_OVERFLOW_POLICY = 'drop_oldest'  # 'drop_oldest', 'drop_newest' or 'disconnect'
+OUTBOUND_TOPIC_POLICIES = {}  # Topic filter -> policy, first match wins, e.g. {'dashboard/#': 'drop_oldest'}
+OUTBOUND_CLIENT_POLICIES = {}  # Client ID -> policy; overrides the topic and default policies
+SHARED_SUBSCRIPTION_POLICY = 'round_robin'  # Which $share/<group>/<filter> member gets a message: 'round_robin' or 'least_queue_depth'
+
+# QoS 1 delivery
+QOS1_MAX_INFLIGHT = 32  # Unacknowledged QoS 1 messages pipelined per subscriber
+QOS1_MAX_PENDING = 1000  # QoS 1 messages waiting for a window slot before the oldest is dropped
+QOS1_RETRY_INTERVAL = 10  # Seconds before an unacknowledged message is resent with DUP set
+TIMER_WHEEL_TICK = 0.1  # Resolution in seconds of the timer wheel shared by all connections
+TIMER_WHEEL_SLOTS = 512  # Slots per rotation
+CONNECT_TIMEOUT = 10  # Seconds a new connection may take to send CONNECT; afterwards 1.5x its keep-alive applies
+
+# Retained messages
+RETAINED_MAX_BYTES = 64 * 1024 * 1024  # Topic and payload bytes held; new retained messages are refused beyond this (None = no cap)
+RETAINED_STORE_PATH = None  # Append-only file replayed at startup, e.g. 'retained.log'; None keeps retained messages in memory only
+
+# Persistent sessions (CONNECT with clean-session=0)
+SESSION_STORE_DIR = None  # Memory-mapped message log and session index, e.g. 'sessions'; None treats every client as clean-session=1
+SESSION_SEGMENT_BYTES = 16 * 1024 * 1024  # Size of each log segment file
+SESSION_MAX_LOG_BYTES = 1024 * 1024 * 1024  # Beyond this the oldest segment is dropped even if an offline session still needs it
+
+# Message sinks: the journal appends before delivery; the others (InfluxDB) run on their own threads
+SINK_QUEUE_SIZE = 100000  # Messages queued per sink worker
+SINK_QUEUE_BLOCK = 1.0  # Seconds a PUBLISH waits for room in a full queue, its socket unread; then it is dropped for that worker's sinks
+
+# Write-ahead journal: every accepted PUBLISH is on disk before QoS 1/2 publishers get their acknowledgement
+JOURNAL_DIR = None  # Directory for the journal segments, e.g. 'journal'; None disables the journal
+JOURNAL_COMMIT_INTERVAL = 0.005  # Seconds between group commits (one fsync per commit)
+JOURNAL_COMMIT_BATCH = 2000  # Messages that trigger a commit before the interval is up
+JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024  # Segments rotate at this size
+JOURNAL_MAX_BYTES = 1024 * 1024 * 1024  # Oldest segments are deleted beyond this even if not yet checkpointed
+
+# Metrics
+METRICS_HOST = '127.0.0.1'  # Interface for the Prometheus endpoint; local only by default
+METRICS_PORT = 9883  # Serves http://METRICS_HOST:METRICS_PORT/metrics; None disables it
+METRICS_INTERVAL = 10  # Seconds per sample of the rolling load counters, also written to InfluxDB as mqtt_message_count; None disables
+METRICS_HISTORY = 360  # Samples kept in memory for the forecaster
+
+# Autoscaler (python mqtt_server_lstm_autoscaler.py): the forecast resizes a pool of worker processes
+FORECAST_MODEL_PATH = 'mqtt_lstm_model.npz'  # Weights and scaler exported by lstm_model.py (or python lstm_inference.py)
+FORECAST_WORKER_PROCESS = True  # Run inference in a child process instead of on a broker thread
+FORECAST_FEATURES = ('pub_count', 'sub_count')  # Rolling series (mqtt_message_count fields) the model reads; it predicts the first
+FORECAST_WINDOW = 30  # METRICS_INTERVAL samples per input window
+FORECAST_INTERVAL = 10  # Seconds between forecasts; may be shorter than a minute, the input is in memory
+AUTOSCALE_MIN_WORKERS = 1  # The pool starts with and never shrinks below this many worker processes
+AUTOSCALE_MAX_WORKERS = 0  # Largest pool (0 = one worker per CPU core)
+AUTOSCALE_UP_THRESHOLD = 1000  # Predicted PUBLISH per interval per worker above which workers are added
+AUTOSCALE_DOWN_THRESHOLD = 500  # A worker is removed only if the rest would stay below this; the gap prevents flapping
+AUTOSCALE_UP_COOLDOWN = 10  # Seconds after a resize before the pool may grow again; one forecast, to follow a ramp
+AUTOSCALE_DOWN_COOLDOWN = 600  # Seconds after a resize before the pool may shrink; a worker added for a spike outlives it
+AUTOSCALE_DOWN_AFTER = 3  # Consecutive low forecasts needed before shrinking
+AUTOSCALE_LEAD = 2  # Forecasts ahead a steep rise is extrapolated, so workers are started before the load arrives
+AUTOSCALE_DRY_RUN = False  # Only log the resizes; the pool keeps AUTOSCALE_MIN_WORKERS workers
+TRAINING_HISTORY_DAYS = 30  # History lstm_model.py trains on
+TRAINING_CHUNK_HOURS = 6  # History per InfluxDB query while lstm_model.py streams it
+
+# Multi-process mode (python worker_pool.py): workers share the port via SO_REUSEPORT
+WORKER_PROCESSES = 0  # Worker processes to start (0 = one per CPU core)
+BUS_SOCKET_DIR = '/tmp'  # Directory for the Unix sockets that link the workers
+BUS_QUEUE_SIZE = 10000  # Messages queued per peer worker before the oldest are dropped
+BUS_CLAIM_TIMEOUT = 2.0  # Seconds a CONNECT waits for the peers to close the client's connection there
+WORKER_STOP_TIMEOUT = 10  # Seconds a stopping worker gets to disconnect its clients and flush before it is killed
+WORKER_SYNC_TIMEOUT = 5  # Seconds a new worker waits for a peer's retained messages before serving without them
+
+# Cluster mode (python cluster.py): broker nodes forward publishes to each other over TCP
+CLUSTER_NODE_ID = None  # Unique name of this node (None = <hostname>:<CLUSTER_PORT>)
+CLUSTER_HOST = '0.0.0.0'  # Interface the cluster listener binds to
+CLUSTER_PORT = 18830  # Port the other nodes dial to link with this one
+CLUSTER_PEERS = []  # 'host:port' of every other node; each node links directly with all the others
+CLUSTER_QUEUE_SIZE = 100000  # Messages queued per peer node before the oldest are dropped
+CLUSTER_BATCH_DELAY = 0.001  # Seconds a peer link waits to gather more messages into one write
 
 # InfluxDB Configuration
 INFLUXDB_HOST = 'localhost'
 INFLUXDB_PORT = 8086
 INFLUXDB_DATABASE = 'mqtt_data'
+INFLUX_BATCH_SIZE = 5000  # Points per write request
+INFLUX_FLUSH_INTERVAL = 1.0  # Seconds a point may wait before a partial batch is written
+INFLUX_MAX_BUFFERED_POINTS = 100000  # In-memory bound; older points spill to disk beyond this
+INFLUX_SPILL_PATH = 'influx_spill.lp'  # Spill file (line protocol); None drops points instead
+INFLUX_SPILL_MAX_BYTES = 512 * 1024 * 1024  # Points are dropped once the spill file reaches this size
+INFLUX_RETRY_BASE_DELAY = 0.5  # First retry delay in seconds, doubled after every failure
+INFLUX_RETRY_MAX_DELAY = 30  # Upper bound for the retry delay
+INFLUX_BREAKER_THRESHOLD = 5  # Consecutive failures before writes are suspended
+INFLUX_BREAKER_RESET_TIMEOUT = 30  # Seconds before a suspended writer tries again
@@ -0,0 +1,380 @@
+import base64
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+from operator import itemgetter
+
+import config
+import metrics
+from message_sinks import MessageSink
+from mqtt_logging import get_logger
+
+# Circuit breaker states
+CLOSED = 'closed'  # Writes flow normally
+OPEN = 'open'  # InfluxDB is considered down; no writes are attempted
+HALF_OPEN = 'half_open'  # One trial write decides whether to close again
+
+log = get_logger('influx')
+
+
+def escape_measurement(name):
+    return name.replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ').replace('\n', '\\n')
+
+
+def escape_string_field(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_line_protocol(measurement, value, timestamp_ns):
+    """Formats one point as InfluxDB line protocol with a string field named 'value'.
+
+    Payloads arrive as bytes and are decoded here, on the writer thread. Anything that
+    is not valid UTF-8 (CBOR, protobuf, packed structs) is stored base64-encoded in a
+    'value_base64' field instead. A dict becomes one numeric field per key.
+    """
+    if isinstance(value, dict):
+        fields = ",".join(f"{key}={field}i" if isinstance(field, int) else f"{key}={field!r}"
+                          for key, field in value.items())
+        return f'{escape_measurement(measurement)} {fields} {timestamp_ns}'
+    if not isinstance(value, str):
+        try:
+            value = str(value, 'utf-8')
+        except UnicodeDecodeError:
+            encoded = base64.b64encode(value).decode('ascii')
+            return f'{escape_measurement(measurement)} value_base64="{encoded}" {timestamp_ns}'
+    return f'{escape_measurement(measurement)} value="{escape_string_field(value)}" {timestamp_ns}'
+
+
+class CircuitBreaker:
+    """Stops write attempts after repeated failures and re-enables them on its own."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def time_until_retry(self):
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        if self.state != CLOSED:
+            log.info("[INFO] InfluxDB reachable again, resuming writes")
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                log.error("[ERROR] InfluxDB circuit open after %s failures, retrying in %ss",
+                          self.failures, self.reset_timeout)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class InfluxBatchWriter:
+    """Queues points and writes them to InfluxDB in line-protocol batches from a background thread.
+
+    write() is a lock-free append of the raw point, so it is safe to call from the
+    socket-reading path; formatting and HTTP happen on the writer thread. Batches are
+    flushed when INFLUX_BATCH_SIZE points are waiting or the oldest one has waited
+    INFLUX_FLUSH_INTERVAL seconds. Failed batches are retried with exponential backoff
+    behind a CircuitBreaker. While InfluxDB is failing, points beyond
+    INFLUX_MAX_BUFFERED_POINTS are spilled to INFLUX_SPILL_PATH and replayed once it
+    is healthy again.
+    """
+
+    def __init__(self, influx_client, database=None):
+        self.client = influx_client
+        self.database = database
+        self.database_ready = database is None
+        self.batch_size = config.INFLUX_BATCH_SIZE
+        self.flush_interval = config.INFLUX_FLUSH_INTERVAL
+        self.max_buffered = config.INFLUX_MAX_BUFFERED_POINTS
+        self.spill_path = config.INFLUX_SPILL_PATH
+        self.spill_max_bytes = config.INFLUX_SPILL_MAX_BYTES
+        self.breaker = CircuitBreaker(config.INFLUX_BREAKER_THRESHOLD, config.INFLUX_BREAKER_RESET_TIMEOUT)
+
+        self.buffer = deque()  # (measurement, value, timestamp_ns); producers only append
+        self.condition = threading.Condition()  # Wakes the writer; never taken by write() on the hot path
+        self.pending_since = None  # When the writer first saw the current partial batch
+        self.retry_delay = 0.0  # Exponential backoff between failed attempts
+        self.last_failure_at = 0.0
+        self.spill_offset = 0  # Bytes of the spill file already replayed
+        self.spill_oldest_ns = None  # Oldest timestamp in the spill file, until it has all been replayed
+        self.spill_newest_ns = 0
+        self.taken_oldest_ns = None  # Oldest timestamp of the points out of the buffer but not yet written
+        self.persisted_ns = 0  # Newest timestamp written to InfluxDB
+        self.running = False
+        self.thread = None
+
+        self.written = 0
+        self.failed_batches = 0
+        self.spilled = 0
+        self.dropped = 0
+
+    def start(self):
+        self.scan_spill()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """Stops the writer after a last flush; whatever cannot be written is spilled."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def write(self, measurement, value, timestamp_ns=None):
+        if isinstance(value, memoryview):
+            value = bytes(value)  # The caller's buffer is reused as soon as we return
+        # deque.append is atomic, so the publishing thread takes no lock here
+        self.buffer.append((measurement, value, timestamp_ns or time.time_ns()))
+        size = len(self.buffer)
+        if size > 2 * self.max_buffered:
+            # The writer has not caught up with spilling; shed the oldest point
+            self.buffer.popleft()
+            self.dropped += 1
+        if size == 1 or size == self.batch_size or size == self.max_buffered + 1:
+            with self.condition:
+                self.condition.notify()
+
+    def persisted_through(self):
+        """Timestamp up to which every point has been written to InfluxDB.
+
+        Nothing older is buffered, in a batch being written or spilled and waiting to be
+        sent again. Scans the buffer, as the mqtt_message_count rows interleave with the
+        messages out of timestamp order.
+        """
+        pending = list(map(itemgetter(2), self.buffer))  # In C, so a producer cannot append mid-iteration
+        pending.extend(timestamp for timestamp in (self.taken_oldest_ns, self.spill_oldest_ns) if timestamp is not None)
+        if pending:
+            return min(pending) - 1
+        return self.persisted_ns
+
+    def stats(self):
+        return {
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "failed_batches": self.failed_batches,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "circuit": self.breaker.state,
+        }
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ready_to_flush():
+                    self.condition.wait(self.wait_time())
+                stopping = not self.running
+
+            if self.healthy():
+                self.flush_once()
+            elif len(self.buffer) > self.max_buffered:
+                # Only spill while InfluxDB is failing; a healthy writer just flushes faster
+                self.spill_overflow(self.max_buffered)
+            if stopping:
+                while self.buffer and self.breaker.allow() and self.flush_once():
+                    pass
+                self.spill_overflow(0)  # Keep unsent points across restarts
+                return
+
+    def healthy(self):
+        return self.breaker.allow() and time.monotonic() >= self.last_failure_at + self.retry_delay
+
+    def ready_to_flush(self):
+        if not self.buffer:
+            self.pending_since = None
+            return self.healthy() and self.spill_pending()
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        if len(self.buffer) > self.max_buffered:
+            return True  # Flush or spill right away
+        if not self.healthy():
+            return False
+        return len(self.buffer) >= self.batch_size or \
+            time.monotonic() - self.pending_since >= self.flush_interval
+
+    def wait_time(self):
+        if not self.breaker.allow():
+            return self.breaker.time_until_retry()
+        backoff = self.last_failure_at + self.retry_delay - time.monotonic()
+        if backoff > 0:
+            return backoff
+        if self.pending_since is not None:
+            return max(0.0, self.flush_interval - (time.monotonic() - self.pending_since))
+        return self.flush_interval
+
+    def take(self, count):
+        # Notes the oldest timestamp first, so persisted_through() never misses the points in between
+        if self.buffer:
+            # map() and islice() run in C, so a producer cannot append mid-iteration
+            self.taken_oldest_ns = min(map(itemgetter(2), islice(self.buffer, count)))
+        points = []
+        try:
+            for _ in range(count):
+                points.append(self.buffer.popleft())
+        except IndexError:
+            pass
+        return points
+
+    def flush_once(self):
+        """Writes one batch from memory (or, when memory is empty, from the spill file).
+
+        Returns True if the batch was written.
+        """
+        points = self.take(self.batch_size)
+        self.pending_since = None
+        if points:
+            lines = [to_line_protocol(*point) for point in points]
+        else:
+            lines, next_offset = self.read_spill()
+            if not lines:
+                return False
+
+        try:
+            if not self.database_ready:
+                self.client.create_database(self.database)  # Create if it doesn't exist
+                self.database_ready = True
+            self.client.write_points(lines, protocol='line')
+        except Exception as e:
+            self.failed_batches += 1
+            self.breaker.record_failure()
+            self.last_failure_at = time.monotonic()
+            self.retry_delay = min(max(self.retry_delay * 2, config.INFLUX_RETRY_BASE_DELAY),
+                                   config.INFLUX_RETRY_MAX_DELAY)
+            log.error("[ERROR] Failed to write %s points to InfluxDB: %s", len(lines), e)
+            if points:
+                self.buffer.extendleft(reversed(points))  # Retry in the original order
+                self.taken_oldest_ns = None
+            return False
+
+        self.written += len(lines)
+        if points:
+            self.persisted_ns = max(self.persisted_ns, max(point[2] for point in points))
+            self.taken_oldest_ns = None
+        self.retry_delay = 0.0
+        self.breaker.record_success()
+        if not points:
+            self.advance_spill(next_offset)
+        return True
+
+    def spill_overflow(self, keep):
+        """Moves the oldest buffered points beyond `keep` to the spill file."""
+        points = self.take(len(self.buffer) - keep)
+        if not points:
+            return
+        try:
+            self.spill(points)
+        finally:
+            self.taken_oldest_ns = None
+
+    def spill(self, points):
+        if not self.spill_path:
+            self.dropped += len(points)
+            return
+        try:
+            size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+            if size >= self.spill_max_bytes:
+                self.dropped += len(points)
+                return
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(to_line_protocol(*point) + '\n' for point in points))
+            self.spilled += len(points)
+            oldest = min(point[2] for point in points)
+            self.spill_oldest_ns = oldest if self.spill_oldest_ns is None else min(self.spill_oldest_ns, oldest)
+            self.spill_newest_ns = max(self.spill_newest_ns, max(point[2] for point in points))
+        except OSError as e:
+            log.error("[ERROR] Failed to spill InfluxDB points to disk: %s", e)
+            self.dropped += len(points)
+
+    def scan_spill(self):
+        # A spill file left by the previous run holds points not yet in InfluxDB
+        if not self.spill_pending():
+            return
+        try:
+            with open(self.spill_path, 'r', encoding='utf-8') as f:
+                timestamps = [int(line.rsplit(' ', 1)[1]) for line in f if line.strip()]
+        except (OSError, ValueError, IndexError) as e:
+            log.error("[ERROR] Failed to read the InfluxDB spill file: %s", e)
+            return
+        if timestamps:
+            self.spill_oldest_ns, self.spill_newest_ns = min(timestamps), max(timestamps)
+
+    def spill_pending(self):
+        return bool(self.spill_path) and os.path.exists(self.spill_path) and \
+            os.path.getsize(self.spill_path) > self.spill_offset
+
+    def read_spill(self):
+        """Returns (lines, next_offset) for the next batch of spilled points."""
+        if not self.spill_pending():
+            return [], self.spill_offset
+        lines = []
+        with open(self.spill_path, 'r', encoding='utf-8') as f:
+            f.seek(self.spill_offset)
+            while len(lines) < self.batch_size:
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line.rstrip('\n'))
+            return lines, f.tell()
+
+    def advance_spill(self, next_offset):
+        self.spill_offset = next_offset
+        if self.spill_offset >= os.path.getsize(self.spill_path):
+            # Everything replayed: start the spill file over
+            os.remove(self.spill_path)
+            self.spill_offset = 0
+            self.persisted_ns = max(self.persisted_ns, self.spill_newest_ns)
+            self.spill_oldest_ns = None
+            self.spill_newest_ns = 0
+
+
+class InfluxSink(MessageSink):
+    """Stores every PUBLISH in InfluxDB, one point per message with the topic as measurement.
+
+    SYNC, because write() only appends to the batch writer's buffer. Given counts (a
+    metrics.RollingCounts), it also writes every sample of them as a mqtt_message_count
+    point, the history the autoscaler's model is trained on.
+    """
+
+    name = 'influx'
+
+    def __init__(self, writer, counts=None):
+        self.writer = writer
+        self.counts = counts
+
+    def write_batch(self, messages):
+        for message in messages:
+            self.writer.write(message.topic, message.payload, message.timestamp_ns)
+
+    def start(self, pipeline):
+        self.writer.start()
+        log.info("[INFO] InfluxDB batch writer started")
+        if self.counts is not None:
+            self.counts.listeners.append(
+                lambda row, timestamp_ns: self.writer.write('mqtt_message_count', row, timestamp_ns))
+
+    def persisted_through(self):
+        return self.writer.persisted_through()
+
+    def stop(self):
+        self.writer.stop()
+
+    def register_metrics(self):
+        metrics.REGISTRY.gauge('mqtt_influx_buffered_points', 'Points waiting for the InfluxDB writer',
+                               lambda: self.writer.stats()['buffered'])
@@ -0,0 +1,198 @@
+"""NumPy inference for the autoscaler's LSTM model.
+
+The broker never imports TensorFlow: lstm_model.py trains the Keras model and exports
+its weights and scaler with export_model() into one .npz file, and NumpyLSTM runs the
+forward pass from that file. ForecastWorker runs it in a separate process.
+
+Export an already trained model:
+    python lstm_inference.py [mqtt_lstm_model.h5] [scaler.pkl] [mqtt_lstm_model.npz]
+"""
+import multiprocessing
+import sys
+
+import numpy as np
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+ACTIVATIONS = {
+    'tanh': np.tanh,
+    'sigmoid': sigmoid,
+    'hard_sigmoid': hard_sigmoid,
+    'relu': lambda x: np.maximum(x, 0.0),
+    'linear': lambda x: x,
+}
+
+
+def activation_name(activation):
+    # Keras stores activations as functions; the exported file only needs the name
+    return activation if isinstance(activation, str) else activation.__name__
+
+
+def export_model(model, scalers, path, features=('pub_count',)):
+    """Writes a Keras Sequential of LSTM layers and one Dense layer, plus its scaling, to path (.npz).
+
+    scalers is one fitted MinMaxScaler per input feature, in input order, or a single
+    one for all of them. features names the mqtt_message_count fields the model reads;
+    it predicts the first one.
+    """
+    arrays = {}
+    lstm_count = 0
+    for layer in model.layers:
+        kind = type(layer).__name__
+        weights = layer.get_weights()
+        if kind == 'LSTM':
+            kernel, recurrent_kernel, bias = weights
+            arrays[f'lstm{lstm_count}_kernel'] = kernel
+            arrays[f'lstm{lstm_count}_recurrent_kernel'] = recurrent_kernel
+            arrays[f'lstm{lstm_count}_bias'] = bias
+            arrays[f'lstm{lstm_count}_activations'] = np.array(
+                [activation_name(layer.activation), activation_name(layer.recurrent_activation)])
+            lstm_count += 1
+        elif kind == 'Dense':
+            arrays['dense_kernel'], arrays['dense_bias'] = weights
+            arrays['dense_activation'] = np.array(activation_name(layer.activation))
+        elif weights:
+            raise ValueError(f"Cannot export layer {layer.name} ({kind})")
+    if not lstm_count or 'dense_kernel' not in arrays:
+        raise ValueError("Expected LSTM layers followed by a Dense layer")
+
+    if not isinstance(scalers, (list, tuple)):
+        scalers = [scalers]
+    arrays['input_min'] = np.concatenate([np.ravel(scaler.min_) for scaler in scalers]).astype(np.float64)
+    arrays['input_scale'] = np.concatenate([np.ravel(scaler.scale_) for scaler in scalers]).astype(np.float64)
+    if len(arrays['input_min']) != arrays['lstm0_kernel'].shape[0] or len(features) != len(arrays['input_min']):
+        raise ValueError("Need one scaler and one feature name per model input")
+    arrays['output_min'] = arrays['input_min'][:1]
+    arrays['output_scale'] = arrays['input_scale'][:1]
+    arrays['features'] = np.array(list(features))
+    arrays['window'] = np.array(model.input_shape[1] or 0)
+    np.savez(path, **arrays)
+
+
+class NumpyLSTM:
+    """Stacked LSTM layers and a Dense output, evaluated with NumPy from an exported file.
+
+    The per-step input projection of each layer is one matrix product over the whole
+    window; only the recurrent part runs step by step. Gate order is Keras's: input,
+    forget, cell, output.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.layers = []
+            index = 0
+            while f'lstm{index}_kernel' in data:
+                activation, recurrent_activation = (str(name) for name in data[f'lstm{index}_activations'])
+                self.layers.append((data[f'lstm{index}_kernel'], data[f'lstm{index}_recurrent_kernel'],
+                                    data[f'lstm{index}_bias'], ACTIVATIONS[activation],
+                                    ACTIVATIONS[recurrent_activation]))
+                index += 1
+            self.dense_kernel = data['dense_kernel']
+            self.dense_bias = data['dense_bias']
+            self.dense_activation = ACTIVATIONS[str(data['dense_activation'])]
+            self.input_min = data['input_min']
+            self.input_scale = data['input_scale']
+            self.output_min = data['output_min']
+            self.output_scale = data['output_scale']
+            self.window = int(data['window'])
+            # Exports from before feature names were stored had a single pub_count input
+            self.features = [str(name) for name in data['features']] if 'features' in data else ['pub_count']
+
+    def predict(self, windows):
+        """Returns the model's (scaled) output for windows shaped (batch, steps, features)."""
+        sequence = np.asarray(windows, dtype=np.float32)
+        for kernel, recurrent_kernel, bias, activation, recurrent_activation in self.layers:
+            batch, steps, _ = sequence.shape
+            units = recurrent_kernel.shape[0]
+            projected = sequence @ kernel + bias  # (batch, steps, 4 * units)
+            h = np.zeros((batch, units), dtype=np.float32)
+            c = np.zeros((batch, units), dtype=np.float32)
+            outputs = np.empty((batch, steps, units), dtype=np.float32)
+            for step in range(steps):
+                z = projected[:, step] + h @ recurrent_kernel
+                i = recurrent_activation(z[:, :units])
+                f = recurrent_activation(z[:, units:2 * units])
+                g = activation(z[:, 2 * units:3 * units])
+                o = recurrent_activation(z[:, 3 * units:])
+                c = f * c + i * g
+                h = o * activation(c)
+                outputs[:, step] = h
+            sequence = outputs
+        # Every LSTM but the last returns sequences; the Dense layer sees the last step
+        return self.dense_activation(sequence[:, -1] @ self.dense_kernel + self.dense_bias)
+
+    def forecast(self, recent):
+        """Predicts the next value from raw recent values shaped (steps,) or (steps, features)."""
+        recent = np.asarray(recent, dtype=np.float64).reshape(len(recent), -1)
+        scaled = recent * self.input_scale + self.input_min  # MinMaxScaler.transform
+        predicted = self.predict(scaled[np.newaxis])[0, 0]
+        return float((predicted - self.output_min[0]) / self.output_scale[0])  # MinMaxScaler.inverse_transform
+
+
+def serve_forecasts(path, connection):
+    # Runs in the worker process: one forecast per window received, until the pipe closes
+    model = NumpyLSTM(path)
+    connection.send((model.window, model.features))
+    while True:
+        try:
+            recent = connection.recv()
+        except EOFError:
+            return
+        try:
+            connection.send(model.forecast(recent))
+        except Exception as e:
+            connection.send(e)
+
+
+class ForecastWorker:
+    """Runs NumpyLSTM in a child process, so inference never holds the broker's GIL.
+
+    The child is spawned rather than forked: forking a process with live serving
+    threads can copy locks in a held state.
+    """
+
+    def __init__(self, path):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve_forecasts, args=(path, child), name='lstm-forecast',
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.window, self.features = self.connection.recv()
+
+    def forecast(self, recent):
+        self.connection.send(np.asarray(recent, dtype=np.float64))
+        result = self.connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        self.connection.close()
+        self.process.join(1)
+
+
+def export_keras(model_path, scaler_path, path):
+    import pickle
+    from tensorflow.keras.models import load_model  # Only the export needs TensorFlow
+
+    with open(scaler_path, "rb") as f:
+        scalers = pickle.load(f)
+    if isinstance(scalers, dict):
+        # {feature: MinMaxScaler} as saved by lstm_model.py
+        export_model(load_model(model_path, compile=False), list(scalers.values()), path, list(scalers))
+    else:
+        export_model(load_model(model_path, compile=False), scalers, path)  # Inference needs no optimizer state
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:] + ["mqtt_lstm_model.h5", "scaler.pkl", "mqtt_lstm_model.npz"][len(sys.argv) - 1:]
+    export_keras(*arguments)
+    print(f"[INFO] Exported {arguments[0]} and {arguments[1]} to {arguments[2]}")
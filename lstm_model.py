@@ -1,55 +1,161 @@
+"""Trains the autoscaler's LSTM on the mqtt_message_count history and exports it for the broker.
+
+The history is streamed from InfluxDB in time-bounded chunks into float32 arrays;
+training windows are strided views of that array, and only one batch at a time is
+copied out. Each feature has its own MinMaxScaler. If a model and its scalers were
+saved before, training continues from them (fine-tuning) instead of starting over.
+
+    python lstm_model.py [--days 30] [--epochs N] [--from-scratch]
+"""
+import argparse
+import math
+import os
+import time
 import numpy as np
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import LSTM, Dense
+from numpy.lib.stride_tricks import sliding_window_view
+from tensorflow.keras.models import Sequential, load_model
+from tensorflow.keras.layers import LSTM, Dense, Input
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.utils import Sequence
 from sklearn.preprocessing import MinMaxScaler
 from influxdb import InfluxDBClient
 import config
 import pickle
+from lstm_inference import export_model
 
-def load_data():
-    # Connect to InfluxDB
-    client = InfluxDBClient(
-        host=config.INFLUXDB_HOST,
-        port=config.INFLUXDB_PORT,
-        database=config.INFLUXDB_DATABASE
-    )
-    # Load historical data
-    results = client.query('SELECT pub_count, sub_count FROM mqtt_message_count')
-    data = list(results.get_points())
+MODEL_PATH = "mqtt_lstm_model.h5"
+SCALER_PATH = "scaler.pkl"  # {feature: MinMaxScaler}, in input order
+
+
+def load_data(client, features, start_ns, end_ns, chunk_ns):
+    """Reads the features of mqtt_message_count between start_ns and end_ns, oldest first.
+
+    One query per chunk_ns of history, so neither InfluxDB nor this process ever holds
+    more than a chunk as parsed JSON. Returns a float32 array shaped (points, features).
+    """
+    fields = ", ".join(features)
+    parts = []
+    for chunk_start in range(start_ns, end_ns, chunk_ns):
+        chunk_end = min(chunk_start + chunk_ns, end_ns)
+        results = client.query(f"SELECT {fields} FROM mqtt_message_count "
+                               f"WHERE time >= {chunk_start} AND time < {chunk_end}")
+        values = np.fromiter((point[feature] or 0 for point in results.get_points() for feature in features),
+                             dtype=np.float32)
+        parts.append(values.reshape(-1, len(features)))
+    return np.concatenate(parts) if parts else np.empty((0, len(features)), dtype=np.float32)
+
+
+def fit_scalers(data, features):
+    # One scaler per feature; the first feature's also turns predictions back into counts
+    return {feature: MinMaxScaler().fit(data[:, [index]]) for index, feature in enumerate(features)}
+
+
+def scale(data, scalers):
+    # MinMaxScaler.transform for every column, written into the array in place
+    for index, scaler in enumerate(scalers.values()):
+        data[:, index] *= scaler.scale_[0]
+        data[:, index] += scaler.min_[0]
     return data
 
-def preprocess_data(data):
-    pub_counts = np.array([point['pub_count'] for point in data])
-    sub_counts = np.array([point['sub_count'] for point in data])
-
-    scaler = MinMaxScaler()
-    pub_counts = scaler.fit_transform(pub_counts.reshape(-1, 1))
-    sub_counts = scaler.fit_transform(sub_counts.reshape(-1, 1))
-    
-    # Save scaler for later use in prediction
-    with open("scaler.pkl", "wb") as f:
-        pickle.dump(scaler, f)
-    
-    # Create sequences for LSTM
-    sequence_length = 30
-    X, y = [], []
-    for i in range(len(pub_counts) - sequence_length):
-        X.append(pub_counts[i:i + sequence_length])
-        y.append(pub_counts[i + sequence_length])
-    return np.array(X), np.array(y)
-
-def build_and_train_model(X, y):
+
+def make_windows(data, window):
+    """Returns (X, y): every window of `window` steps as a view of data, and the next first-feature value."""
+    X = sliding_window_view(data[:-1], window, axis=0).transpose(0, 2, 1)  # (samples, window, features), no copy
+    y = data[window:, :1]
+    return X, y
+
+
+class WindowBatches(Sequence):
+    """Hands Keras shuffled batches of windows; only the batch being trained on is copied."""
+
+    def __init__(self, X, y, batch_size):
+        super().__init__()
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.order = np.random.permutation(len(X))
+
+    def __len__(self):
+        return math.ceil(len(self.X) / self.batch_size)
+
+    def __getitem__(self, index):
+        batch = np.sort(self.order[index * self.batch_size:(index + 1) * self.batch_size])
+        return self.X[batch], self.y[batch]
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.order)
+
+
+def build_model(window, features):
     model = Sequential()
-    model.add(LSTM(50, return_sequences=True, input_shape=(X.shape[1], X.shape[2])))
+    model.add(Input((window, features)))
+    model.add(LSTM(50, return_sequences=True))
     model.add(LSTM(50))
     model.add(Dense(1))
     model.compile(optimizer='adam', loss='mse')
-    model.fit(X, y, epochs=20, batch_size=16)
     return model
 
+
+def load_previous(window, features):
+    """Returns (model, scalers) saved by an earlier run for the same window and features, or None."""
+    if not (os.path.exists(MODEL_PATH) and os.path.exists(SCALER_PATH)):
+        return None
+    with open(SCALER_PATH, "rb") as f:
+        scalers = pickle.load(f)
+    if not isinstance(scalers, dict) or list(scalers) != list(features):
+        return None  # A single scaler from before per-feature scaling, or other features
+    model = load_model(MODEL_PATH, compile=False)
+    if tuple(model.input_shape[1:]) != (window, len(features)):
+        return None
+    # A lower learning rate adjusts the weights to the new data without unlearning the old
+    model.compile(optimizer=Adam(learning_rate=1e-4), loss='mse')
+    return model, scalers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=float, default=config.TRAINING_HISTORY_DAYS, help="History to train on")
+    parser.add_argument("--epochs", type=int, default=None, help="Default: 20 from scratch, 3 when fine-tuning")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--from-scratch", action="store_true", help="Ignore the saved model and scalers")
+    args = parser.parse_args()
+
+    features = list(config.FORECAST_FEATURES)
+    window = config.FORECAST_WINDOW
+    client = InfluxDBClient(
+        host=config.INFLUXDB_HOST,
+        port=config.INFLUXDB_PORT,
+        database=config.INFLUXDB_DATABASE
+    )
+    end_ns = time.time_ns()
+    started = time.perf_counter()
+    data = load_data(client, features, end_ns - int(args.days * 86400e9), end_ns,
+                     int(config.TRAINING_CHUNK_HOURS * 3600e9))
+    print(f"[INFO] Loaded {len(data)} points of {features} in {time.perf_counter() - started:.1f}s")
+    if len(data) <= window:
+        print(f"[ERROR] Need more than {window} points to train")
+        return
+
+    previous = None if args.from_scratch else load_previous(window, features)
+    if previous is None:
+        model, scalers = build_model(window, len(features)), fit_scalers(data, features)
+        epochs = args.epochs or 20
+    else:
+        # The saved scalers are kept: the weights were learned on their scale
+        model, scalers = previous
+        epochs = args.epochs or 3
+        print(f"[INFO] Fine-tuning {MODEL_PATH} for {epochs} epochs")
+
+    X, y = make_windows(scale(data, scalers), window)
+    model.fit(WindowBatches(X, y, args.batch_size), epochs=epochs)
+    model.save(MODEL_PATH)
+    with open(SCALER_PATH, "wb") as f:
+        pickle.dump(scalers, f)
+    print(f"[INFO] Model trained and saved to {MODEL_PATH}")
+    # The broker loads this NumPy export instead of the Keras model
+    export_model(model, list(scalers.values()), config.FORECAST_MODEL_PATH, features)
+    print(f"[INFO] Weights and scalers exported to {config.FORECAST_MODEL_PATH}")
+
+
 if __name__ == "__main__":
-    data = load_data()
-    X, y = preprocess_data(data)
-    model = build_and_train_model(X, y)
-    model.save("mqtt_lstm_model.h5")
-    print("[INFO] Model trained and saved to mqtt_lstm_model.h5")
+    main()
@@ -0,0 +1,322 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+import metrics
+from message_sinks import WRITE_AHEAD, MessageSink, PublishedMessage
+from mqtt_logging import get_logger
+
+log = get_logger('journal')
+
+RECORD_HEADER = struct.Struct("!II")  # Body length, CRC-32 of the body
+RECORD_BODY = struct.Struct("!QqBH")  # Sequence, timestamp in ns, QoS << 1 | retain, topic length
+SEGMENT_SUFFIX = '.wal'
+CHECKPOINT_FILE = 'checkpoint'
+
+
+class JournalSegment:
+    __slots__ = ('path', 'first_seq', 'last_seq', 'last_timestamp', 'size')
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.last_timestamp = 0
+        self.size = 0
+
+
+class MessageJournal:
+    """Write-ahead log of every accepted PUBLISH, made durable by group commit.
+
+    append() only writes into the current segment's buffer; a committer thread flushes
+    and fsyncs whatever has accumulated every `commit_interval` seconds, or sooner
+    once `commit_batch` records are waiting, and then runs their on_durable callbacks
+    (the servers send PUBACK/PUBREC from there). One fsync covers the whole batch.
+
+    Segments rotate at segment_bytes; the committer thread fsyncs and closes the sealed
+    one, so appends never wait for the disk. checkpoint_source(), if set, returns the
+    timestamp up to which downstream sinks have persisted everything; without one (no
+    sink stores messages) the checkpoint is the last durable record. It is saved after
+    each rotation, older segments are deleted, and recover() replays only records newer
+    than it. Records carry a CRC, so a torn write at the end of the log is detected and
+    cut off on startup.
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes, commit_interval, commit_batch):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.checkpoint_source = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.segments = []
+        self.file = None
+        self.sealed = []  # (file, last seq, last timestamp) of rotated segments the committer has yet to fsync and close
+        self.next_seq = 1
+        self.synced_seq = 0  # Every record up to here is on disk
+        self.synced_timestamp = 0  # Timestamp of that record
+        self.waiting = deque()  # (seq, on_durable) for records not yet synced
+        self.unsynced = 0
+        self.running = False
+        self.thread = None
+
+        self.appended = 0
+        self.commits = 0
+        self.recovered = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def recover(self, replay):
+        """Checks every segment and calls replay(topic, payload, qos, retain, timestamp_ns) for
+        records newer than the last checkpoint. Call once, before start()."""
+        checkpoint = self.read_checkpoint()
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for index, name in enumerate(names):
+            segment = JournalSegment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            with open(segment.path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(data):
+                body_length, crc = RECORD_HEADER.unpack_from(data, offset)
+                body = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + body_length]
+                if body_length < RECORD_BODY.size or len(body) < body_length or zlib.crc32(body) != crc:
+                    break
+                seq, timestamp_ns, flags, topic_length = RECORD_BODY.unpack_from(body)
+                if timestamp_ns > checkpoint:
+                    topic = body[RECORD_BODY.size:RECORD_BODY.size + topic_length].decode('utf-8')
+                    replay(topic, body[RECORD_BODY.size + topic_length:], flags >> 1, bool(flags & 0x01), timestamp_ns)
+                    self.recovered += 1
+                segment.last_seq, segment.last_timestamp = seq, timestamp_ns
+                offset += RECORD_HEADER.size + body_length
+            if offset < len(data):
+                log.warning("[JOURNAL] Cut %s bytes of incomplete records from %s", len(data) - offset, name)
+                if index != len(names) - 1:
+                    log.error("[JOURNAL] Corruption before the end of the log in %s", name)
+                with open(segment.path, 'r+b') as f:
+                    f.truncate(offset)
+            segment.size = offset
+            self.segments.append(segment)
+            self.next_seq = max(self.next_seq, segment.last_seq + 1)
+        self.synced_seq = self.next_seq - 1
+        self.synced_timestamp = self.segments[-1].last_timestamp if self.segments else 0
+        if self.recovered:
+            log.info("[JOURNAL] Replayed %s messages written after the last checkpoint", self.recovered)
+
+    def start(self):
+        with self.lock:
+            if self.segments and self.segments[-1].size < self.segment_bytes:
+                self.file = open(self.segments[-1].path, 'ab')
+            else:
+                self.open_segment()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, topic_bytes, payload, qos=0, retain=False, on_durable=None):
+        """Appends one message and returns its timestamp in ns.
+
+        on_durable() is called from the commit thread once the record is on disk.
+        """
+        timestamp_ns = time.time_ns()
+        with self.lock:
+            if self.file is None:
+                return timestamp_ns  # Closed: never durable, so never acknowledged either
+            seq = self.next_seq
+            self.next_seq += 1
+            body = b"".join((RECORD_BODY.pack(seq, timestamp_ns, qos << 1 | retain, len(topic_bytes)),
+                             topic_bytes, payload))
+            record = RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+            segment = self.segments[-1]
+            if segment.size and segment.size + len(record) > self.segment_bytes:
+                self.rotate()
+                segment = self.segments[-1]
+            self.file.write(record)
+            segment.size += len(record)
+            segment.last_seq, segment.last_timestamp = seq, timestamp_ns
+            self.appended += 1
+            self.unsynced += 1
+            if on_durable is not None:
+                self.waiting.append((seq, on_durable))
+            if self.unsynced == self.commit_batch:
+                self.condition.notify()
+        return timestamp_ns
+
+    def run(self):
+        # Commits until close(), then once more for whatever was appended last
+        while True:
+            fd = None
+            with self.lock:
+                if self.running and self.unsynced < self.commit_batch and not self.sealed:
+                    self.condition.wait(self.commit_interval)
+                stopping = not self.running
+                sealed, self.sealed = self.sealed, []
+                if self.unsynced:
+                    self.file.flush()
+                    fd = os.dup(self.file.fileno())  # Synced outside the lock, even if a rotation seals the file meanwhile
+                    seq = self.next_seq - 1
+                    timestamp = self.segments[-1].last_timestamp
+                    self.unsynced = 0
+                elif sealed:
+                    seq, timestamp = sealed[-1][1:]
+                else:
+                    seq, timestamp = self.synced_seq, self.synced_timestamp
+            # Outside the lock: appends keep filling the next batch meanwhile
+            for file, _, _ in sealed:
+                os.fsync(file.fileno())
+                file.close()
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            if fd is not None or sealed:
+                self.commits += 1
+            self.mark_synced(seq, timestamp)
+            if sealed:
+                self.retire()
+            if stopping:
+                return
+
+    def mark_synced(self, seq, timestamp):
+        done = []
+        with self.lock:
+            if seq > self.synced_seq:
+                self.synced_seq, self.synced_timestamp = seq, timestamp
+            while self.waiting and self.waiting[0][0] <= self.synced_seq:
+                done.append(self.waiting.popleft()[1])
+        for on_durable in done:
+            try:
+                on_durable()
+            except Exception as e:
+                log.error("[ERROR] Journal callback failed: %s", e)
+
+    def rotate(self):
+        # Called with the lock held: seals the current segment and starts the next one. The
+        # committer fsyncs and closes the sealed file, then retires what the checkpoint covers
+        self.file.flush()
+        segment = self.segments[-1]
+        self.sealed.append((self.file, segment.last_seq, segment.last_timestamp))
+        self.open_segment()
+        self.unsynced = 0  # Every record so far is in the sealed file
+        self.condition.notify()
+
+    def open_segment(self):
+        segment = JournalSegment(os.path.join(self.directory, f"{self.next_seq:020d}{SEGMENT_SUFFIX}"),
+                                 self.next_seq)
+        self.file = open(segment.path, 'ab')
+        self.segments.append(segment)
+
+    def retire(self):
+        # Runs on the committer thread: saves the checkpoint, then deletes sealed segments it
+        # covers (or that exceed max_bytes)
+        checkpoint = self.save_checkpoint()
+        retired = []
+        with self.lock:
+            total = sum(segment.size for segment in self.segments)
+            while len(self.segments) > 1 and self.segments[0].last_seq <= self.synced_seq:
+                oldest = self.segments[0]
+                if oldest.last_timestamp > checkpoint and total <= self.max_bytes:
+                    break
+                if oldest.last_timestamp > checkpoint:
+                    log.warning("[JOURNAL] Over %s bytes, deleting %s before it was checkpointed",
+                                self.max_bytes, os.path.basename(oldest.path))
+                retired.append(self.segments.pop(0))
+                total -= oldest.size
+        for segment in retired:
+            try:
+                os.remove(segment.path)
+            except OSError as e:
+                log.error("[ERROR] Failed to delete journal segment %s: %s", segment.path, e)
+
+    def save_checkpoint(self):
+        """Advances the checkpoint to what the sinks (or, without any, the journal itself) hold durably."""
+        checkpoint = self.read_checkpoint()
+        durable = self.checkpoint_source() if self.checkpoint_source is not None else self.synced_timestamp
+        if (durable or 0) > checkpoint:
+            checkpoint = durable
+            self.write_checkpoint(checkpoint)
+        return checkpoint
+
+    def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def write_checkpoint(self, timestamp_ns):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(str(timestamp_ns))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            log.error("[ERROR] Failed to write the journal checkpoint: %s", e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "appended": self.appended,
+                "commits": self.commits,
+                "unsynced": self.unsynced,
+                "segments": len(self.segments),
+                "bytes": sum(segment.size for segment in self.segments),
+                "recovered": self.recovered,
+            }
+
+    def close(self):
+        """Commits what is buffered, stops the commit thread and closes the segment."""
+        with self.lock:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()  # Its last pass commits what was appended before running was cleared
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        self.save_checkpoint()
+
+
+class JournalSink(MessageSink):
+    """Journals every accepted PUBLISH; the publisher's acknowledgement goes out from the group commit.
+
+    WRITE_AHEAD: append() only buffers, so it runs on the accepting thread before the
+    message is delivered. The timestamp it stamps on each message is the one InfluxDB
+    stores, which is what makes a replayed message a no-op there.
+    """
+
+    name = 'journal'
+    execution = WRITE_AHEAD
+    holds_acks = True
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def write_batch(self, messages):
+        for message in messages:
+            message.timestamp_ns = self.journal.append(message.topic_bytes, message.payload, message.qos,
+                                                       message.retain, message.on_durable)
+
+    def recover(self, replay):
+        self.journal.recover(lambda topic, payload, qos, retain, timestamp_ns: replay(
+            PublishedMessage(topic, topic.encode('utf-8'), payload, qos, retain, timestamp_ns)))
+
+    def start(self, pipeline):
+        if pipeline.persisted_through() is not None:
+            # Segments are kept until every storing sink (InfluxDB or its spill file) has everything in them
+            self.journal.checkpoint_source = pipeline.persisted_through
+        self.journal.start()
+
+    def stop(self):
+        self.journal.close()
+
+    def register_metrics(self):
+        metrics.REGISTRY.counter_function('mqtt_journal_commits_total', 'Group commits (fsyncs) of the message journal',
+                                          lambda: self.journal.stats()['commits'])
@@ -0,0 +1,247 @@
+import threading
+import time
+from collections import deque
+
+import metrics
+from mqtt_logging import get_logger
+
+log = get_logger('sinks')
+
+# How a sink is executed
+# Called on the thread that accepted the PUBLISH, before it is delivered to anyone: only for
+# a sink that is as cheap as a buffer append (the journal), and the only kind that may hold acks
+WRITE_AHEAD = 'write_ahead'
+SYNC = 'sync'  # Called in registration order on the pipeline thread shared by every SYNC sink
+ASYNC = 'async'  # Gets a thread of its own, so a slow sink never holds up the others
+
+
+class PublishedMessage:
+    """One accepted PUBLISH as handed to the sinks; topic and payload are private copies."""
+
+    __slots__ = ('topic', 'topic_bytes', 'payload', 'qos', 'retain', 'timestamp_ns', 'on_durable')
+
+    def __init__(self, topic, topic_bytes, payload, qos=0, retain=False, timestamp_ns=None, on_durable=None):
+        self.topic = topic
+        self.topic_bytes = topic_bytes
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp_ns = timestamp_ns  # Set by the first sink that stamps it (the journal), else None
+        self.on_durable = on_durable  # Sends the publisher's PUBACK/PUBREC; only for sinks that hold acks
+
+
+class MessageSink:
+    """Base class for storage and analytics hooks on the PUBLISH path.
+
+    execution is WRITE_AHEAD, SYNC or ASYNC. SYNC sinks must not block: appending to a
+    buffer another thread drains (InfluxBatchWriter, the journal's group commit) is what
+    they are for. batch_size is the largest batch write_batch() gets; an ASYNC sink also
+    waits up to batch_interval seconds for a batch to fill. A sink with holds_acks set
+    sends the QoS 1/2 acknowledgement itself, through each message's on_durable; it must
+    be WRITE_AHEAD, so that a message it is to acknowledge is never shed from a queue.
+    """
+
+    name = 'sink'
+    execution = SYNC
+    batch_size = 1000
+    batch_interval = 0.0
+    holds_acks = False
+
+    def write_batch(self, messages):
+        raise NotImplementedError
+
+    def recover(self, replay):
+        """Called once before start(); may call replay(message) for messages to re-deliver to the other sinks."""
+
+    def start(self, pipeline):
+        pass
+
+    def persisted_through(self):
+        """Timestamp up to which this sink has everything on durable storage, or None if it keeps nothing."""
+        return None
+
+    def stop(self):
+        """Called once the pipeline has handed the sink its last batch; flushes whatever the sink buffers."""
+
+    def register_metrics(self):
+        pass
+
+
+class SinkWorker:
+    """A queue of messages drained in batches by one thread into one or more sinks.
+
+    When the queue is full, put() holds the producer for up to block_timeout seconds
+    until the thread has taken a batch: the socket it reads from is not read meanwhile,
+    so the publisher is slowed down to what the sinks can take. A message still without
+    room is dropped for these sinks and counted. It has already been journaled and
+    acknowledged (see WRITE_AHEAD), so only what the queued sinks store is missing.
+    """
+
+    def __init__(self, name, sinks, batch_size, batch_interval, max_queued, block_timeout=0.0):
+        self.name = name
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_queued = max_queued
+        self.block_timeout = block_timeout
+        self.queue = deque()  # Producers only append; taken from by the worker thread alone
+        # Wakes the worker; producers only take it when the queue was empty or is full
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = None
+        self.waiting = 0  # Producers held in put() for room
+        self.processed = 0
+        self.waits = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"sink-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout):
+        """Lets the thread write out what is queued, then end; waits up to timeout seconds for it."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def put(self, message):
+        if len(self.queue) >= self.max_queued and not self.wait_for_room():
+            # The sink still cannot keep up; shed the newest rather than grow without bound
+            self.dropped += 1
+            return
+        self.queue.append(message)
+        if len(self.queue) == 1 or len(self.queue) == self.batch_size:
+            with self.condition:
+                self.condition.notify()
+
+    def wait_for_room(self):
+        if not self.block_timeout:
+            return False
+        deadline = time.monotonic() + self.block_timeout
+        with self.condition:
+            self.waits += 1
+            self.waiting += 1
+            try:
+                while len(self.queue) >= self.max_queued and self.running:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+        return len(self.queue) < self.max_queued
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and self.running:
+                    self.condition.wait(0.1)  # Two producers appending at once can both miss the size == 1 wakeup
+                if not self.queue:
+                    return  # Stopped, with everything written
+            if self.batch_interval and len(self.queue) < self.batch_size and self.running:
+                deadline = time.monotonic() + self.batch_interval
+                with self.condition:
+                    while len(self.queue) < self.batch_size and time.monotonic() < deadline and self.running:
+                        self.condition.wait(deadline - time.monotonic())
+            batch = []
+            try:
+                for _ in range(self.batch_size):
+                    batch.append(self.queue.popleft())
+            except IndexError:
+                pass
+            if self.waiting:
+                with self.condition:
+                    self.condition.notify_all()  # Room for the producers held in put()
+            for sink in self.sinks:
+                try:
+                    sink.write_batch(batch)
+                except Exception as e:
+                    self.failed += 1
+                    log.error("[ERROR] Sink %s failed on %s messages: %s", sink.name, len(batch), e)
+            self.processed += len(batch)
+
+
+class SinkPipeline:
+    """Hands every accepted PUBLISH to the registered sinks, off the socket-reading path.
+
+    submit() copies the message and hands it to the WRITE_AHEAD sinks (the journal) on the
+    calling thread, before the server delivers it, so no subscriber gets a message the
+    journal has not recorded. It then appends it to each worker's queue; the other sinks
+    run on the workers' threads, and see the timestamp the journal stamped. All SYNC sinks
+    share one worker, in registration order. Each ASYNC sink has its own. A server with
+    no sinks has no pipeline at all.
+    """
+
+    def __init__(self, sinks, max_queued, block_timeout=0.0):
+        self.sinks = list(sinks)
+        for sink in self.sinks:
+            if sink.holds_acks and sink.execution != WRITE_AHEAD:
+                raise ValueError(f"sink {sink.name} holds acks, so it must be WRITE_AHEAD")
+        self.holds_acks = any(sink.holds_acks for sink in self.sinks)
+        self.write_ahead = [sink for sink in self.sinks if sink.execution == WRITE_AHEAD]
+        self.workers = []
+        inline = [sink for sink in self.sinks if sink.execution == SYNC]
+        if inline:
+            self.workers.append(SinkWorker('sync', inline, min(sink.batch_size for sink in inline), 0.0, max_queued,
+                                           block_timeout))
+        for sink in self.sinks:
+            if sink.execution == ASYNC:
+                self.workers.append(SinkWorker(sink.name, [sink], sink.batch_size, sink.batch_interval, max_queued,
+                                               block_timeout))
+
+    def recover(self):
+        # Whatever one sink recovers (e.g. the journal's unpersisted tail) is replayed into the others
+        for sink in self.sinks:
+            others = [other for other in self.sinks if other is not sink]
+            sink.recover(lambda message, others=others: [other.write_batch([message]) for other in others])
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start(self)
+        for worker in self.workers:
+            worker.start()
+        log.info("[SINKS] Started %s", ", ".join(f"{sink.name} ({sink.execution})" for sink in self.sinks))
+
+    def submit(self, topic, topic_bytes, payload, qos=0, retain=False, on_durable=None):
+        # topic_bytes and payload may be views into a reused receive buffer
+        message = PublishedMessage(topic, bytes(topic_bytes), bytes(payload), qos, retain, None, on_durable)
+        for sink in self.write_ahead:
+            try:
+                sink.write_batch((message,))
+            except Exception as e:
+                # Not recorded, so not acknowledged either: the publisher sends it again
+                log.error("[ERROR] Sink %s failed on a message to %s: %s", sink.name, topic, e)
+        for worker in self.workers:
+            worker.put(message)
+
+    def stop(self, timeout=5):
+        """Hands every queued message to the sinks, then lets each sink flush.
+
+        The sinks stop in reverse order, so InfluxDB has flushed (or spilled) its points
+        before the journal writes its last checkpoint.
+        """
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.stop(max(deadline - time.monotonic(), 0))
+        for sink in reversed(self.sinks):
+            sink.stop()
+        log.info("[SINKS] Stopped")
+
+    def persisted_through(self):
+        """The oldest point any storing sink has reached, or None if no sink stores messages."""
+        points = [point for point in (sink.persisted_through() for sink in self.sinks) if point is not None]
+        return min(points) if points else None
+
+    def register_metrics(self):
+        for worker in self.workers:
+            metrics.REGISTRY.gauge('mqtt_sink_queued', 'Messages waiting for a sink worker',
+                                   lambda worker=worker: len(worker.queue), worker=worker.name)
+            metrics.REGISTRY.counter_function('mqtt_sink_waits_total', 'PUBLISH packets held for room in a full sink queue',
+                                              lambda worker=worker: worker.waits, worker=worker.name)
+            metrics.REGISTRY.counter_function('mqtt_sink_dropped_total', 'Messages shed by a sink worker that fell behind',
+                                              lambda worker=worker: worker.dropped, worker=worker.name)
+        for sink in self.sinks:
+            sink.register_metrics()
@@ -0,0 +1,333 @@
+import bisect
+import threading
+import time
+import weakref
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mqtt_logging import get_logger
+
+log = get_logger('metrics')
+
+PACKET_TYPES = ('RESERVED', 'CONNECT', 'CONNACK', 'PUBLISH', 'PUBACK', 'PUBREC', 'PUBREL', 'PUBCOMP',
+                'SUBSCRIBE', 'SUBACK', 'UNSUBSCRIBE', 'UNSUBACK', 'PINGREQ', 'PINGRESP', 'DISCONNECT', 'AUTH')
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000, 10000)
+
+
+class PerThreadCells:
+    """Values kept in one small list per thread, so updates never take a lock or contend.
+
+    Reading sums every thread's cell. Cells of threads that have exited are folded
+    into `retired` on collection, so per-connection threads do not pile up.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.local = threading.local()
+        self.cells = []  # (thread, cell)
+        self.retired = [0] * width
+        self.lock = threading.Lock()  # Only taken for a thread's first update and for reads
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.width
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+            return cell
+
+    def totals(self):
+        with self.lock:
+            live = []
+            for thread, cell in self.cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    self.retired = [a + b for a, b in zip(self.retired, cell)]
+            self.cells = live
+            totals = list(self.retired)
+            for _, cell in live:
+                for index, value in enumerate(cell):
+                    totals[index] += value
+        return totals
+
+
+class Counter(PerThreadCells):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+    def value(self):
+        return self.totals()[0]
+
+
+class Histogram(PerThreadCells):
+    """Fixed-bucket histogram; a cell holds the per-bucket counts, then the sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        super().__init__(len(self.buckets) + 3)  # Buckets, +Inf, sum, count
+
+    def observe(self, value):
+        cell = self.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def snapshot(self):
+        """Returns ([(upper_bound, cumulative_count)], sum, count)."""
+        totals = self.totals()
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, totals[-2], totals[-1]
+
+
+class Registry:
+    """Named metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.families = {}  # Name -> (type, help, {labels: metric or callable})
+        self.lock = threading.Lock()
+
+    def register(self, kind, name, help_text, metric, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (kind, help_text, {}))
+            family[2].setdefault(key, metric)
+            return family[2][key]
+
+    def counter(self, name, help_text, **labels):
+        return self.register('counter', name, help_text, Counter(), labels)
+
+    def histogram(self, name, help_text, buckets, **labels):
+        return self.register('histogram', name, help_text, Histogram(buckets), labels)
+
+    def gauge(self, name, help_text, function, **labels):
+        self.register_function('gauge', name, help_text, function, labels)
+
+    def counter_function(self, name, help_text, function, **labels):
+        # For totals kept elsewhere (e.g. by the outbound queues) and only summed when scraped
+        self.register_function('counter', name, help_text, function, labels)
+
+    def register_function(self, kind, name, help_text, function, labels):
+        # Computed when scraped; a later registration under the same labels replaces it
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.families.setdefault(name, (kind, help_text, {}))[2][key] = function
+
+    def render(self):
+        with self.lock:
+            families = [(name, kind, help_text, list(metrics.items()))
+                        for name, (kind, help_text, metrics) in sorted(self.families.items())]
+        lines = []
+        for name, kind, help_text, metrics in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind == 'histogram':
+                    buckets, total, count = metric.snapshot()
+                    for bound, cumulative in buckets:
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+                else:
+                    try:
+                        value = metric() if callable(metric) else metric.value()
+                    except Exception as e:
+                        log.debug("[METRICS] %s failed: %s", name, e)
+                        continue
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+class QueueTotals:
+    """Packets and bytes sent, summed over the live outbound queues and the closed ones.
+
+    Each queue counts in plain attributes it already updates under its own lock, so
+    fan-out adds no metric call per delivered message.
+    """
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.retired_packets = [0] * len(PACKET_TYPES)
+        self.retired_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, queue):
+        with self.lock:
+            self.queues.add(queue)
+
+    def retire(self, queue):
+        with self.lock:
+            if queue in self.queues:
+                self.queues.discard(queue)
+                self.retired_packets = [a + b for a, b in zip(self.retired_packets, queue.sent_packets)]
+                self.retired_bytes += queue.sent_bytes
+
+    def packets(self, packet_type):
+        with self.lock:
+            return self.retired_packets[packet_type] + sum(queue.sent_packets[packet_type] for queue in self.queues)
+
+    def bytes(self):
+        with self.lock:
+            return self.retired_bytes + sum(queue.sent_bytes for queue in self.queues)
+
+
+REGISTRY = Registry()
+outbound = QueueTotals()
+
+# Broker-wide metrics; every server variant and the outbound queues update these
+packets_received = [REGISTRY.counter('mqtt_packets_received_total', 'MQTT packets received, by type', type=name)
+                    for name in PACKET_TYPES]
+bytes_received = REGISTRY.counter('mqtt_bytes_received_total', 'Bytes read from client sockets')
+connections_accepted = REGISTRY.counter('mqtt_connections_accepted_total', 'TCP connections accepted')
+connections_rejected = REGISTRY.counter('mqtt_connections_rejected_total',
+                                        'Connections closed unserved: MAX_CONNECTIONS reached or CONNECT wait too long')
+connections_throttled = REGISTRY.counter('mqtt_connections_throttled_total',
+                                         'Connections whose CONNECT waited for the CONNECT_RATE limit')
+session_takeovers = REGISTRY.counter('mqtt_session_takeovers_total',
+                                     'Connections closed because a new one connected with the same client ID')
+tls_handshakes = {kind: REGISTRY.counter('mqtt_tls_handshakes_total', 'TLS handshakes on TLS_PORT, by outcome', kind=kind)
+                  for kind in ('full', 'resumed', 'failed')}
+tls_handshake_seconds = REGISTRY.histogram('mqtt_tls_handshake_seconds', 'Time taken by completed TLS handshakes',
+                                           LATENCY_BUCKETS)
+bus_forwarded = REGISTRY.counter('mqtt_bus_forwarded_total', 'PUBLISH packets forwarded to peer workers or cluster nodes')
+bus_received = REGISTRY.counter('mqtt_bus_received_total', 'PUBLISH packets received from peer workers or cluster nodes')
+publish_fanout = REGISTRY.histogram('mqtt_publish_fanout', 'Subscribers matched per PUBLISH (the sum counts deliveries)',
+                                    FANOUT_BUCKETS)
+publish_latency = REGISTRY.histogram('mqtt_publish_latency_seconds',
+                                     'PUBLISH receipt until every subscriber has it sent or queued',
+                                     LATENCY_BUCKETS)
+for packet_type, name in enumerate(PACKET_TYPES):
+    REGISTRY.counter_function('mqtt_packets_sent_total', 'MQTT packets accepted for sending, by type',
+                              lambda packet_type=packet_type: outbound.packets(packet_type), type=name)
+REGISTRY.counter_function('mqtt_bytes_sent_total', 'Bytes written to client sockets', outbound.bytes)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the broker's log
+
+
+def start_http_server(host, port):
+    """Serves REGISTRY as Prometheus text on http://host:port/metrics from a daemon thread."""
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log.error("[ERROR] Metrics endpoint on %s:%s failed: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("[METRICS] Serving Prometheus metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+class RollingCounts:
+    """The broker's load per interval, kept for the last `size` intervals in fixed arrays.
+
+    Each series is an array used as a ring buffer. Every interval, sample() stores the
+    increase of each cumulative series (a counter) or the current value of a gauge,
+    then hands the row to the listeners; the InfluxDB sink (for a worker pool, the
+    pool) writes it as a mqtt_message_count point. The forecaster reads window() and
+    never queries anything.
+    """
+
+    def __init__(self):
+        self.sources = {}  # Name -> (function, cumulative)
+        self.series = {}  # Name -> array('q') of the last `size` values
+        self.last = {}  # Name -> cumulative value at the previous sample
+        self.listeners = []  # listener(row, timestamp_ns) after every sample
+        self.size = 0
+        self.position = 0  # Next slot to write
+        self.count = 0  # Slots written so far, up to size
+        self.interval = None
+        self.lock = threading.Lock()
+
+    def track(self, name, function, cumulative=True):
+        with self.lock:
+            self.sources[name] = (function, cumulative)
+            self.last[name] = function() if cumulative else 0
+            if self.size:
+                self.series[name] = array('q', bytes(8 * self.size))
+
+    def start(self, interval, size):
+        with self.lock:
+            if self.interval is not None:
+                return  # Already sampling
+            self.interval = interval
+            self.size = size
+            self.series = {name: array('q', bytes(8 * size)) for name in self.sources}
+        threading.Thread(target=self.run, name='rolling-metrics', daemon=True).start()
+
+    def run(self):
+        next_tick = time.monotonic() + self.interval
+        while True:
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+            next_tick += self.interval
+            self.sample(time.time_ns())
+
+    def sample(self, timestamp_ns):
+        row = {}
+        for name, (function, cumulative) in list(self.sources.items()):
+            try:
+                value = int(function())
+            except Exception as e:
+                log.debug("[METRICS] %s failed: %s", name, e)
+                value = self.last[name] if cumulative else 0
+            if cumulative:
+                value, self.last[name] = value - self.last[name], value
+            row[name] = value
+        with self.lock:
+            for name, value in row.items():
+                self.series[name][self.position] = value
+            self.position = (self.position + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+        for listener in self.listeners:
+            try:
+                listener(row, timestamp_ns)
+            except Exception as e:
+                log.error("[ERROR] Rolling metrics listener failed: %s", e)
+
+    def window(self, names, count):
+        """Returns the last `count` intervals of the named series as rows, oldest first.
+
+        Fewer rows come back until that many intervals have been sampled.
+        """
+        with self.lock:
+            count = min(count, self.count)
+            start = self.position - count
+            return [[self.series[name][(start + offset) % self.size] for name in names] for offset in range(count)]
+
+
+# Series every broker samples; the servers add their connection gauge
+rolling = RollingCounts()
+rolling.track('pub_count', lambda: packets_received[3].value())  # PUBLISH packets received
+rolling.track('sub_count', lambda: publish_fanout.snapshot()[1])  # Messages delivered to subscribers
+rolling.track('bytes_in', bytes_received.value)
+rolling.track('bytes_out', outbound.bytes)
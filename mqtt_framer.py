@@ -0,0 +1,127 @@
+import struct
+
+import config
+
+MAX_REMAINING_LENGTH_BYTES = 4  # MQTT caps the remaining length field at 4 bytes
+MIN_READ_SIZE = 256  # Never hand out less free space than this to recv_into()
+
+
+def encode_remaining_length(length):
+    encoded_bytes = bytearray()
+    while True:
+        encoded_byte = length % 128
+        length //= 128
+        if length > 0:
+            encoded_byte |= 128
+        encoded_bytes.append(encoded_byte)
+        if length == 0:
+            break
+    return encoded_bytes
+
+
+def decode_remaining_length(data, offset=0):
+    """Decodes the 1-4 byte remaining length field starting at data[offset].
+
+    Returns (length, bytes_consumed), or None if the field has not fully arrived yet.
+    Raises ValueError if the field is longer than 4 bytes.
+    """
+    multiplier = 1
+    value = 0
+    for index in range(MAX_REMAINING_LENGTH_BYTES):
+        if offset + index >= len(data):
+            return None
+        encoded_byte = data[offset + index]
+        value += (encoded_byte & 127) * multiplier
+        if (encoded_byte & 128) == 0:
+            return value, index + 1
+        multiplier *= 128
+    raise ValueError("Malformed remaining length (more than 4 bytes)")
+
+
+def encode_publish(topic_bytes, payload, qos=0, packet_id=None, dup=False, retain=False):
+    """Encodes a complete PUBLISH packet as immutable bytes, so one frame can be shared.
+
+    payload may be bytes, bytearray or memoryview; it is copied exactly once.
+    """
+    remaining_length = 2 + len(topic_bytes) + (2 if qos else 0) + len(payload)
+    return b"".join((
+        bytes([0x30 | (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)]),
+        encode_remaining_length(remaining_length),
+        struct.pack("!H", len(topic_bytes)),  # Topic length in bytes, not characters
+        topic_bytes,
+        struct.pack("!H", packet_id) if qos else b"",
+        payload,
+    ))
+
+
+class PacketFramer:
+    """Incremental MQTT packet framer over a reusable bytearray.
+
+    The socket reads straight into the framer (recv_into() for blocking sockets,
+    get_buffer()/buffer_updated() for asyncio.BufferedProtocol), and packets() drains
+    every complete packet as (header_byte, body) where body is a memoryview of the
+    variable header and payload. Bodies point into the framer's buffer, so they are
+    only valid until the next read: copy anything that has to outlive the handler.
+    """
+
+    def __init__(self, initial_size=None, max_packet_size=None):
+        self.initial_size = initial_size or config.FRAMER_BUFFER_SIZE
+        self.max_packet_size = max_packet_size or config.MAX_PACKET_SIZE
+        self.buffer = bytearray(self.initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not yet handed out as a packet
+        self.end = 0  # One past the last byte received
+        self.pending_length = 0  # Total length of the incomplete packet at self.start, if known
+
+    def get_buffer(self, sizehint=-1):
+        """Returns a writable memoryview over the free space at the end of the buffer."""
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+            if len(self.buffer) > self.initial_size:
+                # Give back the memory a large packet needed once it has been consumed
+                self.buffer = bytearray(self.initial_size)
+                self.view = memoryview(self.buffer)
+
+        wanted = max(MIN_READ_SIZE, self.pending_length - pending)
+        if len(self.buffer) - self.end < wanted:
+            if pending + wanted > len(self.buffer):
+                # Grow to fit the incomplete packet; old packet views keep the old buffer alive
+                new_buffer = bytearray(max(len(self.buffer) * 2, pending + wanted))
+                new_buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = new_buffer
+                self.view = memoryview(new_buffer)
+            else:
+                # Move the partial packet to the front instead of growing
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """Reads once from a blocking socket. Returns the number of bytes read (0 on EOF)."""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def packets(self):
+        """Yields (header_byte, body) for every complete packet currently buffered."""
+        while self.end - self.start >= 2:
+            decoded = decode_remaining_length(self.view[self.start + 1:self.end])
+            if decoded is None:
+                return
+            remaining_length, bytes_consumed = decoded
+            total_length = 1 + bytes_consumed + remaining_length
+            if total_length > self.max_packet_size:
+                raise ValueError(f"Packet of {total_length} bytes exceeds the {self.max_packet_size} byte limit")
+            if self.end - self.start < total_length:
+                self.pending_length = total_length  # Lets get_buffer() make room in one step
+                return
+
+            header = self.buffer[self.start]
+            body = self.view[self.start + 1 + bytes_consumed:self.start + total_length]
+            self.start += total_length
+            self.pending_length = 0
+            yield header, body
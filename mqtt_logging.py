@@ -0,0 +1,125 @@
+import atexit
+import logging
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import config
+
+ROOT_LOGGER = 'mqtt'
+
+_listener = None
+_listener_pid = None  # A forked worker has to start its own listener thread
+
+
+def get_logger(category):
+    """Returns the logger for one category (connection, publish, subscribe, ...)."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{category}")
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps 1 in `sample_every` records below WARNING and at most `max_per_second` records.
+
+    Records cut by the rate limit are counted and the count is appended to the next
+    record that gets through. Every thread logging to the category shares the counters,
+    so they are updated under a lock.
+    """
+
+    def __init__(self, sample_every=1, max_per_second=None):
+        super().__init__()
+        self.sample_every = sample_every
+        self.max_per_second = max_per_second
+        self.seen = 0
+        self.window_start = 0.0
+        self.window_count = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            if self.sample_every > 1 and record.levelno < logging.WARNING:
+                self.seen += 1
+                if self.seen % self.sample_every:
+                    return False
+            if self.max_per_second:
+                now = time.monotonic()
+                if now - self.window_start >= 1:
+                    self.window_start = now
+                    self.window_count = 0
+                if self.window_count >= self.max_per_second:
+                    self.suppressed += 1
+                    return False
+                self.window_count += 1
+                if self.suppressed:
+                    record.msg = f"{record.msg} ({self.suppressed} similar messages suppressed)"
+                    self.suppressed = 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the writer falls behind."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level=None):
+    """Sends every mqtt.* record through a bounded queue to a background writer thread.
+
+    Messages use %-style arguments, so a record below the active level costs one level
+    check and is never formatted. Per-category levels, sampling and rate limits come
+    from config.py. Safe to call again; a forked worker gets its own writer thread.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level or config.LOG_LEVEL)
+    root.propagate = False
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter(config.LOG_FORMAT))
+    log_queue = queue.Queue(config.LOG_QUEUE_SIZE)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, stream)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(_listener.stop)
+
+    for category, category_level in config.LOG_CATEGORY_LEVELS.items():
+        get_logger(category).setLevel(category_level)
+    for category in set(config.LOG_SAMPLE_EVERY) | set(config.LOG_RATE_LIMITS):
+        logger = get_logger(category)
+        for old in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(old)
+        logger.addFilter(SamplingFilter(config.LOG_SAMPLE_EVERY.get(category, 1),
+                                        config.LOG_RATE_LIMITS.get(category)))
+
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, toggle_debug)
+
+
+def set_level(level, category=None):
+    """Changes the level at runtime, for every category or just one."""
+    logger = get_logger(category) if category else logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(level)
+
+
+def toggle_debug(signum=None, frame=None):
+    # kill -USR1 <pid> switches a running broker between DEBUG and the configured level
+    root = logging.getLogger(ROOT_LOGGER)
+    set_level(config.LOG_LEVEL if root.level == logging.DEBUG else logging.DEBUG)
@@ -1,115 +1,364 @@
+import asyncio
+import selectors
+import signal
 import socket
 import threading
-from influxdb import InfluxDBClient
+from influx_writer import InfluxBatchWriter, InfluxSink
+from message_journal import JournalSink, MessageJournal
+from message_sinks import SinkPipeline
 import struct
-from collections import defaultdict
 import time
-import select
+import uuid
 import config
+import metrics
+import tls
+from mqtt_framer import PacketFramer, encode_publish, encode_remaining_length
+from outbound_queue import ThreadedOutboundQueue, TransportOutboundQueue
+from qos import InflightWindow
+from retained_store import RetainedStore
+from session_store import Session, SessionStore
+from timer_wheel import TimerWheel
+from token_bucket import TokenBucket
+from topic_trie import SubscriptionIndex, is_shared, topic_matches
+from mqtt_logging import get_logger, setup_logging
+
+log = get_logger('server')
+connection_log = get_logger('connection')
+publish_log = get_logger('publish')
+subscribe_log = get_logger('subscribe')
+
+def journal_sinks():
+    """The write-ahead journal, if JOURNAL_DIR is set."""
+    if not config.JOURNAL_DIR:
+        return []
+    return [JournalSink(MessageJournal(config.JOURNAL_DIR, config.JOURNAL_SEGMENT_BYTES, config.JOURNAL_MAX_BYTES,
+                                       config.JOURNAL_COMMIT_INTERVAL, config.JOURNAL_COMMIT_BATCH))]
+
+
+def create_influx_writer():
+    """A batch writer to INFLUXDB_DATABASE, or None if the client library or the server is unavailable."""
+    try:
+        from influxdb import InfluxDBClient  # Only brokers that store to InfluxDB need the library
+        influx_client = InfluxDBClient(
+            host=config.INFLUXDB_HOST,
+            port=config.INFLUXDB_PORT,
+            database=config.INFLUXDB_DATABASE
+        )
+        # Batches points in the background; creates the database and retries on its own
+        return InfluxBatchWriter(influx_client, config.INFLUXDB_DATABASE)
+    except Exception as e:
+        log.error("[ERROR] InfluxDB connection failed: %s", e)
+        return None
+
+
+def influx_sinks(counts=metrics.rolling):
+    """InfluxDB storage, with the samples of counts as mqtt_message_count if METRICS_INTERVAL is set."""
+    writer = create_influx_writer()
+    if writer is None:
+        return []
+    return [InfluxSink(writer, counts if config.METRICS_INTERVAL else None)]
+
 
 class MQTTServer:
-    def __init__(self):
+    def __init__(self, sinks=None):
         self.host = config.MQTT_HOST
         self.port = config.MQTT_PORT
         self.clients = {}
-        self.topics = defaultdict(set)
+        self.connections = set()  # Every open connection, whether it has sent CONNECT or not
+        self.handshaking = set()  # TLS sockets the asyncio server has on the handshake pool, not yet in connections
+        self.client_ids = {}  # Client ID -> connection, so a reconnect under the same ID replaces the old one in O(1)
+        self.client_id_lock = threading.Lock()
+        self.connect_throttle = TokenBucket(config.CONNECT_RATE, config.CONNECT_BURST) if config.CONNECT_RATE else None
+        self.tls_context = tls.create_context() if config.TLS_PORT else None  # Fails at startup on a bad certificate
+        self.tls_pool = tls.create_handshake_pool() if config.TLS_PORT else None  # Handshakes stay off the serving path
+        # Topic filter trie with a per-client reverse index
+        self.topics = SubscriptionIndex(
+            depth=self.queue_depth if config.SHARED_SUBSCRIPTION_POLICY == 'least_queue_depth' else None)
         self.topic_lock = threading.Lock()  # Lock for thread-safe topic access
-        self.use_influx = True  # Flag to check if InfluxDB is available
+        self.retained = RetainedStore(config.RETAINED_MAX_BYTES, config.RETAINED_STORE_PATH)  # Last retained message per topic
+        self.sessions = None  # Persistent (clean-session=0) sessions, if enabled
+        if config.SESSION_STORE_DIR:
+            self.sessions = SessionStore(config.SESSION_STORE_DIR, config.SESSION_SEGMENT_BYTES,
+                                         config.SESSION_MAX_LOG_BYTES)
+            for session in self.sessions.offline_sessions():
+                # Offline sessions stay subscribed, so their messages keep being queued across restarts;
+                # shared groups only rotate over connected members
+                for topic_filter, qos in session.subscriptions.items():
+                    if not is_shared(topic_filter):
+                        self.topics.subscribe(session, topic_filter, qos)
+        self.timers = TimerWheel(config.TIMER_WHEEL_TICK, config.TIMER_WHEEL_SLOTS)  # QoS 1 retries and keep-alives
+        self.watchdogs = {}  # Connection -> keep-alive timer
+        self.last_activity = {}  # Connection -> monotonic time of the last inbound data
+        self.reuse_port = False  # Set by worker_pool so every worker can bind the same port
+        self.listeners = []  # Listening sockets, closed by stop()
+        self.stopping = False
+        self.stopped = threading.Event()  # Set once stop() is done; start() then returns
+        self.bus = None  # WorkerBus or ClusterBus linking this broker to its peers, if any
 
-        # Attempt to connect to InfluxDB
-        try:
-            self.influx_client = InfluxDBClient(
-                host=config.INFLUXDB_HOST,
-                port=config.INFLUXDB_PORT,
-                database=config.INFLUXDB_DATABASE
-            )
-            self.influx_client.create_database(config.INFLUXDB_DATABASE)  # Create if it doesn't exist
-            print("[INFO] Connected to InfluxDB")
-        except Exception as e:
-            print(f"[ERROR] InfluxDB connection failed: {e}")
-            self.use_influx = False  # Disable InfluxDB usage if there's an error
+        # Storage and analytics hooks; without any, a PUBLISH never leaves the reading thread
+        self.pipeline = None
+        sinks = self.create_sinks() if sinks is None else sinks
+        if sinks:
+            self.pipeline = SinkPipeline(sinks, config.SINK_QUEUE_SIZE, config.SINK_QUEUE_BLOCK)
+            self.pipeline.recover()
+            self.pipeline.start()
+        self.acks_held = self.pipeline is not None and self.pipeline.holds_acks  # The journal sends PUBACK/PUBREC
+        self.register_metrics()
 
-    def handle_client(self, client_socket, address):
-        print(f"[NEW CONNECTION] {address} connected.")
-        try:
-            buffer = b""
-            last_ping_time = time.time()  # Keep track of last PINGREQ
-            while True:
-                try:
-                    # Use select to handle both data and timeouts
-                    ready_to_read, _, _ = select.select([client_socket], [], [], 1)
-                    if ready_to_read:
-                        data = client_socket.recv(1024)
-                        if not data:
-                            break
-                        buffer += data
-                    else:
-                        # Check for keep-alive timeout (e.g., 120 seconds)
-                        if time.time() - last_ping_time > 120:
-                            print(f"[KEEP ALIVE TIMEOUT] {address}")
-                            break
-
-                    # Check if we've received enough data for at least the fixed header
-                    if len(buffer) < 2:
-                        continue  # Wait for more data
-
-                    # Read the packet type and remaining length from the fixed header
-                    packet_type = (buffer[0] >> 4) & 0x0F
-
-                    # Decode remaining length (this now takes the buffer as input)
-                    remaining_length, bytes_consumed = self.decode_remaining_length(buffer[1:])  
-
-                    # Wait until we have the full packet based on remaining length
-                    total_length = 2 + remaining_length  # +2 for fixed header
-                    if len(buffer) < total_length:
-                        continue  # Wait for more data
-
-                    # Process the packet based on packet type
-                    packet_data = buffer[:total_length]
-                    buffer = buffer[total_length:]  # Remove the processed packet from buffer
-
-                    if packet_type == 1:  # CONNECT
-                        self.handle_connect(client_socket, packet_data, address)
-                    elif packet_type == 3:  # PUBLISH
-                        self.handle_publish(client_socket, packet_data)
-                    elif packet_type == 8:  # SUBSCRIBE
-                        self.handle_subscribe(client_socket, packet_data, address)
-                    elif packet_type == 12:  # PINGREQ
-                        self.handle_pingreq(client_socket)
-                        last_ping_time = time.time()
-                    elif packet_type == 14:  # DISCONNECT
-                        self.handle_disconnect(client_socket, address)
-                        break
-                    else:
-                        print(f"[UNKNOWN PACKET TYPE] {packet_type}")
+    def create_sinks(self):
+        # The journal goes first, so InfluxDB stores the timestamp it stamped
+        return journal_sinks() + influx_sinks()
 
-                except socket.timeout:
-                    print(f"[KEEP ALIVE TIMEOUT] {address}")
+    def handle_client(self, client_socket, address, delay=0.0):
+        if delay:
+            time.sleep(delay)  # The CONNECT waits in the socket buffer until this connection's turn
+        connection_log.info("[NEW CONNECTION] %s connected.", address)
+        metrics.connections_accepted.inc()
+        self.watch_connection(client_socket, address)
+        try:
+            framer = PacketFramer()
+            connected = True
+            while connected:
+                # Blocks until data arrives; an expired keep-alive shuts the socket down from the timer wheel
+                received = framer.recv_into(client_socket)
+                if received == 0:
                     break
+                metrics.bytes_received.inc(received)
+                self.last_activity[client_socket] = time.monotonic()  # Any packet counts, not just PINGREQ
+                for header, body in framer.packets():
+                    if not self.dispatch_packet(client_socket, header >> 4, body, address, header & 0x0F):
+                        connected = False
+                        break
 
         except Exception as e:
-            print(f"[ERROR] {e}")
+            connection_log.error("[ERROR] %s", e)
         finally:
+            self.unwatch_connection(client_socket)
             self.remove_client(client_socket, address)
+            self.connections.discard(client_socket)
             client_socket.close()
 
+    def handle_tls_client(self, client_socket, address, delay=0.0):
+        # Runs on the connection's own thread, which waits while the handshake pool does the
+        # handshake: a niced thread can't be made to serve at normal priority again afterwards
+        if delay:
+            time.sleep(delay)
+        channel = tls.TLSChannel(self.tls_context)
+        try:
+            self.tls_pool.submit(channel.handshake, client_socket, config.CONNECT_TIMEOUT).result()
+        except OSError as e:
+            connection_log.warning("[TLS] Handshake with %s failed: %s", address, e)
+            self.connections.discard(client_socket)
+            client_socket.close()
+            return
+        connection = tls.TLSSocket(client_socket, channel)
+        self.connections.discard(client_socket)
+        self.connections.add(connection)
+        self.handle_client(connection, address)
 
-    def start(self):
+    def open_listener(self, port):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind((self.host, self.port))
-        server.listen(5)
-        print(f"[LISTENING] Server is listening on {self.host}:{self.port}")
+        # stop() closes the clients' connections, so their TIME_WAIT must not keep a restart from binding
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind((self.host, port))
+        server.listen(config.LISTEN_BACKLOG)
+        server.setblocking(False)  # Each wakeup drains every pending connection, see accept_pending()
+        return server
 
-        while True:
-            client, addr = server.accept()
-            client_thread = threading.Thread(target=self.handle_client, args=(client, addr))
-            client_thread.start()
+    def start(self):
+        self.start_metrics()
+        selector = selectors.DefaultSelector()
+        self.listeners.append(self.open_listener(self.port))
+        selector.register(self.listeners[-1], selectors.EVENT_READ, self.handle_client)
+        log.info("[LISTENING] Server is listening on %s:%s", self.host, self.port)
+        if self.tls_context is not None:
+            self.listeners.append(self.open_listener(config.TLS_PORT))
+            selector.register(self.listeners[-1], selectors.EVENT_READ, self.handle_tls_client)
+            log.info("[LISTENING] TLS on %s:%s", self.host, config.TLS_PORT)
+        threading.Thread(target=self.timers.run, daemon=True).start()
+
+        while not self.stopped.is_set():
+            for key, _ in selector.select(1.0):  # The timeout lets start() return once stop() is done
+                if key.fileobj.fileno() < 0:
+                    continue  # Closed by stop()
+                for client, addr in self.accept_pending(key.fileobj):
+                    delay = self.admit_connection(addr)
+                    if delay is None:
+                        client.close()
+                        continue
+                    client.setblocking(True)  # The reader thread blocks in recv_into()
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Small packets must not wait on Nagle
+                    self.connections.add(client)
+                    client_thread = threading.Thread(target=key.data, args=(client, addr, delay))
+                    client_thread.start()
+
+    def stop(self, timeout=5):
+        """Shuts the broker down gracefully; may be called from any thread, and start() returns once it is done.
+
+        The listeners close first, so no new client arrives, then every connection is
+        closed and its client removed (persistent sessions go offline). The bus then
+        closes its links, the sinks write out what they hold and the session and
+        retained stores are closed.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        deadline = time.monotonic() + timeout
+        log.info("[STOPPING] Closing the listeners and %s connections", len(self.connections))
+        self.close_listeners()
+        self.disconnect_all()
+        while self.clients and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.clients:
+            log.warning("[STOPPING] %s clients still connected after %ss", len(self.clients), timeout)
+        if self.bus is not None:
+            self.bus.stop(max(deadline - time.monotonic(), 1))
+        if self.pipeline is not None:
+            self.pipeline.stop(max(deadline - time.monotonic(), 1))
+        if self.sessions is not None:
+            self.sessions.close()
+        self.retained.close()
+        log.info("[STOPPED] Server on port %s stopped", self.port)
+        self.stopped.set()
+
+    def close_listeners(self):
+        for listener in self.listeners:
+            listener.close()
+
+    def disconnect_all(self):
+        for connection in list(self.connections):
+            self.disconnect_client(connection)
+
+    def accept_pending(self, server):
+        """Accepts up to ACCEPT_BATCH connections already queued on the non-blocking listening socket."""
+        accepted = []
+        while len(accepted) < config.ACCEPT_BATCH:
+            try:
+                accepted.append(server.accept())
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Out of file descriptors, typically; the backlog keeps the rest until some are freed
+                connection_log.error("[ERROR] accept failed: %s", e)
+                time.sleep(0.1)
+                break
+        return accepted
+
+    def admit_connection(self, address):
+        """Returns how long a new connection waits before its CONNECT is read, or None to close it at once.
+
+        MAX_CONNECTIONS caps the open connections. CONNECT_RATE spaces out the CONNECTs
+        of a reconnecting fleet; a connection that would wait longer than CONNECT_TIMEOUT
+        is closed instead, and the client retries later.
+        """
+        open_connections = len(self.connections) + len(self.handshaking)
+        if config.MAX_CONNECTIONS and open_connections >= config.MAX_CONNECTIONS:
+            connection_log.warning("[REJECTED] %s: %s connections open", address, open_connections)
+            metrics.connections_rejected.inc()
+            return None
+        if self.connect_throttle is None:
+            return 0.0
+        delay = self.connect_throttle.reserve(config.CONNECT_TIMEOUT)
+        if delay is None:
+            connection_log.warning("[REJECTED] %s: CONNECT queue longer than %ss", address, config.CONNECT_TIMEOUT)
+            metrics.connections_rejected.inc()
+        elif delay:
+            metrics.connections_throttled.inc()
+        return delay
+
+    def register_metrics(self):
+        # Gauges are computed when scraped, so they cost nothing on the packet path
+        metrics.REGISTRY.gauge('mqtt_connections', 'Clients currently connected', lambda: len(self.clients))
+        metrics.rolling.track('connections', lambda: len(self.clients), cumulative=False)
+        metrics.REGISTRY.gauge('mqtt_subscriptions', 'Subscriptions, offline sessions included', lambda: len(self.topics))
+        metrics.REGISTRY.gauge('mqtt_retained_messages', 'Retained messages held',
+                               lambda: self.retained.stats()['messages'])
+        metrics.REGISTRY.gauge('mqtt_retained_bytes', 'Topic and payload bytes of retained messages',
+                               lambda: self.retained.stats()['bytes'])
+        metrics.REGISTRY.gauge('mqtt_timers', 'Keep-alive and retry timers on the shared wheel', lambda: len(self.timers))
+        if self.sessions is not None:
+            metrics.REGISTRY.gauge('mqtt_offline_sessions', 'Persistent sessions with no client attached',
+                                   lambda: self.sessions.stats()['offline'])
+            metrics.REGISTRY.gauge('mqtt_session_log_bytes', 'Bytes in the offline message log',
+                                   lambda: self.sessions.stats()['log_bytes'])
+        if self.pipeline is not None:
+            self.pipeline.register_metrics()
+
+    def start_metrics(self):
+        if config.METRICS_PORT:
+            metrics.start_http_server(config.METRICS_HOST, config.METRICS_PORT)
+        if config.METRICS_INTERVAL:
+            metrics.rolling.start(config.METRICS_INTERVAL, config.METRICS_HISTORY)
+
+    def watch_connection(self, client_socket, address):
+        """Starts the connection's deadline: CONNECT_TIMEOUT until CONNECT, then 1.5x its keep-alive.
+
+        Inbound traffic only stamps last_activity; the timer itself is moved when it
+        fires, so a busy connection costs nothing extra per packet.
+        """
+        self.last_activity[client_socket] = time.monotonic()
+        self.watchdogs[client_socket] = self.timers.schedule(
+            config.CONNECT_TIMEOUT, self.check_keep_alive, client_socket, address)
+
+    def unwatch_connection(self, client_socket):
+        self.last_activity.pop(client_socket, None)
+        timer = self.watchdogs.pop(client_socket, None)
+        if timer is not None:
+            self.timers.cancel(timer)
+
+    def check_keep_alive(self, client_socket, address):
+        # Fired by the timer wheel
+        timer = self.watchdogs.get(client_socket)
+        if timer is None:
+            return  # Already gone
+        client = self.clients.get(client_socket)
+        if client is None:
+            connection_log.warning("[CONNECT TIMEOUT] %s sent no CONNECT", address)
+            self.disconnect_client(client_socket)
+            return
+        limit = client['keep_alive'] * 1.5  # MQTT allows one and a half keep-alive periods
+        idle = time.monotonic() - self.last_activity.get(client_socket, 0)
+        if idle >= limit:
+            connection_log.warning("[KEEP ALIVE TIMEOUT] %s", address)
+            self.disconnect_client(client_socket)
+        else:
+            self.timers.reschedule(timer, limit - idle)
+
+    def dispatch_packet(self, client_socket, packet_type, packet_data, address, flags=0):
+        """Routes one framed packet body to its handler. Returns False once the client disconnects."""
+        metrics.packets_received[packet_type].inc()
+        if packet_type == 1:  # CONNECT
+            self.handle_connect(client_socket, packet_data, address)
+        elif packet_type == 3:  # PUBLISH
+            if not self.handle_publish(client_socket, packet_data, flags):
+                return False  # A protocol violation: the connection is closed
+        elif packet_type == 4:  # PUBACK
+            self.handle_puback(client_socket, packet_data)
+        elif packet_type == 6:  # PUBREL
+            self.handle_pubrel(client_socket, packet_data)
+        elif packet_type == 8:  # SUBSCRIBE
+            self.handle_subscribe(client_socket, packet_data, address)
+        elif packet_type == 10:  # UNSUBSCRIBE
+            self.handle_unsubscribe(client_socket, packet_data)
+        elif packet_type == 12:  # PINGREQ
+            self.handle_pingreq(client_socket)
+        elif packet_type == 14:  # DISCONNECT
+            self.handle_disconnect(client_socket, address)
+            return False
+        else:
+            connection_log.warning("[UNKNOWN PACKET TYPE] %s", packet_type)
+        return True
 
     def parse_packet_type(self, byte):
         packet_types = {
             0x10: "CONNECT",
             0x30: "PUBLISH",
+            0x40: "PUBACK",
+            0x62: "PUBREL",
             0x80: "SUBSCRIBE",
+            0xA0: "UNSUBSCRIBE",
             0xC0: "PINGREQ",
             0xE0: "DISCONNECT"
         }
@@ -117,182 +366,791 @@ class MQTTServer:
 
 
     def handle_connect(self, client_socket, data, address):
+        # data is the CONNECT variable header and payload (fixed header already stripped)
         try:
             # Check for minimum length
-            if len(data) < 10:  # Basic check for minimum length
-                print("[ERROR] CONNECT packet too short")
-                return
-
-            # Check packet type (should be 0x10 for CONNECT)
-            packet_type = (data[0] >> 4) & 0x0F
-            if packet_type != 1:
-                print(f"[ERROR] Expected CONNECT packet, but got type {packet_type}")
+            if len(data) < 12:  # Protocol name, level, flags, keep-alive and client ID length
+                connection_log.error("[ERROR] CONNECT packet too short")
                 return
 
             # Parse protocol name length
-            protocol_name_len = struct.unpack("!H", data[2:4])[0]
-            protocol_name = data[4:4 + protocol_name_len].decode('utf-8')
-            print(f"[CONNECT] Protocol Name: {protocol_name}")
+            protocol_name_len = struct.unpack("!H", data[0:2])[0]
+            protocol_name = str(data[2:2 + protocol_name_len], 'utf-8')
+            connection_log.debug("[CONNECT] Protocol Name: %s", protocol_name)
 
             # Verify protocol name is "MQTT"
             if protocol_name != "MQTT":
-                print(f"[ERROR] Unsupported protocol name: {protocol_name}")
+                connection_log.error("[ERROR] Unsupported protocol name: %s", protocol_name)
                 return
 
             # Parse protocol level (should be 4 for MQTT 3.1.1 or 5 for MQTT 5.0)
-            protocol_level = data[4 + protocol_name_len]
+            protocol_level = data[2 + protocol_name_len]
             if protocol_level not in [4, 5]:
-                print(f"[ERROR] Unsupported MQTT protocol level: {protocol_level}")
+                connection_log.error("[ERROR] Unsupported MQTT protocol level: %s", protocol_level)
                 return
 
-            # Parse Client ID
-            client_id_len = struct.unpack("!H", data[10:12])[0]
-            client_id = data[12:12 + client_id_len].decode('utf-8')
-            print(f"[CONNECT] Client ID: {client_id}")
+            # Clean-session=0 asks for the session to outlive the connection
+            clean_session = bool(data[3 + protocol_name_len] & 0x02)
 
-            # Register the client
-            self.clients[client_socket] = {"id": client_id, "address": address}
+            # Keep-alive in seconds follows the connect flags; 0 turns the mechanism off
+            keep_alive = struct.unpack("!H", data[4 + protocol_name_len:6 + protocol_name_len])[0]
 
-            # Send CONNACK response
-            connack_packet = b'\x20\x02\x00\x00'
-            client_socket.sendall(connack_packet)
-            print(f"[CONNECT] Client {client_id} connected successfully.")
+            # Parse Client ID (after the connect flags and the 2-byte keep-alive)
+            client_id_offset = 6 + protocol_name_len
+            client_id_len = struct.unpack("!H", data[client_id_offset:client_id_offset + 2])[0]
+            client_id = str(data[client_id_offset + 2:client_id_offset + 2 + client_id_len], 'utf-8')
+            if not client_id:
+                if not clean_session:
+                    # MQTT 3.1.1 3.1.3.1: a session that outlives the connection needs a client ID
+                    connection_log.warning("[CONNECT] %s sent an empty client ID with clean-session=0", address)
+                    self.send_to_client(client_socket, bytes([0x20, 0x02, 0x00, 0x02]))  # Identifier rejected
+                    self.disconnect_client(client_socket)
+                    return
+                # A unique ID of its own, so anonymous clients never take each other over
+                client_id = f"auto-{uuid.uuid4().hex}"
+            connection_log.debug("[CONNECT] Client ID: %s", client_id)
+            self.claim_client(client_socket, client_id, clean_session,
+                              lambda: self.connect_client(client_socket, client_id, address, keep_alive, clean_session))
 
         except Exception as e:
-            print(f"[ERROR] in handle_connect: {e}")
+            connection_log.error("[ERROR] in handle_connect: %s", e)
+
+    def claim_client(self, client_socket, client_id, clean_session, connected):
+        """Has the bus peers close the client's connection there, then calls connected().
+
+        The reader thread waits for them, up to BUS_CLAIM_TIMEOUT; the client is waiting
+        for its CONNACK anyway.
+        """
+        if self.bus is not None:
+            claimed = threading.Event()
+            number = self.bus.claim(client_id, clean_session, claimed.set)
+            if not claimed.wait(config.BUS_CLAIM_TIMEOUT):
+                self.bus.abandon(number)
+                connection_log.warning("[TAKEOVER] Peers did not release %s within %ss", client_id,
+                                       config.BUS_CLAIM_TIMEOUT)
+        connected()
 
+    def connect_client(self, client_socket, client_id, address, keep_alive, clean_session):
+        # The rest of the CONNECT, once no peer holds the client
+        self.take_over(client_id, client_socket)
 
+        # Register the client with its own bounded outbound queue
+        queue = self.create_outbound_queue(client_socket, client_id)
+        self.clients[client_socket] = {
+            "id": client_id,
+            "address": address,
+            "queue": queue,
+            "keep_alive": keep_alive,
+            "inflight": InflightWindow(queue, self.timers),  # QoS 1 messages awaiting PUBACK
+            "session": None  # Set for clean-session=0 clients
+        }
+        session_present = self.attach_session(client_socket, client_id, clean_session)
+
+        # Send CONNACK response
+        # Swap the CONNECT deadline for the client's own keep-alive
+        timer = self.watchdogs.get(client_socket)
+        if timer is not None:
+            if keep_alive:
+                self.timers.reschedule(timer, keep_alive * 1.5)
+            else:
+                self.unwatch_connection(client_socket)
+
+        connack_packet = bytes([0x20, 0x02, 0x01 if session_present else 0x00, 0x00])
+        self.send_to_client(client_socket, connack_packet)
+        connection_log.info("[CONNECT] Client %s connected successfully.", client_id)
+        if self.clients[client_socket]['session'] is not None:
+            self.replay_session(client_socket)
 
-    def handle_publish(self, client_socket, data):
-        topic_length = struct.unpack("!H", data[2:4])[0]
-        topic = data[4:4 + topic_length].decode('utf-8')
+    def handle_publish(self, client_socket, data, flags=0):
+        """Returns False if the client broke the protocol and has to be disconnected."""
+        started = time.perf_counter()
+        topic_length = struct.unpack("!H", data[0:2])[0]
+        topic = str(data[2:2 + topic_length], 'utf-8')  # Topic names are UTF-8; payloads are opaque bytes
+        if '+' in topic or '#' in topic:
+            # MQTT 3.1.1 3.3.2.1: wildcards are for topic filters, never in the topic name of a PUBLISH
+            publish_log.warning("[PUBLISH] %s published to %s, which has a wildcard; disconnecting",
+                                self.clients.get(client_socket, {}).get('id'), topic)
+            return False
 
-        payload_start = 4 + topic_length
-        if len(data) > payload_start:
-            payload = data[payload_start:].decode('utf-8')
-            print(f"[PUBLISH] Topic: {topic}, Payload: {payload}")
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        payload_start = 2 + topic_length
+        packet_id = None
+        if qos:
+            # QoS 1 and 2 carry a packet identifier between the topic and the payload
+            packet_id = struct.unpack("!H", data[payload_start:payload_start + 2])[0]
+            payload_start += 2
+        if len(data) >= payload_start:  # An empty payload is valid
+            # A view into the framer's buffer: never decoded, and only copied into the outgoing frame
+            payload = data[payload_start:]
+            publish_log.debug("[PUBLISH] Topic: %s, %s byte payload", topic, len(payload))
 
-            if self.use_influx:
-                try:
-                    self.influx_client.write_points([{"measurement": topic, "fields": {"value": payload}}])
-                except Exception as e:
-                    print(f"[ERROR] Failed to write to InfluxDB: {e}")
-                    self.use_influx = False  # Disable InfluxDB if an error occurs during a write
+            # QoS 2 is acknowledged with PUBREC/PUBCOMP but delivered onwards as QoS 1
+            ack = None
+            if qos == 1:
+                ack = struct.pack("!BBH", 0x40, 2, packet_id)  # PUBACK
+            elif qos == 2:
+                ack = struct.pack("!BBH", 0x50, 2, packet_id)  # PUBREC
 
-            self.publish_to_subscribers(topic, payload)
+            if self.pipeline is not None:
+                # Journaled before delivery, then queued for the sink threads; the acknowledgement waits for the commit
+                on_durable = (lambda: self.send_durable_ack(client_socket, ack)) if ack and self.acks_held else None
+                self.pipeline.submit(topic, data[2:2 + topic_length], payload, qos, retain, on_durable)
+
+            self.publish_to_subscribers(topic, payload, min(qos, 1), retain=retain)
+            metrics.publish_latency.observe(time.perf_counter() - started)
+            if ack is not None and not self.acks_held:
+                self.send_to_client(client_socket, ack)
         else:
-            print("[ERROR] Invalid PUBLISH packet structure")
+            publish_log.error("[ERROR] Invalid PUBLISH packet structure")
+        return True
+
+    def send_durable_ack(self, client_socket, packet):
+        # Called on the journal's commit thread once the PUBLISH is on disk
+        if client_socket in self.clients:
+            self.send_to_client(client_socket, packet)
+
+    def handle_puback(self, client_socket, data):
+        packet_id = struct.unpack("!H", data[0:2])[0]
+        client = self.clients.get(client_socket)
+        if client is not None and not client['inflight'].acknowledge(packet_id):
+            publish_log.debug("[PUBACK] Unknown packet ID %s from %s", packet_id, client['id'])
+
+    def handle_pubrel(self, client_socket, data):
+        packet_id = struct.unpack("!H", data[0:2])[0]
+        self.send_to_client(client_socket, struct.pack("!BBH", 0x70, 2, packet_id))  # PUBCOMP
 
     def handle_subscribe(self, client_socket, data, address):
         try:
             # Decode packet ID and topic length safely
-            if len(data) < 6:
-                print("[ERROR] Subscription data too short.")
+            if len(data) < 4:
+                subscribe_log.error("[ERROR] Subscription data too short.")
                 return
 
-            packet_id = struct.unpack("!H", data[2:4])[0]
-            topic_length = struct.unpack("!H", data[4:6])[0]
-
-            # Ensure the data length is sufficient for the topic
-            if len(data) < 6 + topic_length:
-                print("[ERROR] Incomplete subscription packet.")
-                return
+            packet_id = struct.unpack("!H", data[0:2])[0]
 
-            # Decode topic and QoS level
-            topic = data[6:6 + topic_length].decode('utf-8')
-            qos = data[6 + topic_length]  # Get QoS level, assuming it's one byte
+            # Packet ID followed by one or more topic filters, each with its requested QoS
+            requests = []
+            offset = 2
+            while offset + 2 <= len(data):
+                topic_length = struct.unpack("!H", data[offset:offset + 2])[0]
+                # Ensure the data length is sufficient for the topic and its QoS byte
+                if len(data) < offset + 3 + topic_length:
+                    subscribe_log.error("[ERROR] Incomplete subscription packet.")
+                    return
+                topic = str(data[offset + 2:offset + 2 + topic_length], 'utf-8')
+                requests.append((topic, min(data[offset + 2 + topic_length], 1)))  # QoS 2 requests are granted QoS 1
+                offset += 3 + topic_length
 
-            # Register the subscriber to the topic (thread-safe)
+            # Register the subscriber to each topic filter (thread-safe); SUBACK has one return code per filter
+            return_codes = []
             with self.topic_lock:
-                self.topics[topic].add(client_socket)
-            print(f"[SUBSCRIBE] {self.clients[client_socket]['id']} subscribed to {topic} with QoS {qos}")
+                for topic, qos in requests:
+                    try:
+                        self.topics.subscribe(client_socket, topic, qos)
+                        return_codes.append(qos)
+                    except ValueError as e:
+                        subscribe_log.warning("[ERROR] Rejected subscription: %s", e)
+                        return_codes.append(0x80)  # SUBACK failure return code
+            granted = [(topic, qos) for (topic, qos), code in zip(requests, return_codes) if code != 0x80]
+            session = self.clients[client_socket]['session']
+            for topic, qos in granted:
+                if session is not None:
+                    self.sessions.subscribe(session, topic, qos)
+                subscribe_log.info("[SUBSCRIBE] %s subscribed to %s with QoS %s", self.clients[client_socket]['id'], topic, qos)
 
             # Send SUBACK response to acknowledge subscription
-            suback_packet = struct.pack("!BBH", 0x90, 3, packet_id) + bytes([qos])  # 0x90 = SUBACK packet type
-            client_socket.sendall(suback_packet)
+            suback_packet = bytes([0x90]) + encode_remaining_length(2 + len(return_codes)) + \
+                struct.pack("!H", packet_id) + bytes(return_codes)  # 0x90 = SUBACK packet type
+            self.send_to_client(client_socket, suback_packet)
+            for topic, qos in granted:
+                if not is_shared(topic):
+                    self.send_retained(client_socket, topic, qos)  # Not for shared subscriptions, as in MQTT 5
 
         except Exception as e:
-            print(f"[ERROR] In handle_subscribe: {e}")
+            subscribe_log.error("[ERROR] In handle_subscribe: %s", e)
             self.remove_client(client_socket, address)
 
 
+    def handle_unsubscribe(self, client_socket, data):
+        # Packet ID followed by one or more length-prefixed topic filters
+        packet_id = struct.unpack("!H", data[0:2])[0]
+        topics = []
+        offset = 2
+        while offset + 2 <= len(data):
+            topic_length = struct.unpack("!H", data[offset:offset + 2])[0]
+            topics.append(str(data[offset + 2:offset + 2 + topic_length], 'utf-8'))
+            offset += 2 + topic_length
+
+        # Only this client's own trie nodes are touched
+        with self.topic_lock:
+            for topic in topics:
+                self.topics.unsubscribe(client_socket, topic)
+        session = self.clients.get(client_socket, {}).get('session')
+        if session is not None:
+            for topic in topics:
+                self.sessions.unsubscribe(session, topic)
+        subscribe_log.info("[UNSUBSCRIBE] %s unsubscribed from %s", self.clients.get(client_socket, {}).get('id'), topics)
+
+        unsuback_packet = struct.pack("!BBH", 0xB0, 2, packet_id)  # 0xB0 = UNSUBACK packet type
+        self.send_to_client(client_socket, unsuback_packet)
+
     def handle_pingreq(self, client_socket):
         pingresp_packet = b'\xd0\x00'
-        client_socket.sendall(pingresp_packet)
+        self.send_to_client(client_socket, pingresp_packet)
 
     def handle_disconnect(self, client_socket, address):
-        print(f"[DISCONNECT] {address} disconnected.")
+        connection_log.info("[DISCONNECT] %s disconnected.", address)
         self.remove_client(client_socket, address)
 
+    def take_over(self, client_id, client_socket):
+        """Makes client_socket the connection of client_id, closing the one that had it (MQTT 3.1.1 3.1.4).
+
+        Without this a device reconnecting before its old connection timed out would
+        leave a zombie client subscribed next to the new one.
+        """
+        with self.client_id_lock:
+            previous = self.client_ids.get(client_id)
+            self.client_ids[client_id] = client_socket
+        if previous is None or previous is client_socket:
+            return
+        connection_log.info("[TAKEOVER] Client %s connected again; closing its previous connection", client_id)
+        self.close_taken_over(previous)
+
+    def release_client(self, client_id):
+        """Closes client_id's connection here, as the client is connecting to a bus peer."""
+        with self.client_id_lock:
+            previous = self.client_ids.pop(client_id, None)
+        if previous is not None:
+            connection_log.info("[TAKEOVER] Client %s connected to a peer; closing its connection here", client_id)
+            self.close_taken_over(previous)
+
+    def close_taken_over(self, previous):
+        metrics.session_takeovers.inc()
+        # Removed here rather than by its reader, so its session is offline before the new one attaches
+        self.remove_client(previous, self.clients.get(previous, {}).get('address'))
+        self.disconnect_client(previous)
+
     def remove_client(self, client_socket, address):
-        if client_socket in self.clients:
-            client_id = self.clients[client_socket]['id']
-            del self.clients[client_socket]
-            for topic in self.topics:
-                if client_socket in self.topics[topic]:
-                    self.topics[topic].remove(client_socket)
-            print(f"[CLIENT REMOVED] {client_id} removed.")
-
-    def publish_to_subscribers(self, topic, payload):
-        print(f"[PUBLISH TO SUBSCRIBERS] Topic: {topic}, Payload: {payload}")
-        # Iterate over a copy of the set to avoid issues during removal
+        client = self.clients.pop(client_socket, None)  # Atomic: a takeover and the reader may both get here
+        if client is not None:
+            client_id = client['id']
+            with self.client_id_lock:
+                if self.client_ids.get(client_id) is client_socket:
+                    del self.client_ids[client_id]
+            client['queue'].close()
+            unacknowledged = client['inflight'].close()
+            session = client['session']
+            with self.topic_lock:
+                # Offline before it is subscribed: a publish matching the session in between
+                # would otherwise find it still owned and queue nothing
+                if session is not None and self.sessions.go_offline(session, client_socket, unacknowledged):
+                    # The session takes over the subscriptions, so matching messages are queued for it;
+                    # it leaves its shared groups, whose messages go to the members still connected
+                    for topic_filter, qos in session.subscriptions.items():
+                        if not is_shared(topic_filter):
+                            self.topics.subscribe(session, topic_filter, qos)
+                self.topics.remove_client(client_socket)
+            connection_log.info("[CLIENT REMOVED] %s removed.", client_id)
+
+    def publish_to_subscribers(self, topic, payload, qos=0, from_bus=False, retain=False, shared=()):
+        """Delivers a message to the matching subscribers here and forwards it to interested peers.
+
+        A message from the bus is only delivered to the shared groups in shared, which the
+        peer it was published on picked this broker to serve.
+        """
+        publish_log.debug("[PUBLISH TO SUBSCRIBERS] Topic: %s, %s byte payload", topic, len(payload))
+        if retain:
+            # Kept at the published QoS; subscribers get it at their granted QoS
+            self.retained.set(topic, payload, qos)
+        # Snapshot the recipients under the lock, then deliver without holding it
+        groups = {}
+        targets = {}
+        with self.topic_lock:
+            recipients = self.topics.match(topic, groups)
+            if self.bus is None:
+                shared = groups
+            elif not from_bus:
+                # Messages that came in over the bus are never forwarded again, so they cannot loop.
+                # Every worker (or cluster node) keeps the whole retained store, so retained messages go to all peers
+                targets, shared = self.bus.route(topic, retain)
+            for topic_filter in shared:
+                group = groups.get(topic_filter)
+                if group is not None:  # Its last member here may have left since the publishing peer picked us
+                    self.topics.pick(group, recipients)
+        recipients = list(recipients.items())
+        metrics.publish_fanout.observe(len(recipients))
+        if not recipients and not targets:
+            return
+
+        publish_packet = self.create_publish_packet(topic, payload)  # Encoded once for every QoS 0 subscriber
+        if targets:
+            # Bus frames carry the publish QoS and RETAIN in the fixed header but no packet identifier
+            header = publish_packet[0] | qos << 1 | retain
+            self.bus.forward(targets, bytes([header]) + publish_packet[1:] if header != publish_packet[0] else publish_packet)
+        topic_bytes = topic.encode('utf-8')
+        policy = self.topic_overflow_policy(topic)
+        offline = []
+        for client_socket, granted_qos in recipients:
+            client = self.clients.get(client_socket)
+            if client is None:
+                if isinstance(client_socket, Session):
+                    offline.append((client_socket, min(qos, granted_qos)))
+                continue
+            if qos and granted_qos:
+                # Needs its own packet identifier; the window encodes it and tracks the PUBACK
+                client['inflight'].publish(topic_bytes, payload)
+            # Only queues the frame; the client's writer does the actual send
+            elif not client['queue'].put(publish_packet, policy):
+                publish_log.warning("[SLOW CONSUMER] %s outbound queue full, disconnecting.", client['id'])
+                self.disconnect_client(client_socket)
+        if offline:
+            # One log record for every offline session the message is for
+            self.sessions.enqueue(offline, topic_bytes, payload)
+
+    def deliver_from_bus(self, topic, payload, qos=0, retain=False, shared=()):
+        # Called on a bus reader thread with a message published on another worker or cluster node
+        self.publish_to_subscribers(topic, payload, qos, from_bus=True, retain=retain, shared=shared)
+
+    def adopt_session(self, client_id, subscriptions):
+        """Takes over an offline persistent session from a worker leaving the pool, or one the client left."""
+        if self.sessions is None:
+            return
+        session = self.sessions.adopt(client_id, subscriptions)
+        if session is None:
+            log.warning("[SESSION] %s already has a session here; the one handed over is dropped", client_id)
+            return
         with self.topic_lock:
-            for client in list(self.topics[topic]):
-                try:
-                    publish_packet = self.create_publish_packet(topic, payload)
-                    client.sendall(publish_packet)
-                except Exception as e:
-                    print(f"[ERROR] Failed to send message to client: {e}")
-                    self.remove_client(client, self.clients.get(client, {'address': 'unknown'})['address']) 
+            for topic_filter, qos in session.subscriptions.items():
+                if not is_shared(topic_filter):
+                    self.topics.subscribe(session, topic_filter, qos)
+
+    def queue_for_session(self, client_id, topic_bytes, payload, qos):
+        # A queued message of a session handed over by adopt_session()
+        session = self.sessions.sessions.get(client_id) if self.sessions is not None else None
+        if session is not None:
+            self.sessions.enqueue([(session, qos)], topic_bytes, payload)
+
+    def attach_session(self, client_socket, client_id, clean_session):
+        """Restores or starts a persistent session. Returns the CONNACK session-present flag."""
+        if self.sessions is None:
+            return False
+        if clean_session:
+            self.discard_session(client_id)
+            return False
+        session, present = self.sessions.open(client_id, client_socket)
+        client = self.clients[client_socket]
+        client['session'] = session
+        with self.topic_lock:
+            # The connection subscribes before the offline entry goes, so no filter lapses in between
+            for topic_filter, qos in session.subscriptions.items():
+                self.topics.subscribe(client_socket, topic_filter, qos)
+            self.topics.remove_client(session)
+        client['inflight'].refill = lambda: self.replay_session(client_socket)
+        return present
+
+    def discard_session(self, client_id):
+        old = self.sessions.discard(client_id)
+        if old is not None:
+            with self.topic_lock:
+                self.topics.remove_client(old)
+
+    def replay_session(self, client_socket):
+        # Streams the offline backlog from the log; a full QoS 1 window pauses it until PUBACKs arrive
+        client = self.clients.get(client_socket)
+        if client is None:
+            return
 
+        def deliver(topic_bytes, payload, qos):
+            if qos:
+                return client['inflight'].publish(topic_bytes, payload)
+            topic = topic_bytes.decode('utf-8')
+            if not client['queue'].put(encode_publish(topic_bytes, payload), self.topic_overflow_policy(topic)):
+                publish_log.warning("[SLOW CONSUMER] %s outbound queue full, disconnecting.", client['id'])
+                self.disconnect_client(client_socket)
+                return False
+            return True
 
+        if self.sessions.replay(client['session'], deliver):
+            client['inflight'].refill = None
+
+    def send_retained(self, client_socket, topic_filter, granted_qos):
+        # Only the retained topics the new filter can match are visited, not the whole store
+        client = self.clients.get(client_socket)
+        if client is None:
+            return
+        for topic, payload, qos in self.retained.match(topic_filter):
+            topic_bytes = topic.encode('utf-8')
+            if min(qos, granted_qos):
+                client['inflight'].publish(topic_bytes, payload, retain=True)
+            elif not client['queue'].put(encode_publish(topic_bytes, payload, retain=True),
+                                         self.topic_overflow_policy(topic)):
+                subscribe_log.warning("[SLOW CONSUMER] %s outbound queue full, disconnecting.", client['id'])
+                self.disconnect_client(client_socket)
+                return
+
+    def send_to_client(self, client_socket, packet):
+        # Control packets share the client's queue (so frames never interleave) but are never dropped
+        client = self.clients.get(client_socket)
+        if client is None:
+            client_socket.sendall(packet)
+        else:
+            client['queue'].put(packet, force=True)
+
+    def create_outbound_queue(self, client_socket, client_id):
+        queue = ThreadedOutboundQueue(
+            client_socket,
+            config.OUTBOUND_QUEUE_SIZE,
+            config.OUTBOUND_OVERFLOW_POLICY,
+            config.OUTBOUND_CLIENT_POLICIES.get(client_id)
+        )
+        queue.start()
+        return queue
+
+    def topic_overflow_policy(self, topic):
+        # The first filter in OUTBOUND_TOPIC_POLICIES that matches the topic wins
+        for topic_filter, policy in config.OUTBOUND_TOPIC_POLICIES.items():
+            if topic_matches(topic_filter, topic):
+                return policy
+        return None
+
+    def disconnect_client(self, client_socket):
+        # Shutting the socket down wakes its reader, which then removes the client
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def queue_depth(self, client):
+        # Messages waiting for a shared-subscription member: queued frames plus unacknowledged and pending QoS 1
+        entry = self.clients.get(client)
+        if entry is None:
+            return float('inf')
+        inflight = entry['inflight']
+        return len(entry['queue'].packets) + len(inflight.inflight) + len(inflight.pending)
+
+    def get_outbound_stats(self):
+        """Returns {client_id: {"depth", "enqueued", "dropped"}} for every connected client."""
+        return {client['id']: client['queue'].stats() for client in list(self.clients.values())}
 
     def create_publish_packet(self, topic, payload):
-        # Fixed header
-        packet_type_flags = 0x30  # PUBLISH with QoS 0 and no retain
-        topic_length = len(topic)
-        payload_length = len(payload)
-        remaining_length = topic_length + payload_length + 2  # +2 for topic length field
-
-        # Create packet with fixed header
-        packet = bytearray()
-        packet.append(packet_type_flags)  # PUBLISH fixed header byte
-        packet.extend(self.encode_remaining_length(remaining_length))
-        packet.extend(struct.pack("!H", topic_length))  # Topic length as 2 bytes
-        packet.extend(topic.encode('utf-8'))  # Topic
-        packet.extend(payload.encode('utf-8'))  # Payload
-
-        print(f"[DEBUG] Created publish packet: {packet}")
-        return packet
-
-    def encode_remaining_length(self, length):
-        encoded_bytes = bytearray()
+        # PUBLISH with QoS 0 and no retain, as immutable bytes shared by every recipient
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return encode_publish(topic.encode('utf-8'), payload)
+
+
+class TransportConnection:
+    """Socket-like wrapper so the MQTTServer handlers can write to an asyncio transport."""
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+        self.writing_paused = False  # Set while the transport's write buffer is above its high-water mark
+        self.outbound = None  # TransportOutboundQueue once the client has sent CONNECT
+        self.held = False  # Set while its CONNECT waits for the bus peers to release the client
+
+    def sendall(self, data):
+        # Never blocks: asyncio buffers whatever the kernel does not accept right away
+        self.transport.write(data)
+
+    def shutdown(self, how=None):
+        # Slow consumers are cut off without flushing what is still buffered
+        self.transport.abort()
+
+    def close(self):
+        self.transport.close()
+
+
+class MQTTProtocol(asyncio.BufferedProtocol):
+    """Per-connection state for AsyncMQTTServer. Holds no thread and no timer of its own."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.connection = None
+        self.address = None
+        self.framer = PacketFramer()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        delay = self.admit()
+        if delay is None:
+            transport.abort()
+            return
+        self.connection = TransportConnection(transport, self)
+        self.server.connections.add(self)
+        connection_log.info("[NEW CONNECTION] %s connected.", self.address)
+        metrics.connections_accepted.inc()
+        if delay:
+            # The CONNECT waits in the socket buffer until this connection's turn
+            transport.pause_reading()
+            self.server.loop.call_later(delay, self.admitted)
+        else:
+            self.server.watch_connection(self.connection, self.address)
+
+    def admit(self):
+        return self.server.admit_connection(self.address)
+
+    def admitted(self):
+        if not self.transport.is_closing():
+            self.server.watch_connection(self.connection, self.address)
+            self.transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        # The event loop reads straight into the framer's buffer
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.framer.buffer_updated(nbytes)
+        self.received(nbytes)
+
+    def received(self, nbytes):
+        # Handles every packet now complete in the framer
+        metrics.bytes_received.inc(nbytes)
+        self.server.last_activity[self.connection] = time.monotonic()  # Any packet counts, not just PINGREQ
+        try:
+            for header, body in self.framer.packets():
+                if not self.server.dispatch_packet(self.connection, header >> 4, body, self.address, header & 0x0F):
+                    self.transport.close()
+                    break
+                if self.connection.held:
+                    break  # The rest waits in the framer until release()
+        except Exception as e:
+            connection_log.error("[ERROR] %s", e)
+            self.transport.close()
+
+    def release(self):
+        # The server is done with a CONNECT it held; go on with what arrived after it
+        self.transport.resume_reading()
+        self.received(0)
+
+    def pause_writing(self):
+        self.connection.writing_paused = True
+
+    def resume_writing(self):
+        self.connection.writing_paused = False
+        if self.connection.outbound is not None:
+            self.connection.outbound.flush()
+
+    def connection_lost(self, exc):
+        if self.connection is None:
+            return  # Rejected by admit_connection()
+        self.server.connections.discard(self)
+        self.server.unwatch_connection(self.connection)
+        self.server.remove_client(self.connection, self.address)
+
+
+class TLSProtocol(MQTTProtocol):
+    """MQTTProtocol for a TLS connection whose handshake was done on the handshake pool.
+
+    The event loop reads ciphertext into a scratch buffer, which is decrypted straight
+    into the framer; writes are encrypted by a TLSTransport in front of the transport.
+    The connection was admitted when it was accepted, and waits out what is left of
+    its CONNECT_RATE delay.
+    """
+
+    def __init__(self, server, channel, admit_at):
+        super().__init__(server)
+        self.channel = channel
+        self.admit_at = admit_at  # time.monotonic() at which its CONNECT may be read
+        self.scratch = memoryview(bytearray(tls.READ_SIZE))
+
+    def connection_made(self, transport):
+        super().connection_made(tls.TLSTransport(transport, self.channel))
+        if self.transport.is_reading():
+            self.decrypt(0)  # A CONNECT sent along with the end of the handshake
+
+    def admit(self):
+        return max(0.0, self.admit_at - time.monotonic())
+
+    def admitted(self):
+        super().admitted()
+        self.decrypt(0)
+
+    def get_buffer(self, sizehint):
+        return self.scratch
+
+    def buffer_updated(self, nbytes):
+        self.channel.feed(self.scratch[:nbytes])
+        self.decrypt(nbytes)
+
+    def decrypt(self, nbytes):
+        if self.transport.is_closing():
+            return
+        try:
+            while True:
+                decrypted = self.channel.read(self.framer.get_buffer())
+                if decrypted <= 0:
+                    break
+                self.framer.buffer_updated(decrypted)
+        except OSError as e:  # ssl.SSLError: a corrupt or forged record
+            connection_log.warning("[TLS] %s: %s", self.address, e)
+            self.transport.abort()
+            return
+        self.transport.write_pending()
+        if decrypted < 0:
+            self.transport.close()  # close_notify
+        self.received(nbytes)
+
+
+class AsyncMQTTServer(MQTTServer):
+    """Serves every client from a single asyncio event loop instead of one thread per socket.
+
+    Packet handling is inherited from MQTTServer; each connection is represented by a
+    TransportConnection so the handlers can keep calling sendall().
+    """
+
+    def __init__(self, sinks=None):
+        super().__init__(sinks)
+        self.loop = None
+        self.server = None  # asyncio Server of the plain listener
+
+    def create_outbound_queue(self, connection, client_id):
+        # No writer thread: the queue is drained from the transport's flow-control callbacks
+        connection.outbound = TransportOutboundQueue(
+            connection,
+            config.OUTBOUND_QUEUE_SIZE,
+            config.OUTBOUND_OVERFLOW_POLICY,
+            config.OUTBOUND_CLIENT_POLICIES.get(client_id)
+        )
+        return connection.outbound
+
+    def send_durable_ack(self, client_socket, packet):
+        # The journal commits on its own thread; the transports belong to the event loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(super().send_durable_ack, client_socket, packet)
+
+    def deliver_from_bus(self, topic, payload, qos=0, retain=False, shared=()):
+        # Bus readers are threads; hand the message to the event loop that owns the transports
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.publish_to_subscribers, topic, payload, qos, True, retain, shared)
+
+    def claim_client(self, connection, client_id, clean_session, connected):
+        # The loop never waits for the peers: the connection stops reading until they have
+        # answered, and the packets that came after its CONNECT are handled then
+        if self.bus is None:
+            connected()
+            return
+        connection.held = True
+        connection.transport.pause_reading()
+        state = {}
+
+        def finish(timed_out=False):
+            if state.get('done'):
+                return
+            state['done'] = True
+            state['timer'].cancel()
+            self.bus.abandon(number)
+            if timed_out:
+                connection_log.warning("[TAKEOVER] Peers did not release %s within %ss", client_id,
+                                       config.BUS_CLAIM_TIMEOUT)
+            connection.held = False
+            if connection.transport.is_closing():
+                return  # The client went away meanwhile
+            try:
+                connected()
+            except Exception as e:
+                connection_log.error("[ERROR] in handle_connect: %s", e)
+            connection.protocol.release()
+
+        state['timer'] = self.loop.call_later(config.BUS_CLAIM_TIMEOUT, finish, True)
+        number = self.bus.claim(client_id, clean_session, lambda: self.loop.call_soon_threadsafe(finish))
+
+    def release_client(self, client_id):
+        # The connections belong to the event loop; the bus reader waits until the old one is closed
+        if self.loop is None:
+            return
+        release = super().release_client
+        released = threading.Event()
+
+        def run():
+            try:
+                release(client_id)
+            finally:
+                released.set()
+
+        self.loop.call_soon_threadsafe(run)
+        released.wait(config.BUS_CLAIM_TIMEOUT)
+
+    def start(self):
+        self.start_metrics()
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self):
+        loop = self.loop = asyncio.get_running_loop()
+        # asyncio accepts up to `backlog` pending connections per wakeup of the listener
+        self.server = await loop.create_server(lambda: MQTTProtocol(self), self.host, self.port,
+                                               backlog=config.LISTEN_BACKLOG, reuse_port=self.reuse_port or None)
+        log.info("[LISTENING] Server is listening on %s:%s (asyncio)", self.host, self.port)
+        if self.tls_context is not None:
+            self.listeners.append(self.open_listener(config.TLS_PORT))
+            threading.Thread(target=self.accept_tls, args=(self.listeners[-1],), daemon=True).start()
+            log.info("[LISTENING] TLS on %s:%s", self.host, config.TLS_PORT)
+
+        timers = loop.create_task(self.run_timers())
+        try:
+            while not self.stopped.is_set():  # The server accepts until stop() is done
+                await asyncio.sleep(1.0)
+        finally:
+            timers.cancel()
+
+    def close_listeners(self):
+        super().close_listeners()  # The TLS listener
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    def disconnect_all(self):
+        # The transports belong to the event loop; close() still writes out what they have buffered
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(lambda: [protocol.transport.close() for protocol in list(self.connections)])
+
+    def accept_tls(self, listener):
+        # TLS connections are accepted on this thread and handed to the handshake pool; once
+        # the handshake is done, the event loop takes over the socket
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
         while True:
-            encoded_byte = length % 128
-            length //= 128
-            if length > 0:
-                encoded_byte |= 128
-            encoded_bytes.append(encoded_byte)
-            if length == 0:
-                break
-        return encoded_bytes
+            selector.select()
+            for client, addr in self.accept_pending(listener):
+                delay = self.admit_connection(addr)
+                if delay is None:
+                    client.close()
+                    continue
+                client.setblocking(True)
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.handshaking.add(client)  # Counted against MAX_CONNECTIONS until the loop has it
+                self.tls_pool.submit(self.tls_handshake, client, addr, time.monotonic() + delay)
 
+    def tls_handshake(self, client_socket, address, admit_at):
+        channel = tls.TLSChannel(self.tls_context)
+        try:
+            channel.handshake(client_socket, config.CONNECT_TIMEOUT)
+        except OSError as e:
+            connection_log.warning("[TLS] Handshake with %s failed: %s", address, e)
+            self.handshaking.discard(client_socket)
+            client_socket.close()
+            return
+        future = asyncio.run_coroutine_threadsafe(
+            self.loop.connect_accepted_socket(lambda: TLSProtocol(self, channel, admit_at), client_socket), self.loop)
+        # Once connection_made() has put it in connections
+        future.add_done_callback(lambda _: self.handshaking.discard(client_socket))
 
-    def decode_remaining_length(self, data):
-        """Decodes remaining length from a byte array."""
-        multiplier = 1
-        value = 0
-        index = 0
+    async def run_timers(self):
+        # Drives the shared TimerWheel on the loop, so keep-alives and retransmissions touch
+        # the transports from the loop thread only
         while True:
-            encoded_byte = data[index]
-            value += (encoded_byte & 127) * multiplier
-            if (encoded_byte & 128) == 0:
-                break
-            multiplier *= 128
-            index += 1
-        return value, index + 1  # Return length and bytes consumed
+            await asyncio.sleep(self.timers.tick)
+            self.timers.advance()
 
 
 if __name__ == "__main__":
-    server = MQTTServer()
+    setup_logging()
+    if config.SERVER_MODE == 'async':
+        server = AsyncMQTTServer()
+    else:
+        server = MQTTServer()
+    # SIGTERM stops the broker gracefully: the clients are disconnected and the sinks flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.stop).start())
     server.start()
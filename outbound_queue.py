@@ -0,0 +1,199 @@
+import socket
+import threading
+import time
+from collections import deque
+
+import metrics
+from mqtt_logging import get_logger
+
+# Overflow policies for a full outbound queue
+DROP_OLDEST = 'drop_oldest'  # Discard the oldest queued packet to make room
+DROP_NEWEST = 'drop_newest'  # Discard the packet being queued
+DISCONNECT = 'disconnect'  # Drop the slow client altogether
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)  # Per-call non-blocking send (not on Windows)
+
+log = get_logger('outbound')
+
+
+class OutboundQueue:
+    """Bounded queue of encoded packets waiting to be written to one client.
+
+    A publisher only ever appends here, so a subscriber with a full TCP window can
+    no longer block it. When the queue is full the overflow policy decides what
+    happens: the client's own policy wins, otherwise the one passed in for the
+    message (per topic), otherwise the queue default. Unless metered is False (the
+    worker bus), packets and bytes are counted in the broker metrics.
+    """
+
+    def __init__(self, maxsize, default_policy=DROP_OLDEST, client_policy=None, metered=True):
+        for policy in (default_policy, client_policy):
+            if policy is not None and policy not in POLICIES:
+                raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.default_policy = default_policy
+        self.client_policy = client_policy
+        self.metered = metered
+        self.sent_packets = [0] * 16  # By packet type; summed into the broker metrics when scraped
+        self.sent_bytes = 0
+        if metered:
+            metrics.outbound.add(self)
+        self.packets = deque()
+        self.enqueued = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, packet, policy=None, force=False):
+        """Queues a packet. Returns False if the overflow policy says to disconnect the client.
+
+        force=True bypasses the bound; it is meant for small control packets (CONNACK,
+        SUBACK, PINGRESP) that must never be dropped.
+        """
+        if self.closed:
+            return True
+        if not force and len(self.packets) >= self.maxsize:
+            policy = self.client_policy or policy or self.default_policy
+            if policy == DISCONNECT:
+                return False
+            self.dropped += 1
+            if policy == DROP_NEWEST:
+                return True
+            self.packets.popleft()
+        self.packets.append(packet)
+        self.enqueued += 1
+        self.sent_packets[packet[0] >> 4] += 1
+        return True
+
+    def close(self):
+        self.closed = True
+        self.packets.clear()
+        if self.metered:
+            metrics.outbound.retire(self)
+
+    def stats(self):
+        return {"depth": len(self.packets), "enqueued": self.enqueued, "dropped": self.dropped}
+
+
+class ThreadedOutboundQueue(OutboundQueue):
+    """OutboundQueue drained by a dedicated writer thread doing blocking sendall().
+
+    While the queue is empty and the writer idle, put() first tries a non-blocking
+    send so the common case costs no thread switch; the writer only takes over once
+    the client's socket would block. With a linger (seconds) every packet goes
+    through the writer instead, which waits that long for more before each send, so
+    a busy link carries a few large writes rather than one per packet.
+    """
+
+    def __init__(self, client_socket, maxsize, default_policy=DROP_OLDEST, client_policy=None, metered=True,
+                 linger=0.0):
+        super().__init__(maxsize, default_policy, client_policy, metered)
+        self.client_socket = client_socket
+        self.linger = linger
+        self.condition = threading.Condition()
+        self.partial = b""  # Unsent tail of a frame; always written first and never dropped
+        self.sending = False  # True while the writer has a batch outside the lock
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def put(self, packet, policy=None, force=False):
+        with self.condition:
+            if self.closed:
+                return True
+            idle = not self.packets and not self.partial and not self.sending
+            if idle and MSG_DONTWAIT is not None and not self.linger:
+                try:
+                    sent = self.client_socket.send(packet, MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    sent = 0  # Leave the error for the writer to report
+                self.enqueued += 1
+                self.sent_packets[packet[0] >> 4] += 1
+                self.sent_bytes += sent
+                if sent == len(packet):
+                    return True
+                self.partial = packet[sent:]
+                self.condition.notify()
+                return True
+
+            accepted = super().put(packet, policy, force)
+            if idle:
+                self.condition.notify()  # The writer only ever waits when there is nothing to send
+        return accepted
+
+    def close(self):
+        with self.condition:
+            super().close()
+            self.partial = b""
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return super().stats()
+
+    def drain(self, timeout):
+        """Waits up to timeout seconds for the writer to send everything queued. Returns True if it did."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.condition:
+                if self.closed:
+                    return False
+                if not self.packets and not self.partial and not self.sending:
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.sending = False
+                while not self.packets and not self.partial and not self.closed:
+                    self.condition.wait()
+                if self.linger and not self.closed:
+                    self.condition.wait(self.linger)  # put() does not notify a writer that has packets
+                if self.closed:
+                    return
+                # Take everything queued so far and write it with a single sendall()
+                batch = self.partial + b"".join(self.packets)
+                self.partial = b""
+                self.packets.clear()
+                self.sending = True
+            try:
+                self.client_socket.sendall(batch)
+                self.sent_bytes += len(batch)
+            except OSError as e:
+                log.error("[ERROR] Failed to send message to client: %s", e)
+                self.close()
+                try:
+                    # Wake the reader thread so it removes the client
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+
+class TransportOutboundQueue(OutboundQueue):
+    """OutboundQueue for an asyncio connection, drained from transport flow control.
+
+    Packets go straight to the transport while it accepts writes; once asyncio calls
+    pause_writing() they wait here (bounded) until resume_writing() flushes them.
+    Runs entirely on the event loop thread, so it needs no lock.
+    """
+
+    def __init__(self, connection, maxsize, default_policy=DROP_OLDEST, client_policy=None, metered=True):
+        super().__init__(maxsize, default_policy, client_policy, metered)
+        self.connection = connection
+
+    def put(self, packet, policy=None, force=False):
+        accepted = super().put(packet, policy, force)
+        self.flush()
+        return accepted
+
+    def flush(self):
+        while self.packets and not self.connection.writing_paused:
+            packet = self.packets.popleft()
+            self.connection.transport.write(packet)
+            self.sent_bytes += len(packet)
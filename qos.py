@@ -0,0 +1,140 @@
+import threading
+from collections import deque
+
+import config
+from mqtt_framer import decode_remaining_length, encode_publish
+
+
+class PacketIdAllocator:
+    """Hands out the 16-bit packet identifiers of one session, skipping those still in use."""
+
+    def __init__(self):
+        self.next_id = 1
+        self.in_use = set()
+
+    def allocate(self):
+        for _ in range(65535):
+            packet_id = self.next_id
+            self.next_id = packet_id % 65535 + 1  # Identifiers run 1..65535; 0 is not allowed
+            if packet_id not in self.in_use:
+                self.in_use.add(packet_id)
+                return packet_id
+        raise RuntimeError("All 65535 packet identifiers are in use")
+
+    def release(self, packet_id):
+        self.in_use.discard(packet_id)
+
+
+def split_publish(frame):
+    """Returns (topic_bytes, payload, qos) from a PUBLISH frame built by encode_publish()."""
+    _, length_bytes = decode_remaining_length(frame, 1)
+    offset = 1 + length_bytes
+    topic_length = int.from_bytes(frame[offset:offset + 2], 'big')
+    qos = (frame[0] >> 1) & 0x03
+    payload_start = offset + 2 + topic_length + (2 if qos else 0)
+    return frame[offset + 2:offset + 2 + topic_length], frame[payload_start:], qos
+
+
+class InflightWindow:
+    """QoS 1 messages sent to one subscriber and not yet acknowledged with PUBACK.
+
+    Up to `window` messages are pipelined at once; the rest wait in a bounded pending
+    queue (the oldest is dropped when it is full). Each in-flight message has one entry
+    on the server's shared TimerWheel and is resent with the DUP flag every
+    `retry_interval` seconds until the subscriber acknowledges it.
+    """
+
+    def __init__(self, queue, timers, window=None, retry_interval=None, max_pending=None):
+        self.queue = queue  # The client's OutboundQueue
+        self.timers = timers
+        self.window = window or config.QOS1_MAX_INFLIGHT
+        self.retry_interval = retry_interval or config.QOS1_RETRY_INTERVAL
+        self.max_pending = max_pending or config.QOS1_MAX_PENDING
+        self.ids = PacketIdAllocator()
+        self.inflight = {}  # Packet ID -> (frame, timer)
+        self.pending = deque()  # (topic_bytes, payload, retain) waiting for a free slot
+        self.lock = threading.Lock()
+        self.closed = False
+        self.refill = None  # Called once the window has room and nothing is pending (session replay)
+
+        self.sent = 0
+        self.acked = 0
+        self.retransmitted = 0
+        self.dropped = 0
+
+    def publish(self, topic_bytes, payload, retain=False):
+        """Sends the message now if the window has room. Returns False if it had to wait."""
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.inflight) < self.window:
+                self.send_new(topic_bytes, payload, retain)
+                return True
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            # Only a waiting message needs its own copy; the caller's view may be reused
+            self.pending.append((topic_bytes, bytes(payload), retain))
+            return False
+
+    def send_new(self, topic_bytes, payload, retain=False):
+        # Called with the lock held
+        packet_id = self.ids.allocate()
+        frame = encode_publish(topic_bytes, payload, qos=1, packet_id=packet_id, retain=retain)
+        timer = self.timers.schedule(self.retry_interval, self.retransmit, packet_id)
+        self.inflight[packet_id] = (frame, timer)
+        self.sent += 1
+        self.queue.put(frame, force=True)  # The window already bounds what is queued here
+
+    def acknowledge(self, packet_id):
+        """Handles a PUBACK. Returns False for an unknown (or duplicate) packet ID."""
+        with self.lock:
+            entry = self.inflight.pop(packet_id, None)
+            if entry is None:
+                return False
+            self.timers.cancel(entry[1])
+            self.ids.release(packet_id)
+            self.acked += 1
+            # Refill the window straight away so the pipeline never drains
+            while self.pending and len(self.inflight) < self.window and not self.closed:
+                self.send_new(*self.pending.popleft())
+            refill = self.refill if not self.pending and not self.closed else None
+        if refill is not None:
+            refill()  # Outside the lock: it publishes into this window again
+        return True
+
+    def retransmit(self, packet_id):
+        # Fired by the TimerWheel
+        with self.lock:
+            entry = self.inflight.get(packet_id)
+            if entry is None or self.closed:
+                return
+            frame, timer = entry
+            self.retransmitted += 1
+            self.timers.reschedule(timer, self.retry_interval)
+            self.queue.put(bytes([frame[0] | 0x08]) + frame[1:], force=True)  # Same frame with DUP set
+
+    def close(self):
+        """Stops delivery. Returns [(topic_bytes, payload, 1)] for every unacknowledged message."""
+        with self.lock:
+            self.closed = True
+            self.refill = None
+            unacknowledged = []
+            for frame, timer in self.inflight.values():
+                self.timers.cancel(timer)
+                unacknowledged.append(split_publish(frame))
+            unacknowledged.extend((topic_bytes, payload, 1) for topic_bytes, payload, _ in self.pending)
+            self.inflight.clear()
+            self.pending.clear()
+            return unacknowledged
+
+    def stats(self):
+        with self.lock:
+            return {
+                "inflight": len(self.inflight),
+                "pending": len(self.pending),
+                "sent": self.sent,
+                "acked": self.acked,
+                "retransmitted": self.retransmitted,
+                "dropped": self.dropped,
+            }
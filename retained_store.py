@@ -0,0 +1,246 @@
+import os
+import struct
+import threading
+
+from mqtt_logging import get_logger
+
+log = get_logger('retained')
+
+RECORD_HEADER = struct.Struct("!BHI")  # QoS, topic length, payload length; an empty payload deletes the topic
+COMPACT_MIN_BYTES = 1024 * 1024  # Never rewrite a log smaller than this
+
+
+class RetainedNode:
+    __slots__ = ("children", "message")
+
+    def __init__(self):
+        self.children = {}  # Topic level -> RetainedNode
+        self.message = None  # (payload bytes, qos) retained for the topic ending here
+
+
+class RetainedStore:
+    """The last retained PUBLISH per topic, kept in a trie of concrete topic levels.
+
+    match() walks the subscription filter through the trie: a literal level follows one
+    child, '+' every child at that depth and '#' a whole subtree, so a SUBSCRIBE only
+    visits topics that can match instead of scanning the store. Memory is accounted as
+    topic plus payload bytes; with max_bytes set, a message that would exceed the cap is
+    refused and the previous value (if any) is kept.
+
+    With a path, every change is appended to a log file which is replayed on startup
+    and rewritten without the superseded records once it is twice the live size.
+    """
+
+    def __init__(self, max_bytes=None, path=None):
+        self.root = RetainedNode()
+        self.max_bytes = max_bytes
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        self.bytes = 0  # Topic and payload bytes of every retained message
+        self.rejected = 0
+        self.log_file = None
+        self.log_bytes = 0
+        if path:
+            self.load()
+
+    def __len__(self):
+        return self.count
+
+    def set(self, topic, payload, qos=0):
+        """Retains payload for topic (an empty payload clears it). Returns False if refused."""
+        payload = bytes(payload)  # The caller's view points into a reused receive buffer
+        with self.lock:
+            if not self._store(topic, payload, qos):
+                return False
+            if self.log_file is not None:
+                self.append(topic, payload, qos)
+        return True
+
+    def set_missing(self, topic, payload, qos=0):
+        """Retains payload for topic unless a message is already retained there. Returns True if it was stored."""
+        payload = bytes(payload)
+        with self.lock:
+            if not payload or self._find(topic) is not None or not self._store(topic, payload, qos):
+                return False
+            if self.log_file is not None:
+                self.append(topic, payload, qos)
+        return True
+
+    def get(self, topic):
+        """Returns (payload, qos) retained for a concrete topic, or None."""
+        with self.lock:
+            return self._find(topic)
+
+    def match(self, topic_filter):
+        """Returns [(topic, payload, qos)] for every retained topic the filter matches."""
+        result = []
+        with self.lock:
+            self._match(self.root, topic_filter.split('/'), 0, [], result)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {"messages": self.count, "bytes": self.bytes, "rejected": self.rejected}
+
+    def snapshot(self):
+        """Returns [(topic, payload, qos)] for every retained message, '$' topics included."""
+        result = []
+        with self.lock:
+            self._collect_all(self.root, [], result)
+        return result
+
+    def clear(self):
+        """Drops every retained message, e.g. before loading a snapshot from a peer."""
+        with self.lock:
+            self.root = RetainedNode()
+            self.count = 0
+            self.bytes = 0
+            if self.log_file is not None:
+                self.compact()
+
+    def close(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+    def _find(self, topic):
+        # Called with the lock held
+        node = self.root
+        for level in topic.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node.message
+
+    def _store(self, topic, payload, qos):
+        # Called with the lock held
+        levels = topic.split('/')
+        if not payload:
+            self._clear(levels)
+            return True
+        node = self.root
+        for level in levels:
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = RetainedNode()
+            node = child
+        old_size = len(node.message[0]) + len(topic) if node.message else 0
+        new_size = len(payload) + len(topic)
+        if self.max_bytes is not None and self.bytes - old_size + new_size > self.max_bytes:
+            self.rejected += 1
+            if node.message is None:
+                self._clear(levels)  # Prune the nodes just created
+            log.warning("[RETAIN] Store full (%s bytes), refused %s", self.bytes, topic)
+            return False
+        if node.message is None:
+            self.count += 1
+        self.bytes += new_size - old_size
+        node.message = (payload, qos)
+        return True
+
+    def _clear(self, levels):
+        path = []
+        node = self.root
+        for level in levels:
+            child = node.children.get(level)
+            if child is None:
+                return
+            path.append((node, level))
+            node = child
+        if node.message is not None:
+            self.count -= 1
+            self.bytes -= len(node.message[0]) + len('/'.join(levels))
+            node.message = None
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.message is not None or child.children:
+                break
+            del parent.children[level]
+
+    def _match(self, node, levels, index, prefix, result):
+        if index == len(levels):
+            if node.message is not None:
+                result.append(('/'.join(prefix), *node.message))
+            return
+        level = levels[index]
+        if level == '#':
+            # '#' also matches the parent level itself ("a/#" matches "a")
+            self._collect(node, prefix, result, index == 0)
+        elif level == '+':
+            for name, child in node.children.items():
+                if index == 0 and name.startswith('$'):
+                    continue  # Wildcards at the first level never match $SYS and friends
+                self._match(child, levels, index + 1, prefix + [name], result)
+        else:
+            child = node.children.get(level)
+            if child is not None:
+                self._match(child, levels, index + 1, prefix + [level], result)
+
+    def _collect(self, node, prefix, result, skip_dollar):
+        if node.message is not None and prefix:
+            result.append(('/'.join(prefix), *node.message))
+        for name, child in node.children.items():
+            if skip_dollar and name.startswith('$'):
+                continue
+            self._collect(child, prefix + [name], result, False)
+
+    def load(self):
+        """Replays the log file, then rewrites it with only the live messages."""
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(data):
+                qos, topic_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+                end = offset + RECORD_HEADER.size + topic_length + payload_length
+                if end > len(data):
+                    break  # Torn write at the end of the log
+                start = offset + RECORD_HEADER.size
+                topic = data[start:start + topic_length].decode('utf-8')
+                self._store(topic, data[start + topic_length:end], qos)
+                offset = end
+            if offset < len(data):
+                log.warning("[RETAIN] Ignored %s trailing bytes of %s", len(data) - offset, self.path)
+            log.info("[RETAIN] Loaded %s retained messages from %s", self.count, self.path)
+        self.compact()
+
+    def append(self, topic, payload, qos):
+        # Called with the lock held
+        topic_bytes = topic.encode('utf-8')
+        record = RECORD_HEADER.pack(qos, len(topic_bytes), len(payload)) + topic_bytes + payload
+        try:
+            self.log_file.write(record)
+            self.log_file.flush()
+            self.log_bytes += len(record)
+        except OSError as e:
+            log.error("[ERROR] Failed to persist retained message: %s", e)
+            return
+        if self.log_bytes > max(COMPACT_MIN_BYTES, 2 * (self.bytes + self.count * RECORD_HEADER.size)):
+            self.compact()
+
+    def compact(self):
+        # Writes the live messages to a new file and swaps it in atomically
+        records = []
+        self._collect_all(self.root, [], records)
+        temp_path = self.path + '.tmp'
+        try:
+            if self.log_file is not None:
+                self.log_file.close()
+            with open(temp_path, 'wb') as f:
+                for topic, payload, qos in records:
+                    topic_bytes = topic.encode('utf-8')
+                    f.write(RECORD_HEADER.pack(qos, len(topic_bytes), len(payload)) + topic_bytes + payload)
+            os.replace(temp_path, self.path)
+            self.log_file = open(self.path, 'ab')
+            self.log_bytes = self.log_file.tell()
+        except OSError as e:
+            log.error("[ERROR] Retained messages will not be persisted: %s", e)
+            self.log_file = None
+
+    def _collect_all(self, node, prefix, result):
+        if node.message is not None:
+            result.append(('/'.join(prefix), *node.message))
+        for name, child in node.children.items():
+            self._collect_all(child, prefix + [name], result)
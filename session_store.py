@@ -0,0 +1,407 @@
+import json
+import mmap
+import os
+import struct
+import threading
+
+from mqtt_logging import get_logger
+
+log = get_logger('session')
+
+RECORD_HEADER = struct.Struct("!IHH")  # Body length, target count, topic length
+TARGET = struct.Struct("!I")  # Session number << 2 | QoS the message is delivered at
+SEGMENT_SUFFIX = '.seg'
+INDEX_FILE = 'sessions.index'  # One JSON record per line, appended as sessions change
+LEGACY_INDEX_FILE = 'sessions.json'  # Whole-index snapshot written by earlier versions; converted on load
+COMPACT_MIN_RECORDS = 4096  # Never rewrite an index with fewer records than this
+
+
+class Session:
+    """A clean-session=0 client: its subscriptions and where its offline backlog starts."""
+
+    __slots__ = ('client_id', 'number', 'subscriptions', 'cursor', 'owner')
+
+    def __init__(self, client_id, number, subscriptions=None, cursor=None):
+        self.client_id = client_id
+        self.number = number
+        self.subscriptions = subscriptions or {}  # Topic filter -> granted QoS
+        self.cursor = cursor  # Log offset of the first message not yet replayed; None while online
+        self.owner = None  # Connection currently attached to the session
+
+    def __repr__(self):
+        return f"Session({self.client_id!r})"
+
+
+class Segment:
+    __slots__ = ('base', 'path', 'file', 'map', 'size', 'used')
+
+    def __init__(self, base, path, size):
+        self.base = base  # Log offset of the segment's first byte
+        self.path = path
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)  # Sparse; zeros mark the end of the written records
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.used = 0
+
+    @property
+    def end(self):
+        return self.base + self.used
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SessionStore:
+    """Persistent sessions with an append-only log of messages for offline clients.
+
+    Messages are appended once to fixed-size segment files mapped with mmap, whatever
+    the number of offline sessions they are for; each record lists its target sessions.
+    A session only keeps a cursor into the log, so the backlog never lives in Python
+    objects: replay() walks the mapped segments from the cursor and hands out views.
+    A segment is deleted once every offline session's cursor has moved past it, or when
+    the log outgrows max_log_bytes (the sessions still behind it lose those messages).
+
+    Subscriptions and cursors are kept in an index next to the segments. Every change
+    appends one record to it, so a reconnect storm costs the same per session whatever
+    the number of sessions; the index is rewritten with only the live state once it
+    has twice as many records as the last rewrite left.
+    """
+
+    def __init__(self, directory, segment_bytes, max_log_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_log_bytes = max_log_bytes
+        self.lock = threading.Lock()
+        self.sessions = {}  # Client ID -> Session
+        self.by_number = {}  # Session number -> Session
+        self.next_number = 1
+        self.segments = []
+        self.appended = 0
+        self.replayed = 0
+        self.lost = 0  # Messages dropped by the log size cap (counted per session)
+        self.index_file = None
+        self.index_records = 0  # Records in the index file
+        self.index_rewritten = 0  # Records the last rewrite left in it
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                segment = Segment(int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name), 0)
+                segment.used = self.scan(segment)
+                self.segments.append(segment)
+        end = self.end_offset()
+        self.load_index()
+        for session in self.sessions.values():
+            if session.cursor is None:
+                session.cursor = end  # Online when the broker stopped: starts queueing from here
+        self.rewrite_index()
+        log.info("[SESSION] Loaded %s persistent sessions, %s bytes of offline messages",
+                 len(self.sessions), end - (self.segments[0].base if self.segments else 0))
+
+    def load_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        legacy_path = os.path.join(self.directory, LEGACY_INDEX_FILE)
+        if not os.path.exists(path):
+            if os.path.exists(legacy_path):
+                with open(legacy_path, encoding='utf-8') as f:
+                    index = json.load(f)
+                self.next_number = index['next_number']
+                for client_id, state in index['sessions'].items():
+                    self.add(Session(client_id, state['number'], state['subscriptions'], state['cursor']))
+            return
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self.apply(json.loads(line))
+                except ValueError:
+                    log.warning("[SESSION] Ignored a torn record at the end of %s", path)
+                    break
+
+    def apply(self, record):
+        kind, client_id = record[0], record[1]
+        if kind == 'next':
+            self.next_number = max(self.next_number, record[1])  # Numbers of dropped sessions are never reused
+            return
+        if kind == 'open':
+            self.add(Session(client_id, record[2]))
+            self.next_number = max(self.next_number, record[2] + 1)
+            return
+        session = self.sessions.get(client_id)
+        if session is None:
+            return
+        if kind == 'drop':
+            del self.sessions[client_id]
+            del self.by_number[session.number]
+        elif kind == 'sub':
+            session.subscriptions[record[2]] = record[3]
+        elif kind == 'unsub':
+            session.subscriptions.pop(record[2], None)
+        elif kind == 'cursor':
+            session.cursor = record[2]
+
+    def add(self, session):
+        self.sessions[session.client_id] = session
+        self.by_number[session.number] = session
+
+    def scan(self, segment):
+        # Finds the end of the written records; a record is only complete once its header is written
+        position = 0
+        while position + RECORD_HEADER.size <= segment.size:
+            body_length = RECORD_HEADER.unpack_from(segment.map, position)[0]
+            if body_length == 0 or position + RECORD_HEADER.size + body_length > segment.size:
+                break
+            position += RECORD_HEADER.size + body_length
+        return position
+
+    def end_offset(self):
+        return self.segments[-1].end if self.segments else 0
+
+    def log_index(self, *record):
+        # Called with the lock held
+        if self.index_file is None:
+            return
+        try:
+            self.index_file.write(json.dumps(record) + '\n')
+            self.index_file.flush()
+        except OSError as e:
+            log.error("[ERROR] Failed to save a session change: %s", e)
+            return
+        self.index_records += 1
+        if self.index_records > max(COMPACT_MIN_RECORDS, 2 * self.index_rewritten):
+            self.rewrite_index()
+
+    def rewrite_index(self):
+        # Writes the live state to a new index and swaps it in atomically; runs in
+        # amortized constant time per record, as a rewrite at most halves the records
+        lines = [json.dumps(['next', self.next_number])]
+        for session in self.sessions.values():
+            lines.append(json.dumps(['open', session.client_id, session.number]))
+            lines.extend(json.dumps(['sub', session.client_id, topic_filter, qos])
+                         for topic_filter, qos in session.subscriptions.items())
+            if session.cursor is not None:
+                lines.append(json.dumps(['cursor', session.client_id, session.cursor]))
+        path = os.path.join(self.directory, INDEX_FILE)
+        try:
+            if self.index_file is not None:
+                self.index_file.close()
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(path + '.tmp', path)
+            self.index_file = open(path, 'a', encoding='utf-8')
+        except OSError as e:
+            log.error("[ERROR] Session changes will not be persisted: %s", e)
+            self.index_file = None
+            return
+        self.index_records = self.index_rewritten = len(lines)
+        legacy_path = os.path.join(self.directory, LEGACY_INDEX_FILE)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+    def offline_sessions(self):
+        """Returns the sessions with no client attached, e.g. after a restart."""
+        with self.lock:
+            return [session for session in self.sessions.values() if session.owner is None]
+
+    def open(self, client_id, owner):
+        """Attaches a connection to the client's session. Returns (session, session_present)."""
+        with self.lock:
+            session = self.sessions.get(client_id)
+            present = session is not None
+            if session is None:
+                session = Session(client_id, self.next_number)
+                self.next_number += 1
+                self.add(session)
+                self.log_index('open', client_id, session.number)
+            session.owner = owner
+            return session, present
+
+    def adopt(self, client_id, subscriptions):
+        """Stores an offline session handed over by another worker. Returns it, or None if the client has one here."""
+        with self.lock:
+            if client_id in self.sessions:
+                return None
+            session = Session(client_id, self.next_number, dict(subscriptions), self.end_offset())
+            self.next_number += 1
+            self.add(session)
+            self.log_index('open', client_id, session.number)
+            for topic_filter, qos in session.subscriptions.items():
+                self.log_index('sub', client_id, topic_filter, qos)
+            self.log_index('cursor', client_id, session.cursor)
+            return session
+
+    def discard(self, client_id):
+        """Drops a stored session (CONNECT with clean-session=1). Returns it, or None."""
+        with self.lock:
+            session = self.sessions.pop(client_id, None)
+            if session is not None:
+                del self.by_number[session.number]
+                self.log_index('drop', client_id)
+                self.compact()
+            return session
+
+    def subscribe(self, session, topic_filter, qos):
+        with self.lock:
+            if session.subscriptions.get(topic_filter) != qos:
+                session.subscriptions[topic_filter] = qos
+                self.log_index('sub', session.client_id, topic_filter, qos)
+
+    def unsubscribe(self, session, topic_filter):
+        with self.lock:
+            if session.subscriptions.pop(topic_filter, None) is not None:
+                self.log_index('unsub', session.client_id, topic_filter)
+
+    def go_offline(self, session, owner, unacknowledged=()):
+        """Detaches a connection. Returns False if another connection has taken the session over.
+
+        unacknowledged holds (topic_bytes, payload, qos) for messages sent but never
+        acknowledged; they are queued first so they are resent on reconnect.
+        """
+        with self.lock:
+            if session.owner is not owner:
+                return False
+            session.owner = None
+            if session.cursor is None:
+                session.cursor = self.end_offset()
+            for topic_bytes, payload, qos in unacknowledged:
+                self.append(topic_bytes, payload, [TARGET.pack(session.number << 2 | qos)])
+            self.log_index('cursor', session.client_id, session.cursor)
+            return True
+
+    def enqueue(self, targets, topic_bytes, payload):
+        """Appends one message for [(session, qos)] offline sessions. Returns the number queued."""
+        with self.lock:
+            packed = [TARGET.pack(session.number << 2 | qos) for session, qos in targets
+                      if session.owner is None and session.client_id in self.sessions]
+            if packed:
+                self.append(topic_bytes, payload, packed)
+            return len(packed)
+
+    def append(self, topic_bytes, payload, packed_targets):
+        # Called with the lock held
+        body_length = 4 * len(packed_targets) + len(topic_bytes) + len(payload)
+        record_length = RECORD_HEADER.size + body_length
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.used + record_length > segment.size:
+            segment = self.roll(record_length)
+        position = segment.used + RECORD_HEADER.size
+        for target in packed_targets:
+            segment.map[position:position + 4] = target
+            position += 4
+        segment.map[position:position + len(topic_bytes)] = topic_bytes
+        position += len(topic_bytes)
+        segment.map[position:position + len(payload)] = payload
+        # The header goes in last, so a crash mid-write leaves the record unreadable rather than torn
+        RECORD_HEADER.pack_into(segment.map, segment.used, body_length, len(packed_targets), len(topic_bytes))
+        segment.used += record_length
+        self.appended += 1
+
+    def roll(self, record_length):
+        # Starts a new segment, sized for records larger than a whole segment
+        base = self.end_offset()
+        segment = Segment(base, os.path.join(self.directory, f"{base:020d}{SEGMENT_SUFFIX}"),
+                          max(self.segment_bytes, record_length))
+        self.segments.append(segment)
+        self.compact()
+        return segment
+
+    def replay(self, session, deliver):
+        """Calls deliver(topic_bytes, payload, qos) for the session's queued messages, oldest first.
+
+        payload is a view into the mapped segment, valid only during the call. deliver
+        may return False to pause (e.g. a full in-flight window); the next call resumes
+        after that message. Returns True once the backlog is exhausted.
+        """
+        with self.lock:
+            if session.cursor is None:
+                return True
+            delivered = 0
+            paused = False
+            for segment in self.segments:
+                if segment.end <= session.cursor:
+                    continue
+                position = max(session.cursor - segment.base, 0)
+                while position < segment.used and not paused:
+                    body_length, target_count, topic_length = RECORD_HEADER.unpack_from(segment.map, position)
+                    start = position + RECORD_HEADER.size
+                    position = start + body_length
+                    session.cursor = segment.base + position
+                    for (target,) in TARGET.iter_unpack(segment.map[start:start + 4 * target_count]):
+                        if target >> 2 == session.number:
+                            topic_start = start + 4 * target_count
+                            with memoryview(segment.map) as view:
+                                topic_bytes = bytes(view[topic_start:topic_start + topic_length])
+                                delivered += 1
+                                paused = deliver(topic_bytes, view[topic_start + topic_length:position],
+                                                 target & 0x03) is False
+                            break
+                if paused:
+                    break
+            self.replayed += delivered
+            if not paused:
+                session.cursor = None  # Fully caught up; live delivery takes over
+                self.compact()
+            self.log_index('cursor', session.client_id, session.cursor)
+            return not paused
+
+    def compact(self):
+        # Called with the lock held: drops segments no offline session still needs
+        cursors = [session.cursor for session in self.sessions.values() if session.cursor is not None]
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if cursors and min(cursors) < oldest.end:
+                if total <= self.max_log_bytes:
+                    break
+                behind = [session for session in self.sessions.values()
+                          if session.cursor is not None and session.cursor < oldest.end]
+                for session in behind:
+                    self.lost += self.count_for(session, oldest)
+                    session.cursor = oldest.end
+                log.warning("[SESSION] Log over %s bytes, dropped queued messages for %s",
+                            self.max_log_bytes, [session.client_id for session in behind])
+                cursors = [session.cursor for session in self.sessions.values() if session.cursor is not None]
+            self.segments.pop(0)
+            total -= oldest.size
+            oldest.close()
+            try:
+                os.remove(oldest.path)
+            except OSError as e:
+                log.error("[ERROR] Failed to delete session segment %s: %s", oldest.path, e)
+
+    def count_for(self, session, segment):
+        count = 0
+        position = max(session.cursor - segment.base, 0)
+        while position < segment.used:
+            body_length, target_count, _ = RECORD_HEADER.unpack_from(segment.map, position)
+            start = position + RECORD_HEADER.size
+            count += any(target >> 2 == session.number
+                         for (target,) in TARGET.iter_unpack(segment.map[start:start + 4 * target_count]))
+            position = start + body_length
+        return count
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "offline": sum(1 for session in self.sessions.values() if session.owner is None),
+                "log_bytes": self.end_offset() - (self.segments[0].base if self.segments else 0),
+                "segments": len(self.segments),
+                "appended": self.appended,
+                "replayed": self.replayed,
+                "lost": self.lost,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.index_file is not None:
+                self.index_file.close()
+                self.index_file = None
+            for segment in self.segments:
+                segment.map.flush()
+                segment.close()
+            self.segments = []
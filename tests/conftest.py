@@ -0,0 +1,148 @@
+import asyncio
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+from mqtt_framer import PacketFramer, encode_remaining_length  # noqa: E402
+from mqtt_server import AsyncMQTTServer, MQTTProtocol, MQTTServer  # noqa: E402
+from worker_pool import WorkerBus  # noqa: E402
+
+
+def mqtt_string(text):
+    data = text.encode('utf-8')
+    return struct.pack("!H", len(data)) + data
+
+
+class Client:
+    """A bare MQTT 3.1.1 client on one end of a socket pair; the broker serves the other end."""
+
+    def __init__(self, server, name='client'):
+        self.sock, broker_end = socket.socketpair()
+        self.sock.settimeout(5)
+        self.framer = PacketFramer()
+        self.pending = []
+        if isinstance(server, AsyncMQTTServer):
+            asyncio.run_coroutine_threadsafe(server.loop.connect_accepted_socket(
+                lambda: MQTTProtocol(server), broker_end), server.loop).result(5)
+        else:
+            server.connections.add(broker_end)
+            threading.Thread(target=server.handle_client, args=(broker_end, name), daemon=True).start()
+
+    def send(self, header, body):
+        self.sock.sendall(bytes([header]) + encode_remaining_length(len(body)) + body)
+
+    def read(self):
+        """Returns the next (header, body) from the broker; raises EOFError once it closes the connection."""
+        while not self.pending:
+            if self.framer.recv_into(self.sock) == 0:
+                raise EOFError
+            self.pending = [(header, bytes(body)) for header, body in self.framer.packets()]
+        return self.pending.pop(0)
+
+    def connect(self, client_id, clean_session=True):
+        """Sends CONNECT and returns the CONNACK session-present flag."""
+        self.send(0x10, mqtt_string('MQTT') + bytes([4, 0x02 if clean_session else 0x00]) + struct.pack("!H", 60) +
+                  mqtt_string(client_id))
+        header, body = self.read()
+        assert header == 0x20 and body[1] == 0, (header, body)
+        return bool(body[0] & 0x01)
+
+    def subscribe(self, *filters, packet_id=1):
+        """Subscribes to (topic filter, QoS) pairs and returns the SUBACK return codes."""
+        self.send(0x82, struct.pack("!H", packet_id) +
+                  b"".join(mqtt_string(topic_filter) + bytes([qos]) for topic_filter, qos in filters))
+        header, body = self.read()
+        assert header == 0x90 and struct.unpack("!H", body[:2])[0] == packet_id, (header, body)
+        return list(body[2:])
+
+    def publish(self, topic, payload, qos=0, packet_id=1):
+        self.send(0x30 | qos << 1, mqtt_string(topic) + (struct.pack("!H", packet_id) if qos else b"") + payload)
+
+    def read_publish(self):
+        """Returns (topic, payload, qos) of the next PUBLISH, acknowledging it if it is QoS 1."""
+        header, body = self.read()
+        assert header & 0xF0 == 0x30, (header, body)
+        qos = (header >> 1) & 0x03
+        topic_length = struct.unpack("!H", body[:2])[0]
+        offset = 2 + topic_length
+        if qos:
+            self.send(0x40, body[offset:offset + 2])
+            offset += 2
+        return str(body[2:2 + topic_length], 'utf-8'), body[offset:], qos
+
+    def disconnect(self):
+        self.send(0xE0, b"")
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def publish(server, topic, payload, qos=0):
+    """Publishes as if a client had, on the thread that owns the broker's connections."""
+    if isinstance(server, AsyncMQTTServer):
+        server.loop.call_soon_threadsafe(server.publish_to_subscribers, topic, payload, qos)
+    else:
+        server.publish_to_subscribers(topic, payload, qos)
+
+
+@pytest.fixture(params=[MQTTServer, AsyncMQTTServer], ids=['threaded', 'async'])
+def server_class(request):
+    return request.param
+
+
+@pytest.fixture
+def make_server(tmp_path, monkeypatch, server_class):
+    """Starts brokers with a session store of their own under tmp_path and no sinks; stops them afterwards.
+
+    They listen on an ephemeral port, but the tests hand them connections directly.
+    """
+    monkeypatch.setattr(config, 'MQTT_HOST', '127.0.0.1')
+    monkeypatch.setattr(config, 'MQTT_PORT', 0)
+    monkeypatch.setattr(config, 'METRICS_PORT', None)
+    monkeypatch.setattr(config, 'METRICS_INTERVAL', None)
+    monkeypatch.setattr(config, 'RETAINED_STORE_PATH', None)
+    monkeypatch.setattr(config, 'BUS_SOCKET_DIR', str(tmp_path))
+    servers = []
+
+    def make(name='broker'):
+        monkeypatch.setattr(config, 'SESSION_STORE_DIR', str(tmp_path / name))
+        server = server_class(sinks=[])
+        servers.append(server)
+        threading.Thread(target=server.start, daemon=True).start()
+        wait_for(lambda: server.listeners or getattr(server, 'server', None) is not None)
+        return server
+
+    yield make
+    for server in servers:
+        server.stop(timeout=1)
+
+
+@pytest.fixture
+def make_pool(make_server):
+    """Starts brokers linked by a WorkerBus, as worker_pool.py runs them, once every link is up."""
+
+    def make(workers):
+        servers = [make_server(f"worker{index}") for index in range(workers)]
+        for index, server in enumerate(servers):
+            server.bus = WorkerBus(server, index, workers)
+            server.bus.start()
+        wait_for(lambda: all(len(server.bus.peers) == workers - 1 for server in servers))
+        return servers
+
+    return make
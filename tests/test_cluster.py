@@ -0,0 +1,36 @@
+import socket
+
+import config
+from cluster import ClusterBus
+from conftest import Client, wait_for
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_linked_nodes_fill_in_each_others_retained_messages(make_server, monkeypatch):
+    monkeypatch.setattr(config, 'CLUSTER_HOST', '127.0.0.1')
+    ports = [free_port(), free_port()]
+    nodes = [make_server(f"node{index}") for index in range(2)]
+    nodes[0].retained.set('r/both', b'first')
+    nodes[0].retained.set('r/first', b'only on first', 1)
+    nodes[1].retained.set('r/both', b'second')
+
+    for index, node in enumerate(nodes):
+        monkeypatch.setattr(config, 'CLUSTER_PORT', ports[index])
+        node.bus = ClusterBus(node, f"node{index}", [f"127.0.0.1:{ports[1 - index]}"])
+        node.bus.start()
+    wait_for(lambda: nodes[1].retained.get('r/first') is not None)
+
+    assert nodes[1].retained.get('r/first') == (b'only on first', 1)
+    assert nodes[1].retained.get('r/both') == (b'second', 0)  # The local value is kept
+    wait_for(lambda: len(nodes[0].retained) == 2)
+    assert nodes[0].retained.get('r/both') == (b'first', 0)
+
+    client = Client(nodes[1])
+    client.connect('client')
+    client.subscribe(('r/first', 1))
+    assert client.read_publish() == ('r/first', b'only on first', 1)
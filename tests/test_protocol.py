@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import Client, publish
+
+
+def test_publish_to_a_topic_with_wildcards_closes_the_connection(make_server):
+    server = make_server()
+    subscriber = Client(server)
+    subscriber.connect('subscriber')
+    assert subscriber.subscribe(('#', 0)) == [0]
+    publisher = Client(server)
+    publisher.connect('publisher')
+
+    publisher.publish('p/+/t', b'bad')
+    with pytest.raises(EOFError):
+        publisher.read()
+    publisher = Client(server)
+    publisher.connect('publisher')
+    publisher.publish('p/#', b'bad')
+    with pytest.raises(EOFError):
+        publisher.read()
+
+    publisher = Client(server)
+    publisher.connect('publisher')
+    publisher.publish('p/ok', b'good')
+    assert subscriber.read_publish() == ('p/ok', b'good', 0)
+
+
+def test_subscribe_to_several_filters_at_once(make_server):
+    server = make_server()
+    client = Client(server)
+    client.connect('client')
+    assert client.subscribe(('a/+', 0), ('b/#', 1), ('c/#/d', 0), ('d', 2)) == [0, 1, 0x80, 1]
+
+    for topic in ('a/1', 'b/2/3', 'd'):
+        publish(server, topic, b'm')
+        assert client.read_publish()[0] == topic
+
+
+def test_unsubscribe_from_several_filters_at_once(make_server):
+    server = make_server()
+    client = Client(server)
+    client.connect('client')
+    client.subscribe(('a', 0), ('b', 0), ('c', 0))
+    client.send(0xA2, b'\x00\x02' + b'\x00\x01a' + b'\x00\x01b')
+    assert client.read() == (0xB0, b'\x00\x02')
+
+    for topic in ('a', 'b', 'c'):
+        publish(server, topic, b'm')
+    assert client.read_publish()[0] == 'c'
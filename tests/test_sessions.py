@@ -0,0 +1,46 @@
+import threading
+
+from conftest import Client, publish, wait_for
+
+
+def test_backlog_replayed_on_reconnect(make_server):
+    server = make_server()
+    client = Client(server)
+    assert not client.connect('sensor', clean_session=False)
+    assert client.subscribe(('s/t', 1)) == [1]
+    client.disconnect()
+    wait_for(lambda: server.sessions.offline_sessions())
+
+    publish(server, 's/t', b'queued', 1)
+    client = Client(server)
+    assert client.connect('sensor', clean_session=False)
+    assert client.read_publish() == ('s/t', b'queued', 1)
+
+
+def test_publish_while_client_disconnects_is_queued(make_server, monkeypatch):
+    server = make_server()
+    client = Client(server)
+    client.connect('sensor', clean_session=False)
+    assert client.subscribe(('s/t', 1)) == [1]
+
+    go_offline = server.sessions.go_offline
+    publishers = []
+
+    def publish_meanwhile(session, owner, unacknowledged=()):
+        # A message published on another thread just as the session goes offline
+        publisher = threading.Thread(target=server.publish_to_subscribers, args=('s/t', b'late', 1))
+        publisher.start()
+        publisher.join(0.2)
+        publishers.append(publisher)
+        return go_offline(session, owner, unacknowledged)
+
+    monkeypatch.setattr(server.sessions, 'go_offline', publish_meanwhile)
+    client.disconnect()
+    wait_for(lambda: server.sessions.offline_sessions())
+    for publisher in publishers:
+        publisher.join(5)
+    monkeypatch.setattr(server.sessions, 'go_offline', go_offline)
+
+    client = Client(server)
+    assert client.connect('sensor', clean_session=False)
+    assert client.read_publish() == ('s/t', b'late', 1)
@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import Client, publish, wait_for
+
+
+def test_reconnect_to_another_worker_closes_the_old_connection(make_pool):
+    first, second = make_pool(2)
+    old = Client(first)
+    old.connect('device')
+    new = Client(second)
+    new.connect('device')
+    with pytest.raises(EOFError):
+        old.read()
+    wait_for(lambda: not first.clients)
+
+    assert new.subscribe(('w/t', 0)) == [0]
+    wait_for(lambda: first.bus.remote.match('w/t', {}))
+    publish(first, 'w/t', b'once')
+    assert new.read_publish() == ('w/t', b'once', 0)
+
+
+def test_session_moves_to_the_worker_a_client_reconnects_to(make_pool):
+    first, second = make_pool(2)
+    client = Client(first)
+    assert not client.connect('device', clean_session=False)
+    assert client.subscribe(('w/s', 1)) == [1]
+    client.disconnect()
+    wait_for(lambda: first.sessions.offline_sessions())
+    publish(first, 'w/s', b'queued', 1)
+
+    client = Client(second)
+    assert client.connect('device', clean_session=False)
+    assert client.read_publish() == ('w/s', b'queued', 1)
+    assert not first.sessions.sessions  # Moved, not copied
+
+    wait_for(lambda: first.bus.remote.match('w/s', {}))
+    publish(first, 'w/s', b'live', 1)
+    assert client.read_publish() == ('w/s', b'live', 1)
+
+
+def test_clean_session_drops_the_session_on_other_workers(make_pool):
+    first, second = make_pool(2)
+    client = Client(first)
+    client.connect('device', clean_session=False)
+    client.subscribe(('w/s', 1))
+    client.disconnect()
+    wait_for(lambda: first.sessions.offline_sessions())
+
+    client = Client(second)
+    assert not client.connect('device', clean_session=True)
+    assert not first.sessions.sessions and not second.sessions.sessions
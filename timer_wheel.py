@@ -0,0 +1,87 @@
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'slot')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.slot = None  # Wheel slot holding the timer; None once fired or cancelled
+
+
+class TimerWheel:
+    """Hashed timing wheel shared by every connection of a server.
+
+    schedule() and cancel() are O(1) whatever the number of timers, and a single
+    periodic advance() (one thread or one asyncio task) fires everything that is due,
+    instead of a timer object or wakeup per message or per socket. Deadlines are
+    rounded up to the next tick; timers more than one rotation away stay in their slot
+    until a later pass reaches their deadline.
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.current_tick = int(time.monotonic() / tick)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) from advance() once `delay` seconds have passed."""
+        deadline = time.monotonic() + delay
+        timer = Timer(deadline, callback, args)
+        with self.lock:
+            # Never behind the wheel's position, or the timer would wait a full rotation
+            due_tick = max(int(-(-deadline // self.tick)), self.current_tick + 1)
+            timer.slot = self.slots[due_tick % len(self.slots)]
+            timer.slot.add(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+
+    def reschedule(self, timer, delay):
+        """Moves an existing (or already fired) timer to a new deadline."""
+        deadline = time.monotonic() + delay
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+            timer.deadline = deadline
+            due_tick = max(int(-(-deadline // self.tick)), self.current_tick + 1)
+            timer.slot = self.slots[due_tick % len(self.slots)]
+            timer.slot.add(timer)
+
+    def advance(self, now=None):
+        """Fires every timer that is due; callbacks run outside the wheel's lock."""
+        now = time.monotonic() if now is None else now
+        target_tick = int(now / self.tick)
+        due = []
+        with self.lock:
+            # After a long stall one full rotation already visits every slot
+            first_tick = max(self.current_tick + 1, target_tick - len(self.slots) + 1)
+            for tick in range(first_tick, target_tick + 1):
+                slot = self.slots[tick % len(self.slots)]
+                # Anything later in this slot belongs to a future rotation
+                for timer in [t for t in slot if t.deadline < now + self.tick]:
+                    slot.discard(timer)
+                    timer.slot = None
+                    due.append(timer)
+            self.current_tick = max(self.current_tick, target_tick)
+        for timer in due:
+            timer.callback(*timer.args)
+        return len(due)
+
+    def run(self):
+        # Driver loop for threaded servers; the asyncio server calls advance() from a task instead
+        while True:
+            time.sleep(self.tick)
+            self.advance()
@@ -0,0 +1,174 @@
+import os
+import ssl
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import metrics
+
+READ_SIZE = 65536  # Ciphertext read from the socket at a time
+
+
+def create_context():
+    """Server context for TLS_PORT. Both TLS 1.2 and 1.3 resume sessions from tickets.
+
+    The ticket keys are generated with the context, so a ticket is good for as long
+    as the process runs: a device reconnecting to the same broker process skips the
+    certificate exchange and key agreement.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(config.TLS_CERTFILE, config.TLS_KEYFILE)
+    if config.TLS_CAFILE:
+        context.load_verify_locations(config.TLS_CAFILE)
+        context.verify_mode = ssl.CERT_REQUIRED
+    context.num_tickets = config.TLS_SESSION_TICKETS
+    return context
+
+
+def create_handshake_pool():
+    """Threads for TLS handshakes, so neither the event loop nor a client's thread spends CPU on one.
+
+    On Linux the threads are niced by TLS_HANDSHAKE_NICE: during a reconnect storm the
+    handshakes then get the CPU time the serving threads leave, and deliveries to
+    connected clients keep their latency even on a single core.
+    """
+    return ThreadPoolExecutor(config.TLS_HANDSHAKE_THREADS, thread_name_prefix='tls-handshake',
+                              initializer=lower_priority)
+
+
+def lower_priority():
+    if config.TLS_HANDSHAKE_NICE and sys.platform.startswith('linux'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), config.TLS_HANDSHAKE_NICE)  # Per thread on Linux
+        except OSError:
+            pass
+
+
+class TLSChannel:
+    """The TLS state of one connection, kept in memory BIOs so socket I/O stays with the caller.
+
+    OpenSSL must not be entered from two threads at once for the same connection, so
+    every SSL call takes the lock, but only to encrypt or decrypt: nothing blocks
+    while it is held. The threaded server's reader and writer can share a channel.
+    """
+
+    def __init__(self, context):
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.ssl = context.wrap_bio(self.incoming, self.outgoing, server_side=True)
+        self.lock = threading.Lock()
+
+    def handshake(self, sock, timeout):
+        """Runs the server handshake over a blocking socket; raises OSError (ssl.SSLError included) if it fails."""
+        started = time.perf_counter()
+        sock.settimeout(timeout)
+        try:
+            while True:
+                try:
+                    self.ssl.do_handshake()
+                    break
+                except ssl.SSLWantReadError:
+                    pending = self.outgoing.read()
+                    if pending:
+                        sock.sendall(pending)
+                    data = sock.recv(READ_SIZE)
+                    if not data:
+                        raise ConnectionResetError("closed during the TLS handshake")
+                    self.incoming.write(data)
+            pending = self.outgoing.read()  # The last flight, and the session tickets
+            if pending:
+                sock.sendall(pending)
+        except OSError:
+            metrics.tls_handshakes['failed'].inc()
+            raise
+        finally:
+            sock.settimeout(None)
+        metrics.tls_handshakes['resumed' if self.ssl.session_reused else 'full'].inc()
+        metrics.tls_handshake_seconds.observe(time.perf_counter() - started)
+
+    def feed(self, data):
+        with self.lock:
+            self.incoming.write(data)
+
+    def read(self, buffer):
+        """Decrypts into buffer. Returns the bytes written, 0 if no complete record is buffered, -1 on close_notify."""
+        with self.lock:
+            try:
+                return self.ssl.read(len(buffer), buffer)
+            except ssl.SSLWantReadError:
+                return 0
+            except ssl.SSLZeroReturnError:
+                return -1
+
+    def encrypt(self, data):
+        """Returns the records for data, preceded by anything the SSL object still had to send."""
+        with self.lock:
+            self.ssl.write(data)
+            return self.outgoing.read()
+
+    def pending_output(self):
+        # Records produced while reading (a TLS 1.3 KeyUpdate reply); rarely anything
+        with self.lock:
+            return self.outgoing.read() if self.outgoing.pending else b""
+
+
+class TLSSocket:
+    """A connected client socket seen through a TLSChannel, for the threaded server.
+
+    Works like the plain socket as far as the server is concerned: recv_into()
+    decrypts, sendall() encrypts, and everything else goes to the socket underneath.
+    """
+
+    def __init__(self, sock, channel):
+        self.sock = sock
+        self.channel = channel
+        self.send_lock = threading.Lock()  # Records must reach the socket in the order they were encrypted
+
+    def recv_into(self, buffer):
+        while True:
+            nbytes = self.channel.read(buffer)
+            if self.channel.outgoing.pending:
+                with self.send_lock:
+                    self.sock.sendall(self.channel.pending_output())
+            if nbytes:
+                return max(nbytes, 0)
+            data = self.sock.recv(READ_SIZE)
+            if not data:
+                return 0
+            self.channel.feed(data)
+
+    def send(self, data, flags=0):
+        if flags:
+            # A partial record cannot be handed back as a partial packet; the writer thread sends it whole
+            raise BlockingIOError
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        with self.send_lock:
+            self.sock.sendall(self.channel.encrypt(data))
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class TLSTransport:
+    """An asyncio transport seen through a TLSChannel: write() encrypts, the rest is the transport's."""
+
+    def __init__(self, transport, channel):
+        self.transport = transport
+        self.channel = channel
+
+    def write(self, data):
+        self.transport.write(self.channel.encrypt(data))
+
+    def write_pending(self):
+        pending = self.channel.pending_output()
+        if pending:
+            self.transport.write(pending)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
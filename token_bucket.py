@@ -0,0 +1,30 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Admits `rate` events per second on average, with bursts of up to `burst` at once.
+
+    reserve() never blocks: it takes a token and returns how long the caller has to wait
+    before acting on it. Tokens can go negative, so concurrent callers are spaced out
+    in the order they reserved, instead of all retrying when the next token appears.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait=float('inf')):
+        """Returns the seconds to wait (0 when a token is available), or None if that would exceed max_wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+            if wait > max_wait:
+                return None  # Nothing taken: the caller gives up instead
+            self.tokens -= 1
+            return wait
@@ -0,0 +1,234 @@
+from collections import OrderedDict
+
+SHARE_PREFIX = '$share/'
+
+
+class TrieNode:
+    __slots__ = ("children", "subscribers", "groups")
+
+    def __init__(self):
+        self.children = {}  # Topic level (or '+' / '#') -> TrieNode
+        self.subscribers = {}  # Client -> granted QoS for the filter ending at this node
+        self.groups = None  # Share name -> SharedGroup for $share/<name>/<this filter>, once there is one
+
+
+class SharedGroup:
+    """The members of one shared subscription; every matching message goes to one of them.
+
+    members is kept in rotation order, so picking is O(1): round-robin takes the front
+    member and moves it to the back. With a depth function the front two are compared
+    and the one with less waiting gets the message (least queue depth of two choices).
+    """
+
+    __slots__ = ("filter", "members")
+
+    def __init__(self, topic_filter):
+        self.filter = topic_filter  # The whole '$share/<name>/<filter>'
+        self.members = OrderedDict()  # Client -> granted QoS
+
+    def pick(self, depth=None):
+        members = self.members
+        front = iter(members)
+        chosen = next(front)
+        if depth is not None and len(members) > 1:
+            second = next(front)
+            if depth(second) < depth(chosen):
+                chosen = second
+        members.move_to_end(chosen)
+        return chosen, members[chosen]
+
+
+def validate_topic_filter(topic_filter):
+    """Raises ValueError unless topic_filter is a valid MQTT subscription filter."""
+    if not topic_filter:
+        raise ValueError("Empty topic filter")
+    levels = topic_filter.split('/')
+    for index, level in enumerate(levels):
+        if '#' in level and (level != '#' or index != len(levels) - 1):
+            raise ValueError(f"'#' must be the last level on its own: {topic_filter}")
+        if '+' in level and level != '+':
+            raise ValueError(f"'+' must occupy a whole level: {topic_filter}")
+    return levels
+
+
+def parse_shared_filter(topic_filter):
+    """Returns (share name, filter) for '$share/<name>/<filter>', or (None, topic_filter) for other filters."""
+    if not topic_filter.startswith(SHARE_PREFIX):
+        return None, topic_filter
+    name, _, inner = topic_filter[len(SHARE_PREFIX):].partition('/')
+    if not name or not inner or '+' in name or '#' in name:
+        raise ValueError(f"Shared subscriptions take the form $share/<name>/<filter>: {topic_filter}")
+    return name, inner
+
+
+def is_shared(topic_filter):
+    return topic_filter.startswith(SHARE_PREFIX)
+
+
+def topic_matches(topic_filter, topic):
+    """Returns True if a single topic filter matches a concrete topic name."""
+    if topic.startswith('$') and topic_filter[:1] in ('+', '#'):
+        return False
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class SubscriptionIndex:
+    """Subscription filters stored as a level-split trie with '+' and '#' nodes.
+
+    match() walks at most the topic depth (times the wildcard branches at each level),
+    independent of how many filters exist. A reverse index of client -> filters lets
+    unsubscribe and remove_client touch only that client's own nodes.
+    Not thread-safe on its own: the servers guard it with their topic_lock.
+
+    A '$share/<name>/<filter>' subscription joins the SharedGroup of that name on the
+    filter's node; match() returns one member per matching group, chosen round-robin,
+    or by queue depth when a depth(client) function is given. Given a groups dict,
+    match() puts the matching groups in it instead, for the caller to decide which
+    of them to serve (see PeerBus.route()).
+
+    An optional listener gets on_filter_added(filter) / on_filter_removed(filter) when a
+    filter gains its first or loses its last subscriber (used to propagate interest).
+    """
+
+    def __init__(self, listener=None, depth=None):
+        self.root = TrieNode()
+        self.client_filters = {}  # Client -> set of filters it subscribed to, shared ones as '$share/...'
+        self.listener = listener
+        self.depth = depth
+
+    def __len__(self):
+        return sum(len(filters) for filters in self.client_filters.values())
+
+    def subscribe(self, client, topic_filter, qos=0):
+        share, inner = parse_shared_filter(topic_filter)
+        node = self.root
+        for level in validate_topic_filter(inner):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TrieNode()
+            node = child
+        if share is None:
+            first = not node.subscribers
+            node.subscribers[client] = qos
+        else:
+            if node.groups is None:
+                node.groups = {}
+            group = node.groups.get(share)
+            if group is None:
+                group = node.groups[share] = SharedGroup(topic_filter)
+            first = not group.members
+            group.members[client] = qos  # A new member joins at the back of the rotation
+        self.client_filters.setdefault(client, set()).add(topic_filter)
+        if first and self.listener is not None:
+            self.listener.on_filter_added(topic_filter)
+
+    def unsubscribe(self, client, topic_filter):
+        """Removes one filter for a client. Returns True if it was subscribed."""
+        filters = self.client_filters.get(client)
+        if not filters or topic_filter not in filters:
+            return False
+        filters.discard(topic_filter)
+        if not filters:
+            del self.client_filters[client]
+        self._remove(client, topic_filter)
+        return True
+
+    def remove_client(self, client):
+        """Drops every subscription of a client, visiting only its own filters."""
+        for topic_filter in self.client_filters.pop(client, ()):
+            self._remove(client, topic_filter)
+
+    def filters_for(self, client):
+        return set(self.client_filters.get(client, ()))
+
+    def filters(self):
+        """Returns every filter that currently has at least one subscriber."""
+        return set().union(*self.client_filters.values())
+
+    def match(self, topic, groups=None):
+        """Returns {client: qos} for every filter matching a concrete topic name.
+
+        With groups (a dict), matching shared groups are added to it as
+        {'$share/...': SharedGroup} and left out of the result.
+        """
+        result = {}
+        levels = topic.split('/')
+        # Wildcards at the first level must not match topics starting with '$' (e.g. $SYS)
+        self._match(self.root, levels, 0, result, not topic.startswith('$'), groups)
+        return result
+
+    def pick(self, group, result):
+        """Adds the group's next member to a match() result."""
+        client, qos = group.pick(self.depth)
+        # Overlapping filters deliver once, at the highest granted QoS
+        if result.get(client, -1) < qos:
+            result[client] = qos
+
+    def _match(self, node, levels, index, result, allow_wildcards, groups):
+        if allow_wildcards:
+            multi = node.children.get('#')
+            if multi is not None:
+                # '#' also matches the parent level itself ("a/#" matches "a")
+                self._collect(multi, result, groups)
+
+        if index == len(levels):
+            self._collect(node, result, groups)
+            return
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, result, True, groups)
+        if allow_wildcards:
+            single = node.children.get('+')
+            if single is not None:
+                self._match(single, levels, index + 1, result, True, groups)
+
+    def _collect(self, node, result, groups):
+        for client, qos in node.subscribers.items():
+            # Overlapping filters deliver once, at the highest granted QoS
+            if result.get(client, -1) < qos:
+                result[client] = qos
+        if node.groups:
+            for group in node.groups.values():
+                if groups is None:
+                    self.pick(group, result)
+                else:
+                    groups[group.filter] = group
+
+    def _remove(self, client, topic_filter):
+        # Walk down remembering the path so empty nodes can be pruned on the way back
+        share, inner = parse_shared_filter(topic_filter)
+        path = []
+        node = self.root
+        for level in inner.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                return
+            path.append((node, level))
+            node = child
+        if share is None:
+            last = node.subscribers.pop(client, None) is not None and not node.subscribers
+        else:
+            group = node.groups.get(share) if node.groups else None
+            # Leaves the rotation at once, whatever its position in it
+            last = group is not None and group.members.pop(client, None) is not None and not group.members
+            if last:
+                del node.groups[share]
+                if not node.groups:
+                    node.groups = None
+        if last and self.listener is not None:
+            self.listener.on_filter_removed(topic_filter)
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.subscribers or child.children or child.groups:
+                break
+            del parent.children[level]
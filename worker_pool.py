@@ -0,0 +1,659 @@
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+import config
+import metrics
+from autoscaling import Actuator
+from mqtt_framer import PacketFramer, decode_remaining_length, encode_remaining_length
+from mqtt_logging import get_logger, setup_logging
+from mqtt_server import AsyncMQTTServer, MQTTServer, create_influx_writer, influx_sinks, journal_sinks
+from outbound_queue import ThreadedOutboundQueue
+from topic_trie import SubscriptionIndex, is_shared
+
+log = get_logger('bus')
+
+# Bus frames reuse MQTT fixed-header framing so PacketFramer can split the stream
+BUS_PUBLISH = 0x30  # A PUBLISH packet (QoS and RETAIN bits set, no packet ID), delivered to local subscribers
+# BUS_PUBLISH that also goes to one member of the shared groups listed before the PUBLISH body:
+# group count (2 bytes), then each '$share/...' filter (2-byte length, UTF-8)
+BUS_SHARED_PUBLISH = 0xD0
+BUS_SUBSCRIBE = 0x80  # Body: a topic filter the sender's clients now subscribe to
+BUS_UNSUBSCRIBE = 0xA0  # Body: a topic filter the sender's clients no longer subscribe to
+BUS_HELLO = 0xF0  # Body: the sender's worker index (2 bytes), first frame on every link
+BUS_SYNC = 0xC0  # Asks the peer for every retained message it holds (no body)
+BUS_RETAINED = 0xB0  # One of those retained messages: a PUBLISH body, with its QoS in the fixed header
+BUS_SYNC_DONE = 0x90  # Follows the last BUS_RETAINED frame answering a BUS_SYNC (no body)
+# A persistent session handed over by a worker leaving the pool: client ID, then each
+# subscription as topic filter and granted QoS (1 byte)
+BUS_SESSION = 0xE0
+BUS_SESSION_MESSAGE = 0x60  # A message queued for that session: client ID, then a PUBLISH body; QoS in the header
+# A client connecting on the sender: claim number (4 bytes), then the client ID; bit 0 is set for
+# clean-session=1. The peer closes the client's connection there, sends its session over as
+# BUS_SESSION and BUS_SESSION_MESSAGE frames (or drops it for clean-session=1) and answers with BUS_CLAIMED
+BUS_CLAIM = 0x10
+BUS_CLAIMED = 0x20  # Body: the claim number answered
+
+
+def bus_frame(header, body):
+    return bytes([header]) + encode_remaining_length(len(body)) + body
+
+
+def bus_string(text):
+    # 2-byte length and UTF-8, as in MQTT
+    data = text.encode('utf-8')
+    return struct.pack("!H", len(data)) + data
+
+
+def read_string(body, offset):
+    """Returns the bus_string() at offset and the offset after it."""
+    length = struct.unpack_from("!H", body, offset)[0]
+    return str(body[offset + 2:offset + 2 + length], 'utf-8'), offset + 2 + length
+
+
+def shared_frame(frame, filters):
+    """Turns a BUS_PUBLISH frame into a BUS_SHARED_PUBLISH frame for the given shared filters."""
+    _, consumed = decode_remaining_length(frame, 1)
+    body = struct.pack("!H", len(filters)) + b"".join(bus_string(topic_filter) for topic_filter in filters)
+    return bus_frame(BUS_SHARED_PUBLISH | frame[0] & 0x0F, body + frame[1 + consumed:])
+
+
+def bus_socket_path(port, index):
+    return os.path.join(config.BUS_SOCKET_DIR, f"mqtt-bus-{port}-{index}.sock")
+
+
+class LinkRefused(Exception):
+    """A peer link that admit() turned down, such as a second link between the same two brokers."""
+
+
+class BusPeer:
+    """One link to a peer (another worker or cluster node); writes go through a bounded outbound queue."""
+
+    def __init__(self, name, sock, dialed=False, queue_size=None, linger=0.0):
+        self.name = name
+        self.sock = sock
+        self.dialed = dialed  # True if this end opened the link
+        self.queue = ThreadedOutboundQueue(sock, queue_size or config.BUS_QUEUE_SIZE, metered=False, linger=linger)
+        self.queue.start()
+
+    def send(self, frame, force=False):
+        self.queue.put(frame, force=force)
+
+    def flush(self, timeout):
+        self.queue.drain(timeout)
+
+    def close(self):
+        self.queue.close()
+
+
+class PeerBus:
+    """Links this broker with peers so a publish reaches their subscribers too.
+
+    Peers tell each other which topic filters their clients subscribe to (through the
+    SubscriptionIndex listener), so a publish is only forwarded to peers that have a
+    matching subscriber. Subclasses provide the transport: start() opens the links,
+    each of which is served by serve_peer(), and hello() / create_peer() name the ends.
+
+    A shared subscription gets each message once however many brokers its members
+    are on: the broker a message is published on picks one of the brokers holding
+    members, round-robin, and only that one delivers it to a member (see route()).
+
+    With sync set, the broker replaces its retained messages with those of the first
+    peer it links with, and `synced` is set once they are in; until then, retained
+    messages published meanwhile are noted in `fresh` so the snapshot cannot overwrite
+    them. Without sync, `synced` is set from the start.
+
+    A client is connected to one broker at a time: the broker a CONNECT arrives on claims
+    the client ID from every peer, which closes the client's connection there and sends
+    over its persistent session with the queued messages, and only answers the CONNECT
+    once they all have (see claim()).
+    """
+
+    LOCAL = 'local'  # Member of remote's shared groups standing for this broker's own members
+
+    def __init__(self, server, name, sync=False):
+        self.server = server
+        self.name = name
+        self.peers = {}  # Peer name -> BusPeer
+        self.remote = SubscriptionIndex()  # BusPeer (or LOCAL) -> filters subscribed on that peer
+        self.lock = threading.Lock()  # Guards peers and remote, and the sync state
+        self.closing = False  # Set by stop(); no more links are made
+        self.synced = threading.Event()
+        self.sync_peer = None  # Peer sending its retained messages
+        self.fresh = None  # Retained topics published since the sync started; None until it starts
+        self.claims = {}  # Claim number -> [peers yet to answer, callback once they all have]
+        self.next_claim = 0
+        if not sync:
+            self.synced.set()
+
+    def hello(self):
+        raise NotImplementedError
+
+    def create_peer(self, hello, sock, dialed):
+        raise NotImplementedError
+
+    def accept_loop(self, listener):
+        while True:
+            sock, _ = listener.accept()
+            if self.closing:
+                sock.close()
+                continue
+            threading.Thread(target=self.serve_peer, args=(sock,), daemon=True).start()
+
+    def serve_peer(self, sock, dialed=False):
+        """Serves one link until it drops; returns the name the peer gave in its hello, if any."""
+        name = peer = None
+        framer = PacketFramer()
+        try:
+            sock.sendall(bus_frame(BUS_HELLO, self.hello()))
+            while True:
+                if framer.recv_into(sock) == 0:
+                    break
+                for header, body in framer.packets():
+                    if header == BUS_HELLO:
+                        new_peer = self.create_peer(bytes(body), sock, dialed)
+                        name = new_peer.name
+                        peer = self.add_peer(new_peer)
+                        self.request_sync()
+                    elif header & 0xF0 in (BUS_PUBLISH, BUS_SHARED_PUBLISH):
+                        metrics.bus_received.inc()
+                        shared = []
+                        offset = 0
+                        if header & 0xF0 == BUS_SHARED_PUBLISH:
+                            offset = 2
+                            for _ in range(struct.unpack_from("!H", body, 0)[0]):
+                                topic_filter, offset = read_string(body, offset)
+                                shared.append(topic_filter)
+                        topic, offset = read_string(body, offset)
+                        payload = bytes(body[offset:])  # The framer reuses its buffer
+                        if header & 0x01 and not self.synced.is_set():
+                            with self.lock:
+                                if self.fresh is not None:
+                                    self.fresh.add(topic)
+                        self.server.deliver_from_bus(topic, payload, (header >> 1) & 0x03, bool(header & 0x01),
+                                                     shared)
+                    elif header == BUS_SYNC and peer is not None:
+                        self.send_retained(peer)
+                    elif header & 0xF0 == BUS_RETAINED:
+                        topic, offset = read_string(body, 0)
+                        self.apply_retained(topic, bytes(body[offset:]), (header >> 1) & 0x03)
+                    elif header == BUS_SYNC_DONE and peer is not None:
+                        self.finish_sync(peer)
+                    elif header == BUS_SESSION:
+                        client_id, offset = read_string(body, 0)
+                        subscriptions = {}
+                        while offset < len(body):
+                            topic_filter, offset = read_string(body, offset)
+                            subscriptions[topic_filter] = body[offset]
+                            offset += 1
+                        self.server.adopt_session(client_id, subscriptions)
+                    elif header & 0xF0 == BUS_SESSION_MESSAGE:
+                        client_id, offset = read_string(body, 0)
+                        topic_length = struct.unpack_from("!H", body, offset)[0]
+                        topic_bytes = bytes(body[offset + 2:offset + 2 + topic_length])
+                        self.server.queue_for_session(client_id, topic_bytes, body[offset + 2 + topic_length:],
+                                                      (header >> 1) & 0x03)
+                    elif header & 0xF0 == BUS_CLAIM and peer is not None:
+                        client_id, _ = read_string(body, 4)
+                        self.release(peer, struct.unpack_from("!I", body, 0)[0], client_id, bool(header & 0x01))
+                    elif header == BUS_CLAIMED and peer is not None:
+                        self.answered(struct.unpack_from("!I", body, 0)[0], peer)
+                    elif header == BUS_SUBSCRIBE and peer is not None:
+                        with self.lock:
+                            self.remote.subscribe(peer, str(body, 'utf-8'))
+                    elif header == BUS_UNSUBSCRIBE and peer is not None:
+                        with self.lock:
+                            self.remote.unsubscribe(peer, str(body, 'utf-8'))
+        except LinkRefused as e:
+            log.info("[BUS] %s refused a link: %s", self.name, e)
+        except (OSError, ValueError) as e:
+            log.error("[BUS] Link error: %s", e)
+        finally:
+            if peer is not None:
+                self.remove_peer(peer)
+            sock.close()
+        return name
+
+    def admit(self, peer):
+        """Called with the lock held before a peer is linked; raises LinkRefused to turn it down."""
+        stale = self.peers.get(peer.name)
+        if stale is not None:
+            self.drop(stale)  # The peer restarted and dialled again before its old link was noticed as gone
+
+    def drop(self, peer):
+        try:
+            peer.sock.shutdown(socket.SHUT_RDWR)  # Its reader then removes it
+        except OSError:
+            pass
+
+    def add_peer(self, peer):
+        # Holding topic_lock keeps filter changes from slipping in between the snapshot
+        # and the peer becoming visible to on_filter_added / on_filter_removed
+        with self.server.topic_lock:
+            with self.lock:
+                try:
+                    self.admit(peer)
+                except LinkRefused:
+                    peer.close()
+                    raise
+                self.peers[peer.name] = peer
+            for topic_filter in self.server.topics.filters():
+                peer.send(bus_frame(BUS_SUBSCRIBE, topic_filter.encode('utf-8')), force=True)
+        log.info("[BUS] %s linked with %s", self.name, peer.name)
+        return peer
+
+    def remove_peer(self, peer):
+        with self.lock:
+            if self.peers.get(peer.name) is peer:
+                del self.peers[peer.name]
+            self.remote.remove_client(peer)
+            if self.sync_peer is peer:
+                self.sync_peer = None  # Ask another peer; what this one sent so far is kept
+            claims = [number for number, (waiting, _) in self.claims.items() if peer in waiting]
+        for number in claims:
+            self.answered(number, peer)  # A peer that is gone holds no connection
+        peer.close()
+        log.warning("[BUS] %s lost %s", self.name, peer.name)
+        self.request_sync()
+
+    def request_sync(self):
+        """Asks a linked peer for its retained messages, unless they are in or already asked for."""
+        with self.lock:
+            if self.synced.is_set() or self.sync_peer is not None or not self.peers or self.closing:
+                return
+            if self.fresh is None:
+                self.fresh = set()
+                self.server.retained.clear()  # Whatever the store loaded from disk may be stale
+            self.sync_peer = peer = next(iter(self.peers.values()))
+        peer.send(bus_frame(BUS_SYNC, b""), force=True)
+        log.info("[BUS] %s asked %s for its retained messages", self.name, peer.name)
+
+    def send_retained(self, peer):
+        # Forced: a snapshot missing messages would go unnoticed
+        for topic, payload, qos in self.server.retained.snapshot():
+            peer.send(bus_frame(BUS_RETAINED | qos << 1, bus_string(topic) + payload), force=True)
+        peer.send(bus_frame(BUS_SYNC_DONE, b""), force=True)
+
+    def apply_retained(self, topic, payload, qos):
+        with self.lock:
+            if self.fresh is not None and topic in self.fresh:
+                return  # Published after the peer took its snapshot
+        self.server.retained.set(topic, payload, qos)
+
+    def finish_sync(self, peer):
+        with self.lock:
+            if peer is not self.sync_peer:
+                return
+            self.sync_peer = None
+            self.fresh = None
+            self.synced.set()
+        log.info("[BUS] %s has the %s retained messages of %s", self.name, len(self.server.retained), peer.name)
+
+    def claim(self, client_id, clean_session, done):
+        """Asks every peer to close client_id's connection, as the client is connecting here.
+
+        done() is called once each peer linked now has answered or gone, on whichever
+        thread that happens (at once without peers). Returns the claim number, which
+        abandon() takes when the broker stops waiting.
+        """
+        with self.lock:
+            self.next_claim += 1
+            number = self.next_claim
+            peers = list(self.peers.values())
+            if peers:
+                self.claims[number] = [set(peers), done]
+        if not peers:
+            done()
+            return number
+        frame = bus_frame(BUS_CLAIM | clean_session, struct.pack("!I", number) + bus_string(client_id))
+        for peer in peers:
+            peer.send(frame, force=True)  # A dropped claim would leave the CONNECT waiting
+        return number
+
+    def answered(self, number, peer):
+        with self.lock:
+            claim = self.claims.get(number)
+            if claim is None:
+                return
+            claim[0].discard(peer)
+            if claim[0]:
+                return
+            del self.claims[number]
+        claim[1]()
+
+    def abandon(self, number):
+        with self.lock:
+            self.claims.pop(number, None)
+
+    def release(self, peer, number, client_id, clean_session):
+        # Runs on the link's reader thread: the client is connecting to peer, so its persistent
+        # session moves there, backlog included, unless the client starts a clean one
+        self.server.release_client(client_id)
+        sessions = self.server.sessions
+        session = sessions.sessions.get(client_id) if sessions is not None else None
+        if session is not None and session.owner is None:
+            if clean_session:
+                self.server.discard_session(client_id)
+            else:
+                queued = self.send_session(peer, session)
+                log.info("[BUS] %s moved the session of %s and %s queued messages to %s",
+                         self.name, client_id, queued, peer.name)
+        peer.send(bus_frame(BUS_CLAIMED, struct.pack("!I", number)), force=True)
+
+    def send_session(self, peer, session):
+        """Sends an offline session, with the messages queued for it, to peer and drops it here.
+
+        Returns the number of messages sent. The frames go before anything sent to peer
+        afterwards, so it has the session by the time it reads the next frame.
+        """
+        sessions = self.server.sessions
+        with self.server.topic_lock:
+            self.server.topics.remove_client(session)  # Nothing more is queued for it here
+        client_id = bus_string(session.client_id)
+        peer.send(bus_frame(BUS_SESSION, client_id + b"".join(
+            bus_string(topic_filter) + bytes([qos]) for topic_filter, qos in session.subscriptions.items())),
+            force=True)
+        queued = [0]
+
+        def send(topic_bytes, payload, qos):
+            queued[0] += 1
+            peer.send(bus_frame(BUS_SESSION_MESSAGE | qos << 1, client_id + struct.pack("!H", len(topic_bytes)) +
+                                topic_bytes + bytes(payload)), force=True)
+
+        sessions.replay(session, send)
+        sessions.discard(session.client_id)
+        return queued[0]
+
+    def stop(self, timeout=5):
+        """Closes every link once its queue is written, or once timeout seconds are up."""
+        deadline = time.monotonic() + timeout
+        self.closing = True
+        for peer in self.all_peers():
+            peer.flush(max(deadline - time.monotonic(), 0))
+            self.drop(peer)
+
+    def on_filter_added(self, topic_filter):
+        if is_shared(topic_filter):
+            with self.lock:
+                self.remote.subscribe(self.LOCAL, topic_filter)
+        self.broadcast(bus_frame(BUS_SUBSCRIBE, topic_filter.encode('utf-8')))
+
+    def on_filter_removed(self, topic_filter):
+        if is_shared(topic_filter):
+            with self.lock:
+                self.remote.unsubscribe(self.LOCAL, topic_filter)
+        self.broadcast(bus_frame(BUS_UNSUBSCRIBE, topic_filter.encode('utf-8')))
+
+    def broadcast(self, frame):
+        for peer in self.all_peers():
+            peer.send(frame, force=True)  # Interest updates must never be dropped
+
+    def all_peers(self):
+        with self.lock:
+            return list(self.peers.values())
+
+    def route(self, topic, retain=False):
+        """Decides which peers get a message published on this broker.
+
+        Returns ({peer: [shared filters it serves]}, [shared filters served here]). The
+        peers are those with a matching ordinary subscriber (every peer for a retained
+        message), plus one broker per matching shared group. The server calls this
+        with its topic_lock held, so LOCAL membership matches its own shared groups.
+        """
+        groups = {}
+        with self.lock:
+            interested = self.remote.match(topic, groups)
+            targets = {peer: [] for peer in (self.peers.values() if retain else interested)}
+            local = []
+            for topic_filter, group in groups.items():
+                member, _ = group.pick()
+                if member == self.LOCAL:
+                    local.append(topic_filter)
+                else:
+                    targets.setdefault(member, []).append(topic_filter)
+        return targets, local
+
+    def forward(self, targets, publish_packet):
+        """Sends a BUS_PUBLISH frame to every peer from route(), with the shared filters each one serves."""
+        metrics.bus_forwarded.inc(len(targets))
+        for peer, filters in targets.items():
+            peer.send(shared_frame(publish_packet, filters) if filters else publish_packet)
+
+
+class WorkerBus(PeerBus):
+    """Links the worker processes of one broker so a publish reaches subscribers on any worker.
+
+    Worker i listens on its own Unix socket and dials every worker with a lower index,
+    redialling if that worker restarts. A worker leaving the pool (hand_off set) gives
+    its persistent sessions to the lowest-numbered peer, which a shrinking pool stops last.
+    """
+
+    def __init__(self, server, index, workers, sync=False):
+        super().__init__(server, f"worker {index}", sync)
+        self.index = index
+        self.workers = workers
+        self.path = bus_socket_path(server.port, index)
+        self.hand_off = False
+
+    def start(self):
+        self.server.topics.listener = self
+        if os.path.exists(self.path):
+            os.remove(self.path)  # Left behind by a previous run of this worker
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(self.workers)
+        threading.Thread(target=self.accept_loop, args=(listener,), daemon=True).start()
+        for index in range(self.index):
+            threading.Thread(target=self.connect_loop, args=(index,), daemon=True).start()
+
+    def connect_loop(self, index):
+        delay = 0.1
+        while not self.closing:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(bus_socket_path(self.server.port, index))
+            except OSError:
+                sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+                continue
+            delay = 0.1
+            self.serve_peer(sock, dialed=True)  # Returns once the link drops
+
+    def hello(self):
+        return struct.pack("!H", self.index)
+
+    def create_peer(self, hello, sock, dialed):
+        return BusPeer(f"worker {struct.unpack('!H', hello)[0]}", sock, dialed)
+
+    def stop(self, timeout=5):
+        if self.hand_off and self.server.sessions is not None:
+            peers = self.all_peers()
+            if peers:
+                self.hand_off_sessions(min(peers, key=lambda peer: int(peer.name.rpartition(' ')[2])))
+            elif self.server.sessions.offline_sessions():
+                log.warning("[BUS] %s has no peer to hand its persistent sessions to", self.name)
+        super().stop(timeout)
+
+    def hand_off_sessions(self, peer):
+        """Sends every offline session, with the messages queued for it, to peer and drops it here."""
+        handed = queued = 0
+        for session in self.server.sessions.offline_sessions():
+            queued += self.send_session(peer, session)
+            handed += 1
+        log.info("[BUS] %s handed %s persistent sessions and %s queued messages to %s",
+                 self.name, handed, queued, peer.name)
+
+
+def run_worker(index, workers, reports=None, sync=False):
+    if config.INFLUX_SPILL_PATH:
+        config.INFLUX_SPILL_PATH = f"{config.INFLUX_SPILL_PATH}.{index}"  # One spill file per worker
+    if config.RETAINED_STORE_PATH:
+        config.RETAINED_STORE_PATH = f"{config.RETAINED_STORE_PATH}.{index}"  # Each worker holds every retained message
+    if config.SESSION_STORE_DIR:
+        config.SESSION_STORE_DIR = os.path.join(config.SESSION_STORE_DIR, str(index))  # Sessions move to whichever worker the client reconnects to
+    if config.JOURNAL_DIR:
+        config.JOURNAL_DIR = os.path.join(config.JOURNAL_DIR, str(index))  # One journal per worker
+    if config.METRICS_PORT:
+        config.METRICS_PORT += index  # Each worker is scraped on its own port
+    setup_logging()
+    if reports is not None:
+        # Every sample of this worker's rolling counts goes to the pool, which adds them up
+        metrics.rolling.listeners.append(lambda row, timestamp_ns: reports.put((index, row)))
+    # Workers store messages but not their own counts: the pool writes the sum of them,
+    # one mqtt_message_count series whatever the number of workers
+    sinks = journal_sinks() + influx_sinks(counts=None)
+    server = AsyncMQTTServer(sinks) if config.SERVER_MODE == 'async' else MQTTServer(sinks)
+    server.reuse_port = True
+    server.bus = WorkerBus(server, index, workers, sync)
+    server.bus.start()
+    # SIGTERM: the pool is shrinking, so the worker hands its persistent sessions to a peer.
+    # SIGINT: the pool is stopping, so they stay on disk for the next start. Either way the
+    # clients are disconnected (and reconnect to the other workers) and the sinks flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_worker(server, hand_off=True))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_worker(server, hand_off=False))
+    if not server.bus.synced.wait(config.WORKER_SYNC_TIMEOUT):
+        log.warning("[BUS] Worker %s got no retained messages from a peer in %ss; serving what it has",
+                    index, config.WORKER_SYNC_TIMEOUT)
+    server.start()
+
+
+def stop_worker(server, hand_off):
+    # Runs in a signal handler, so the shutdown itself goes to a thread of its own
+    server.bus.hand_off = server.bus.hand_off or hand_off
+    threading.Thread(target=server.stop, args=(config.WORKER_STOP_TIMEOUT,), name='worker-stop').start()
+
+
+class WorkerPool(Actuator):
+    """Starts the worker processes, restarts any that die and resizes the pool on request.
+
+    Workers are numbered 0..n-1; growing adds the next numbers and shrinking stops the
+    highest, so a new worker always finds the ones it dials. Workers are stopped
+    gracefully (see run_worker): a stopped worker's clients are disconnected and
+    reconnect to the others through SO_REUSEPORT, and its sinks are flushed. A worker
+    started into a running pool copies the retained messages from a peer before it
+    accepts clients, rather than trusting its own file, which is stale. With
+    collect_load set, `load` holds the whole pool's rolling counts, summed from what
+    every worker reports, and its samples are what goes to InfluxDB as
+    mqtt_message_count. Workers are spawned, not forked, because the pool process
+    has threads of its own (the load collector, the forecaster).
+    """
+
+    def __init__(self, workers, maximum=None, collect_load=False):
+        self.workers = workers
+        self.maximum = max(workers, maximum or workers)  # Sizes each worker's bus listen backlog
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}  # Worker index -> Process
+        self.lock = threading.Lock()  # Guards processes and workers between resize() and supervise()
+        self.reports = self.context.Queue() if collect_load else None
+        self.load = None
+        self.influx = None  # Writes the samples of load to InfluxDB
+        if collect_load:
+            self.totals = {name: 0 for name, (_, cumulative) in metrics.rolling.sources.items() if cumulative}
+            self.gauges = {}  # Worker index -> {name: latest value}
+            self.load = metrics.RollingCounts()
+            for name in self.totals:
+                self.load.track(name, lambda name=name: self.totals[name])
+            self.load.track('connections', lambda: self.gauge_total('connections'), cumulative=False)
+
+    def spawn(self, index, sync=False):
+        process = self.context.Process(target=run_worker, args=(index, self.maximum, self.reports, sync),
+                                       name=f"mqtt-worker-{index}")
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        with self.lock:
+            for index in range(self.workers):
+                self.spawn(index)
+        if self.reports is not None:
+            threading.Thread(target=self.collect_load, name='pool-load', daemon=True).start()
+            self.influx = create_influx_writer()
+            if self.influx is not None:
+                self.influx.start()
+                self.load.listeners.append(
+                    lambda row, timestamp_ns: self.influx.write('mqtt_message_count', row, timestamp_ns))
+            self.load.start(config.METRICS_INTERVAL, config.METRICS_HISTORY)
+        log.info("[WORKERS] Started %s worker processes on port %s", self.workers, config.MQTT_PORT)
+
+    def capacity(self):
+        return self.workers
+
+    def resize(self, count):
+        with self.lock:
+            for index in range(self.workers, count):
+                self.spawn(index, sync=True)
+            stopped = {index: self.processes.pop(index) for index in range(count, self.workers)}
+            self.workers = count
+        self.stop_workers(stopped, signal.SIGTERM)
+        if self.reports is not None:
+            for index in stopped:
+                self.gauges.pop(index, None)
+        log.info("[WORKERS] Resized to %s worker processes", count)
+
+    def supervise(self):
+        """Restarts workers that exit, until interrupted; then stops them all."""
+        try:
+            while True:
+                time.sleep(1)
+                with self.lock:
+                    for index, process in list(self.processes.items()):
+                        if not process.is_alive():
+                            log.warning("[WORKERS] Worker %s exited with code %s, restarting", index, process.exitcode)
+                            self.spawn(index, sync=True)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        with self.lock:
+            processes, self.processes = self.processes, {}
+        self.stop_workers(processes, signal.SIGINT)
+        if self.influx is not None:
+            self.influx.stop()
+
+    def stop_workers(self, processes, signum):
+        """Sends signum to the {index: process} workers and waits for them to stop; one that hangs is killed."""
+        for process in processes.values():
+            try:
+                os.kill(process.pid, signum)
+            except ProcessLookupError:
+                pass  # Already exited
+        deadline = time.monotonic() + config.WORKER_STOP_TIMEOUT + 5
+        for index, process in processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                log.warning("[WORKERS] Worker %s did not stop within %ss, killing it", index, config.WORKER_STOP_TIMEOUT)
+                process.kill()
+                process.join()
+            self.remove_socket(index)
+
+    def remove_socket(self, index):
+        path = bus_socket_path(config.MQTT_PORT, index)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def collect_load(self):
+        while True:
+            index, row = self.reports.get()
+            for name, value in row.items():
+                if name in self.totals:
+                    self.totals[name] += value
+                elif index in self.processes:  # Late reports of a stopped worker must not count again
+                    self.gauges.setdefault(index, {})[name] = value
+
+    def gauge_total(self, name):
+        return sum(values.get(name, 0) for values in list(self.gauges.values()))
+
+
+def main():
+    setup_logging()
+    pool = WorkerPool(config.WORKER_PROCESSES or os.cpu_count() or 1, collect_load=bool(config.METRICS_INTERVAL))
+    pool.start()
+    pool.supervise()
+
+
+if __name__ == "__main__":
+    main()